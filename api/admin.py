@@ -1,16 +1,83 @@
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
+from django.core.exceptions import PermissionDenied
+from django.db import transaction
+from django.shortcuts import get_object_or_404, redirect
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from .chat_search import filter_messages
+from .importers import FORMATS, RouteImportError, detect_format, import_route
 from .models import (
-    Destination, TrekRoute, WeatherCache,
+    Destination, TrekRoute, RouteMetrics, WeatherCache,
     ChatRoom, ChatMessage, Booking, Review
 )
 
 
+class RouteImportForm(forms.Form):
+    file = forms.FileField(help_text='GPX, GeoJSON or CSV track')
+    format = forms.ChoiceField(choices=[('', 'Detect from extension')] + [(f, f.upper()) for f in FORMATS],
+                               required=False)
+    replace = forms.BooleanField(required=False, help_text='Delete the existing route first')
+    min_spacing = forms.FloatField(required=False, min_value=0,
+                                   help_text='Drop unnamed points closer than this many metres')
+
+
 @admin.register(Destination)
 class DestinationAdmin(admin.ModelAdmin):
-    list_display = ['name', 'location', 'altitude', 'difficulty', 'price', 'featured']
+    list_display = ['name', 'location', 'altitude', 'difficulty', 'price', 'featured', 'rating_average']
     list_filter = ['difficulty', 'featured', 'best_season']
     search_fields = ['name', 'location', 'description']
     list_editable = ['featured']
+    readonly_fields = ['rating_count', 'rating_sum', 'rating_average', 'rating_histogram']
+    actions = ['import_route_action']
+    
+    def get_urls(self):
+        return [
+            path('<int:destination_id>/import-route/',
+                 self.admin_site.admin_view(self.import_route_view),
+                 name='api_destination_import_route'),
+        ] + super().get_urls()
+    
+    @admin.action(description='Import route from GPX/GeoJSON/CSV file')
+    def import_route_action(self, request, queryset):
+        if queryset.count() != 1:
+            self.message_user(request, 'Select exactly one destination to import a route into.',
+                              messages.WARNING)
+            return None
+        return redirect(reverse('admin:api_destination_import_route', args=[queryset.get().pk]))
+    
+    def import_route_view(self, request, destination_id):
+        destination = get_object_or_404(Destination, pk=destination_id)
+        if not self.has_change_permission(request, destination):
+            raise PermissionDenied
+        form = RouteImportForm(request.POST or None, request.FILES or None)
+        if request.method == 'POST' and form.is_valid():
+            upload = form.cleaned_data['file']
+            try:
+                fmt = form.cleaned_data['format'] or detect_format(upload.name)
+                stats = import_route(
+                    destination, upload.file, fmt,
+                    replace=form.cleaned_data['replace'],
+                    min_spacing_m=form.cleaned_data['min_spacing'] or 0,
+                )
+            except (ValueError, RouteImportError) as e:
+                self.message_user(request, f'Import failed: {e}', messages.ERROR)
+            else:
+                self.message_user(
+                    request,
+                    f"Imported {stats['imported']} points into {destination.name} "
+                    f"({stats['points_per_second']:.0f} points/sec)",
+                    messages.SUCCESS,
+                )
+                return redirect(reverse('admin:api_trekroute_changelist') + f'?destination__id__exact={destination.pk}')
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': f'Import route for {destination.name}',
+            'destination': destination,
+            'form': form,
+        }
+        return TemplateResponse(request, 'admin/api/destination/import_route.html', context)
 
 
 @admin.register(TrekRoute)
@@ -20,6 +87,13 @@ class TrekRouteAdmin(admin.ModelAdmin):
     ordering = ['destination', 'sequence_order']
 
 
+@admin.register(RouteMetrics)
+class RouteMetricsAdmin(admin.ModelAdmin):
+    list_display = ['destination', 'total_distance_km', 'total_ascent_m', 'max_grade_percent', 'computed_at']
+    readonly_fields = ['legs', 'computed_at']
+    exclude = ['encoded_routes']
+
+
 @admin.register(WeatherCache)
 class WeatherCacheAdmin(admin.ModelAdmin):
     list_display = ['destination', 'temperature', 'weather_condition', 'risk_level', 'cached_at']
@@ -28,7 +102,8 @@ class WeatherCacheAdmin(admin.ModelAdmin):
 
 @admin.register(ChatRoom)
 class ChatRoomAdmin(admin.ModelAdmin):
-    list_display = ['destination', 'created_at']
+    list_display = ['destination', 'message_count', 'created_at']
+    readonly_fields = ['message_count', 'last_message']
 
 
 @admin.register(ChatMessage)
@@ -36,6 +111,35 @@ class ChatMessageAdmin(admin.ModelAdmin):
     list_display = ['user', 'chat_room', 'timestamp', 'message']
     list_filter = ['chat_room', 'timestamp']
     search_fields = ['message', 'user__username']
+    
+    def get_search_results(self, request, queryset, search_term):
+        # Match message text through the full-text index instead of LIKE scans
+        if not search_term.strip():
+            return super().get_search_results(request, queryset, search_term)
+        return filter_messages(queryset, search_term.strip()), False
+    
+    # Keep the rooms' denormalized counters in sync with admin edits
+    @transaction.atomic
+    def save_model(self, request, obj, form, change):
+        old_room_id = ChatMessage.objects.get(pk=obj.pk).chat_room_id if change else None
+        super().save_model(request, obj, form, change)
+        if not change:
+            ChatRoom.record_new_messages(obj.chat_room_id, 1, obj.pk)
+        elif old_room_id != obj.chat_room_id:
+            ChatRoom.refresh_message_summary(old_room_id)
+            ChatRoom.refresh_message_summary(obj.chat_room_id)
+    
+    @transaction.atomic
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        ChatRoom.refresh_message_summary(obj.chat_room_id)
+    
+    @transaction.atomic
+    def delete_queryset(self, request, queryset):
+        room_ids = set(queryset.values_list('chat_room_id', flat=True))
+        super().delete_queryset(request, queryset)
+        for room_id in room_ids:
+            ChatRoom.refresh_message_summary(room_id)
 
 
 @admin.register(Booking)
@@ -51,3 +155,23 @@ class ReviewAdmin(admin.ModelAdmin):
     list_display = ['user', 'destination', 'rating', 'created_at']
     list_filter = ['rating', 'created_at']
     search_fields = ['user__username', 'destination__name', 'comment']
+    
+    # Keep the denormalized rating summary in sync with admin edits
+    @transaction.atomic
+    def save_model(self, request, obj, form, change):
+        if change:
+            old = Review.objects.get(pk=obj.pk)
+            Destination.apply_rating_change(old.destination_id, removed=old.rating)
+        super().save_model(request, obj, form, change)
+        Destination.apply_rating_change(obj.destination_id, added=obj.rating)
+    
+    @transaction.atomic
+    def delete_model(self, request, obj):
+        Destination.apply_rating_change(obj.destination_id, removed=obj.rating)
+        super().delete_model(request, obj)
+    
+    @transaction.atomic
+    def delete_queryset(self, request, queryset):
+        for review in queryset:
+            Destination.apply_rating_change(review.destination_id, removed=review.rating)
+        super().delete_queryset(request, queryset)
@@ -0,0 +1,239 @@
+"""
+Versioned response cache for read-heavy destination endpoints.
+
+Responses are stored under a key that embeds the destination (or catalogue)
+version, which is derived from `Destination.updated_at`. Writes to a
+destination or its routes/reviews/weather bump that timestamp (see
+api/signals.py), so stale entries are never served and simply age out.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Count, Max
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import Destination
+
+
+class LRUCacheBackend:
+    """
+    In-process LRU cache with optional per-entry expiry.
+    Fast, but not shared between worker processes.
+    Keeps hit/miss/eviction counters for stats().
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                self.expirations += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires_at = time.monotonic() + timeout if timeout is not None else None
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+class DjangoCacheBackend:
+    """
+    Shared backend on top of a Django cache alias (e.g. Redis or Memcached),
+    so every worker process sees the same entries and versions.
+    """
+
+    def __init__(self, alias='default'):
+        self.cache = caches[alias]
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, timeout=None):
+        self.cache.set(key, value, timeout)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def clear(self):
+        self.cache.clear()
+
+
+_backend = None
+
+
+def get_response_cache():
+    """Return the configured response cache backend (created once per process)"""
+    global _backend
+    if _backend is None:
+        config = getattr(settings, 'RESPONSE_CACHE', {})
+        backend_class = import_string(config.get('BACKEND', 'api.cache.LRUCacheBackend'))
+        _backend = backend_class(**config.get('OPTIONS', {}))
+    return _backend
+
+
+def _version_timeout():
+    # Version entries are re-read from the database after this many seconds,
+    # which bounds staleness when a per-process backend misses an
+    # invalidation made by another worker.
+    return getattr(settings, 'RESPONSE_CACHE', {}).get('VERSION_TIMEOUT', 5)
+
+
+def _response_timeout():
+    return getattr(settings, 'RESPONSE_CACHE', {}).get('TIMEOUT', 3600)
+
+
+def _timestamp_token(value):
+    return format(int(value.timestamp() * 1_000_000), 'x') if value else '0'
+
+
+def destination_version(destination_id):
+    """Version token for one destination, or None if it does not exist"""
+    try:
+        destination_id = int(destination_id)
+    except (TypeError, ValueError):
+        return None  # not an id: the view's get_object() answers 404
+    cache = get_response_cache()
+    key = f'version:destination:{destination_id}'
+    version = cache.get(key)
+    if version is None:
+        updated_at = Destination.objects.filter(pk=destination_id).values_list(
+            'updated_at', flat=True).first()
+        if updated_at is None:
+            return None
+        version = _timestamp_token(updated_at)
+        cache.set(key, version, _version_timeout())
+    return version
+
+
+def catalogue_version():
+    """Version token covering every destination (used by list views)"""
+    cache = get_response_cache()
+    key = 'version:catalogue'
+    version = cache.get(key)
+    if version is None:
+        summary = Destination.objects.aggregate(latest=Max('updated_at'), total=Count('id'))
+        version = f"{_timestamp_token(summary['latest'])}-{summary['total']}"
+        cache.set(key, version, _version_timeout())
+    return version
+
+
+def invalidate_destination(destination_id):
+    """Forget cached versions so the next request re-reads updated_at"""
+    cache = get_response_cache()
+    cache.delete(f'version:destination:{destination_id}')
+    cache.delete('version:catalogue')
+
+
+def on_commit_once(key, function):
+    """
+    Run `function` when the current transaction commits (immediately outside
+    one), however many times it is scheduled under the same `key` meanwhile
+    """
+    # The wrapper, not the `connection` proxy, is this thread's connection
+    wrapper = connections[DEFAULT_DB_ALIAS]
+    pending = wrapper.__dict__.setdefault('_api_on_commit_once', {})
+    callback = pending.get(key)
+    # A rolled-back callback is gone from run_on_commit and can be scheduled again
+    if callback is not None and any(entry[1] is callback for entry in wrapper.run_on_commit):
+        return
+
+    def callback():
+        pending.pop(key, None)
+        function()
+
+    pending[key] = callback
+    transaction.on_commit(callback)
+
+
+def touch_destination(destination_id):
+    """
+    Bump updated_at without firing save signals, then invalidate caches;
+    once per destination and transaction, when it commits
+    """
+    def touch():
+        Destination.objects.filter(pk=destination_id).update(updated_at=timezone.now())
+        invalidate_destination(destination_id)
+
+    on_commit_once(('touch', destination_id), touch)
+
+
+def cached_response(request, name, version, build):
+    """
+    Serve `build()` through the response cache with a strong ETag.
+    The key covers the endpoint, version, host, renderer and query string,
+    so a given key always maps to the same representation.
+    Returns 304 when the client's If-None-Match matches.
+    """
+    if version is None or request.method != 'GET':
+        return build()
+
+    key = '|'.join([
+        'response', name, version, request.get_host(),
+        request.accepted_renderer.format, request.get_full_path(),
+    ])
+    etag = '"%s"' % hashlib.sha1(key.encode()).hexdigest()
+
+    if etag in _parse_if_none_match(request):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+    cache = get_response_cache()
+    data = cache.get(key)
+    if data is None:
+        response = build()
+        if response.status_code != status.HTTP_200_OK:
+            return response
+        data = response.data
+        cache.set(key, data, _response_timeout())
+    return Response(data, headers={'ETag': etag})
+
+
+def _parse_if_none_match(request):
+    header = request.META.get('HTTP_IF_NONE_MATCH', '')
+    return {tag.strip() for tag in header.split(',') if tag.strip()}
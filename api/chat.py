@@ -0,0 +1,312 @@
+"""
+Write-behind persistence for WebSocket chat messages.
+
+Consumers hand messages to a per-process ChatMessageBuffer instead of
+writing them one by one. The buffer writes with bulk_create, in a single
+transaction, once it holds MAX_BATCH messages or MAX_DELAY seconds after
+the first queued one. Each message is broadcast to its room only after it
+is stored, so clients always receive database ids and timestamps, and
+nobody sees a message that was never saved.
+
+History is read with keyset pagination over (timestamp, id), and clients
+catch up after a reconnect with messages_since(), so both cost the same
+however long a room's history grows.
+
+Flushes run one at a time in arrival order, so the id order, the database
+order and the broadcast order all match. A batch that fails to write is
+retried MAX_RETRIES times, then written message by message; messages
+that still fail (e.g. their room was deleted) are logged and dropped so
+they cannot hold up the rest. Pending messages are flushed when
+the last connection in the process closes and, as a last resort, at
+interpreter exit.
+
+Broadcasts go through a ChatBroadcaster. Each event carries its frame
+already encoded in every wire format (api/protocol.py), and subscribers
+write it unchanged. By default every message is its own event. For busy
+rooms, CHAT_BROADCAST['COALESCE'] batches the messages a room receives
+within WINDOW seconds into one event:
+
+    {"type": "batch", "messages": [{"id": ..., "message": ...}, ...]}
+"""
+import asyncio
+import atexit
+import base64
+import logging
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .chat_search import index_messages
+from .models import ChatMessage, ChatRoom
+from .protocol import encode_frames
+
+logger = logging.getLogger(__name__)
+
+
+def encode_cursor(message):
+    """Opaque cursor pointing at a message's (timestamp, id) position"""
+    raw = f'{message.timestamp.isoformat()}|{message.pk}'
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """(timestamp, id) from a cursor; raises ValueError if malformed"""
+    try:
+        timestamp, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        moment = parse_datetime(timestamp)
+    except (ValueError, UnicodeError):
+        raise ValueError(cursor)
+    if moment is None:
+        raise ValueError(cursor)
+    return moment, int(message_id)
+
+
+def messages_before(chat_room_id, cursor=None, limit=50):
+    """
+    Page of messages older than `cursor` (newest page without one), returned
+    oldest first, plus the cursor of the next older page or None
+    """
+    messages = ChatMessage.objects.filter(chat_room_id=chat_room_id).select_related('user')
+    if cursor:
+        timestamp, message_id = decode_cursor(cursor)
+        messages = messages.filter(
+            Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id))
+    page = list(messages.order_by('-timestamp', '-id')[:limit + 1])
+    next_cursor = encode_cursor(page[limit - 1]) if len(page) > limit else None
+    page = page[:limit]
+    page.reverse()
+    return page, next_cursor
+
+
+def messages_since(chat_room_id, since_id, limit=200):
+    """Messages after id `since_id` in id order, plus whether more remain"""
+    page = list(ChatMessage.objects.filter(chat_room_id=chat_room_id, id__gt=since_id)
+                .select_related('user').order_by('id')[:limit + 1])
+    return page[:limit], len(page) > limit
+
+
+def write_messages(messages):
+    """
+    Store a batch of unsaved ChatMessages in one transaction, setting their
+    ids and updating the rooms' message counters
+    """
+    with transaction.atomic():
+        if connection.features.can_return_rows_from_bulk_insert:
+            ChatMessage.objects.bulk_create(messages)
+            index_messages(messages)
+        else:
+            for message in messages:
+                message.save()
+        # One counter update per room in the batch
+        rooms = {}
+        for message in messages:
+            count, _ = rooms.get(message.chat_room_id, (0, None))
+            rooms[message.chat_room_id] = (count + 1, message.pk)
+        for chat_room_id, (count, last_message_id) in rooms.items():
+            ChatRoom.record_new_messages(chat_room_id, count, last_message_id)
+    return messages
+
+
+def write_each(entries):
+    """
+    Write buffered (message, group, username) entries one at a time,
+    logging and dropping those that fail; returns the stored entries
+    """
+    stored = []
+    for entry in entries:
+        try:
+            write_messages([entry[0]])
+        except Exception:
+            _forget_ids([entry[0]])
+            logger.exception('Dropping chat message for room %s that cannot be stored',
+                             entry[0].chat_room_id)
+        else:
+            stored.append(entry)
+    return stored
+
+
+def _forget_ids(messages):
+    # A rolled-back insert may still have assigned ids (SQLite checks foreign
+    # keys at commit), which would make a retry update rows that do not exist
+    for message in messages:
+        message.pk = None
+        message._state.adding = True
+
+
+def message_payload(message, username):
+    """What WebSocket clients receive for a stored message"""
+    return {
+        'id': message.pk,
+        'message': message.message,
+        'username': username,
+        'timestamp': message.timestamp,
+    }
+
+
+def message_event(payload):
+    """Channel layer event carrying one payload, pre-encoded for every protocol"""
+    return {'type': 'chat_message', 'id': payload.get('id'), 'frames': encode_frames(payload)}
+
+
+def batch_event(payloads):
+    """Channel layer event carrying several payloads as one pre-encoded frame"""
+    ids = [payload['id'] for payload in payloads if 'id' in payload]
+    return {
+        'type': 'chat_batch',
+        'frames': encode_frames({'type': 'batch', 'messages': payloads}),
+        'first_id': ids[0] if ids else None,
+    }
+
+
+class ChatBroadcaster:
+    def __init__(self, coalesce=False, window=0.03, max_batch=100):
+        self.coalesce = coalesce
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = {}  # group name -> payloads
+        self._lock = None
+        self._timer = None
+        self._tasks = set()
+
+    async def send(self, group, payload):
+        """Broadcast a payload to a room, now or with the room's next batch"""
+        if not self.coalesce:
+            await get_channel_layer().group_send(group, message_event(payload))
+            return
+        self._pending.setdefault(group, []).append(payload)
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush_later)
+
+    def _flush_later(self):
+        self._timer = None
+        task = asyncio.ensure_future(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self):
+        """Send every room's pending payloads, at most max_batch per frame"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # One flush at a time keeps each room's batches in order
+        async with self._lock:
+            pending, self._pending = self._pending, {}
+            channel_layer = get_channel_layer()
+            for group, payloads in pending.items():
+                for start in range(0, len(payloads), self.max_batch):
+                    await channel_layer.group_send(
+                        group, batch_event(payloads[start:start + self.max_batch]))
+
+
+class ChatMessageBuffer:
+    def __init__(self, max_batch=100, max_delay=0.05, max_retries=3):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self.connections = 0
+        self._failures = 0  # consecutive failed writes of the pending batch
+        self._pending = []  # (ChatMessage, group name, username)
+        self._lock = None
+        self._timer = None
+        self._tasks = set()
+
+    def _flush_lock(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def add(self, chat_room_id, group, user, text):
+        """Queue a message; flushes inline (applying backpressure) when the batch is full"""
+        message = ChatMessage(chat_room_id=chat_room_id, user_id=user.pk,
+                              message=text, timestamp=timezone.now())
+        self._pending.append((message, group, user.username))
+        if len(self._pending) >= self.max_batch:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_delay, self._flush_later)
+
+    def _flush_later(self):
+        self._timer = None
+        task = asyncio.ensure_future(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self):
+        """Write everything queued so far, then broadcast it in order"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        async with self._flush_lock():
+            batch, self._pending = self._pending, []
+            if not batch:
+                return
+            messages = [message for message, _, _ in batch]
+            try:
+                await database_sync_to_async(write_messages)(messages)
+            except Exception:
+                _forget_ids(messages)
+                self._failures += 1
+                if self._failures < self.max_retries:
+                    # Keep the batch ahead of newer messages and retry later
+                    logger.exception('Writing %d chat messages failed; will retry', len(batch))
+                    self._pending[:0] = batch
+                    if self._timer is None:
+                        self._timer = asyncio.get_running_loop().call_later(
+                            self.max_delay * 10, self._flush_later)
+                    return
+                # Still failing: isolate the messages that cannot be written
+                logger.exception('Writing %d chat messages failed %d times; writing them one by one',
+                                 len(batch), self._failures)
+                batch = await database_sync_to_async(write_each)(batch)
+            self._failures = 0
+            broadcaster = get_chat_broadcaster()
+            for message, group, username in batch:
+                await broadcaster.send(group, message_payload(message, username))
+
+    def flush_sync(self):
+        """Store anything still queued without broadcasting (used at exit)"""
+        batch, self._pending = self._pending, []
+        if batch:
+            write_each(batch)
+
+    def connected(self):
+        self.connections += 1
+
+    async def disconnected(self):
+        self.connections -= 1
+        if self.connections <= 0:
+            await self.flush()
+
+
+_buffer = None
+
+
+def get_message_buffer():
+    """The per-process buffer configured by CHAT_WRITE_BUFFER"""
+    global _buffer
+    if _buffer is None:
+        config = getattr(settings, 'CHAT_WRITE_BUFFER', {})
+        _buffer = ChatMessageBuffer(config.get('MAX_BATCH', 100), config.get('MAX_DELAY', 0.05),
+                                    config.get('MAX_RETRIES', 3))
+        atexit.register(_buffer.flush_sync)
+    return _buffer
+
+
+_broadcaster = None
+
+
+def get_chat_broadcaster():
+    """The per-process broadcaster configured by CHAT_BROADCAST"""
+    global _broadcaster
+    if _broadcaster is None:
+        config = getattr(settings, 'CHAT_BROADCAST', {})
+        _broadcaster = ChatBroadcaster(
+            coalesce=config.get('COALESCE', False),
+            window=config.get('WINDOW', 0.03),
+            max_batch=config.get('MAX_BATCH', 100),
+        )
+    return _broadcaster
@@ -0,0 +1,186 @@
+"""
+Full-text search over chat messages backed by an SQLite FTS5 table.
+
+The index lives in `api_chatmessage_fts` (rowid = message id), which is
+created after migrate. Batched WebSocket writes are indexed by
+write_messages(), single saves and deletes by the signals in
+api/signals.py. Queries are scoped to a room by joining the matches to the
+message table by primary key, so their cost follows the number of matching
+messages rather than the size of the room.
+
+Matches are ranked with bm25 over the message text, or listed newest first
+with order='recent', which FTS5 serves in rowid order without sorting.
+Both are paged with keyset cursors. On databases without FTS5, messages are
+matched with icontains, newest first.
+"""
+import base64
+
+from django.contrib.auth.models import User
+from django.db import OperationalError, connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+from .models import ChatMessage
+from .search import SNIPPET_MARKERS, build_match_query, highlight_snippet
+
+FTS_TABLE = 'api_chatmessage_fts'
+ORDERS = ('rank', 'recent')
+
+_available = None
+
+
+def _table_exists():
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+        return cursor.fetchone() is not None
+
+
+def chat_search_available():
+    """Whether the FTS5 table exists; checked once per process"""
+    global _available
+    if _available is None:
+        _available = connection.vendor == 'sqlite' and _table_exists()
+    return _available
+
+
+def create_chat_search_index():
+    """
+    Create the FTS5 table and index existing messages if it does not exist
+    yet. Runs after migrate (see api/signals.py), so the table is there
+    before any message is written. Returns False if the backend lacks FTS5.
+    """
+    global _available
+    if connection.vendor != 'sqlite':
+        _available = False
+        return _available
+    if not _table_exists():
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+                    "message, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')")
+        except OperationalError:
+            _available = False
+            return _available
+        _available = True
+        rebuild_chat_search_index()
+    _available = True
+    return _available
+
+
+def index_messages(messages):
+    """Index saved messages (bulk_create sends no post_save signals)"""
+    if not chat_search_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"INSERT OR REPLACE INTO {FTS_TABLE} (rowid, message) VALUES (%s, %s)",
+            [(message.pk, message.message) for message in messages])
+
+
+def index_message(message):
+    index_messages([message])
+
+
+def unindex_message(message_id):
+    if not chat_search_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [message_id])
+
+
+def rebuild_chat_search_index(chunk_size=10000):
+    """Re-index every chat message; returns the number indexed"""
+    if not chat_search_available():
+        return 0
+    rows = ChatMessage.objects.order_by('id').values_list('id', 'message')
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE}")
+        chunk = []
+        for row in rows.iterator(chunk_size=chunk_size):
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                cursor.executemany(
+                    f"INSERT INTO {FTS_TABLE} (rowid, message) VALUES (%s, %s)", chunk)
+                chunk = []
+        if chunk:
+            cursor.executemany(
+                f"INSERT INTO {FTS_TABLE} (rowid, message) VALUES (%s, %s)", chunk)
+        cursor.execute(f"SELECT count(*) FROM {FTS_TABLE}")
+        return cursor.fetchone()[0]
+
+
+def encode_search_cursor(message, order):
+    """Opaque cursor after a result: its rank and id, or just its id when by recency"""
+    raw = f'{message.search_rank!r}|{message.pk}' if order == 'rank' else f'|{message.pk}'
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_search_cursor(cursor, order):
+    """(rank, id) from a cursor; raises ValueError if malformed"""
+    try:
+        rank, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return (float(rank) if order == 'rank' else None), int(message_id)
+    except (ValueError, UnicodeError):
+        raise ValueError(cursor)
+
+
+def search_messages(chat_room_id, text, order='rank', cursor=None, limit=20):
+    """
+    Page of messages in a room matching `text`, by relevance or newest first,
+    plus the cursor of the next page or None. Each message gets an HTML-escaped
+    `search_snippet` with matched terms wrapped in <mark> tags.
+    """
+    match = build_match_query(text)
+    if not match:
+        return [], None
+    messages = ChatMessage.objects.filter(chat_room_id=chat_room_id).select_related('user')
+    if not chat_search_available():
+        order = 'recent'
+        messages = messages.filter(message__icontains=text).extra(select={'search_snippet': "''"})
+        if cursor:
+            messages = messages.filter(id__lt=decode_search_cursor(cursor, order)[1])
+        page = list(messages.order_by('-id')[:limit + 1])
+    else:
+        where = [f'{FTS_TABLE}.rowid = api_chatmessage.id', f'{FTS_TABLE} MATCH %s']
+        params = [match]
+        if cursor:
+            rank, message_id = decode_search_cursor(cursor, order)
+            if order == 'rank':
+                where.append(f'({FTS_TABLE}.rank > %s OR '
+                             f'({FTS_TABLE}.rank = %s AND {FTS_TABLE}.rowid > %s))')
+                params += [rank, rank, message_id]
+            else:
+                where.append(f'{FTS_TABLE}.rowid < %s')
+                params.append(message_id)
+        # Driven from the FTS index: matches are looked up by primary key and
+        # kept if they belong to the room, so cost tracks matches, not history
+        page = list(messages.extra(
+            tables=[FTS_TABLE],
+            where=where,
+            params=params,
+            select={
+                'search_rank': f'{FTS_TABLE}.rank',
+                'search_snippet': f"snippet({FTS_TABLE}, 0, {SNIPPET_MARKERS}, '...', 16)",
+            },
+            order_by=['search_rank', f'{FTS_TABLE}.rowid'] if order == 'rank'
+            else [f'-{FTS_TABLE}.rowid'],
+        )[:limit + 1])
+    next_cursor = encode_search_cursor(page[limit - 1], order) if len(page) > limit else None
+    page = page[:limit]
+    for message in page:
+        message.search_snippet = highlight_snippet(message.search_snippet)
+    return page, next_cursor
+
+
+def filter_messages(queryset, text):
+    """Restrict `queryset` to messages matching `text` or sent by a matching username"""
+    # A subquery rather than a join, so SQLite can answer each side from an index
+    by_user = Q(user__in=User.objects.filter(username__icontains=text))
+    match = build_match_query(text)
+    if not match or not chat_search_available():
+        return queryset.filter(Q(message__icontains=text) | by_user)
+    matches = RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s',
+                     [match])
+    return queryset.filter(Q(pk__in=matches) | by_user)
@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.core.checks import Warning, register
+
+
+@register()
+def check_channel_layer(app_configs, **kwargs):
+    """The in-memory channel layer silently splits chat rooms between processes"""
+    backend = getattr(settings, 'CHANNEL_LAYERS', {}).get('default', {}).get('BACKEND', '')
+    if settings.DEBUG or not backend.endswith('InMemoryChannelLayer'):
+        return []
+    return [Warning(
+        'InMemoryChannelLayer only delivers messages within one process.',
+        hint='Set REDIS_URL when running more than one server process.',
+        id='api.W001',
+    )]
@@ -1,7 +1,13 @@
-import json
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.utils import timezone
+from .chat import get_chat_broadcaster, get_message_buffer, message_payload, messages_since
+from .limits import Outbox, get_chat_limits
+from .presence import get_presence_tracker
+from .protocol import DEFAULT_PROTOCOL, negotiate
 from .models import ChatRoom, ChatMessage
 
 
@@ -9,6 +15,12 @@ class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.room_id = self.scope['url_route']['kwargs']['room_id']
         self.room_group_name = f'chat_{self.room_id}'
+        self.chat_room_id = await self.get_chat_room_id()
+        self.message_buffer = get_message_buffer()
+        self.broadcaster = get_chat_broadcaster()
+        self.limits = get_chat_limits()
+        self.bucket = self.limits.connection_bucket()
+        self.violations = 0
 
         # Join room group
         await self.channel_layer.group_add(
@@ -16,7 +28,24 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
 
-        await self.accept()
+        # Clients pick a wire format through the WebSocket subprotocol
+        protocol = negotiate(self.scope.get('subprotocols', []))
+        self.protocol = protocol or DEFAULT_PROTOCOL
+        await self.accept(subprotocol=protocol.name if protocol else None)
+        self.outbox = Outbox(super().send, self.limits.send_queue_size)
+        self.message_buffer.connected()
+
+        user = self.scope.get('user')
+        self.username = user.username if user is not None and user.is_authenticated else None
+        self.presence = get_presence_tracker()
+        await self.presence.join(self.room_group_name, self, self.username)
+
+        # Reconnecting clients pass ?since=<last message id> to receive only
+        # what they missed; joining the group first means nothing falls in between
+        self.replayed_up_to = 0
+        since = parse_qs(self.scope.get('query_string', b'').decode()).get('since', [''])[0]
+        if self.chat_room_id and since.isdigit():
+            await self.replay(int(since))
 
     async def disconnect(self, close_code):
         # Leave room group
@@ -24,28 +53,153 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.room_group_name,
             self.channel_name
         )
+        if hasattr(self, 'outbox'):
+            self.outbox.close()
+        if hasattr(self, 'presence'):
+            self.presence.leave(self.room_group_name, self, self.username)
+        if hasattr(self, 'message_buffer'):
+            await self.message_buffer.disconnected()
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        # Frames are queued for this socket's writer task, so a slow client
+        # only ever holds up its own queue
+        outbox = getattr(self, 'outbox', None)
+        if outbox is None or close:
+            await super().send(text_data, bytes_data, close)
+            return
+        if outbox.closed:
+            return
+        frame = {'text_data': text_data} if text_data is not None else {'bytes_data': bytes_data}
+        if outbox.put(frame):
+            return
+        if self.limits.slow_consumer_policy == 'drop':
+            self.limits.count('dropped_frames')
+            return
+        # Too far behind: it can reconnect with ?since=<id> to catch up
+        self.limits.count('slow_consumer_disconnects')
+        outbox.close()
+        await self.close(code=4009)
+
+    async def send_frame(self, frame):
+        """Encode a frame in this socket's wire format and send it"""
+        await self.send(**self.protocol.send_kwargs(self.protocol.encode(frame)))
+
+    async def send_encoded(self, frames):
+        """Send this socket's encoding of a frame that was encoded for every format"""
+        await self.send(**self.protocol.send_kwargs(frames[self.protocol.name]))
+
+    async def reject(self, counter, error):
+        """Count a rejected frame; persistent offenders are disconnected"""
+        self.limits.count(counter)
+        self.violations += 1
+        if self.violations == self.limits.max_violations:
+            self.limits.count('abusive_disconnects')
+            await self.close(code=4008)
+        elif self.violations == 1:
+            # Only the first rejection of a streak is answered
+            await self.send_frame(dict(type='error', **error))
+
+    async def receive(self, text_data=None, bytes_data=None):
+        self.presence.touch(self)
+        limits = self.limits
+
+        # Cheap checks first, so a flood costs no parsing or broadcasting
+        size = len(text_data.encode()) if text_data is not None else len(bytes_data or b'')
+        if size > limits.max_message_bytes:
+            await self.reject('oversized', {'code': 'message_too_large',
+                                            'max_bytes': limits.max_message_bytes})
+            return
+        if not self.bucket.allow():
+            await self.reject('rate_limited_connection', {
+                'code': 'rate_limited', 'retry_after': round(self.bucket.retry_after(), 3)})
+            return
+        try:
+            frame = self.protocol.decode(text_data if text_data is not None else bytes_data)
+        except ValueError:
+            frame = None
+        if not isinstance(frame, dict):
+            await self.reject('invalid', {'code': 'invalid_message'})
+            return
 
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        message = text_data_json['message']
-        username = text_data_json.get('username', 'Anonymous')
+        # Control frames: keep-alives and typing indicators
+        frame_type = frame.get('type')
+        if frame_type == 'heartbeat':
+            self.violations = 0
+            self.presence.heartbeat(self)
+            return
+        if frame_type == 'typing':
+            self.violations = 0
+            self.presence.set_typing(self.room_group_name, self.username,
+                                     frame.get('typing', True))
+            return
+
+        message = frame.get('message')
+        if not isinstance(message, str):
+            await self.reject('invalid', {'code': 'invalid_message'})
+            return
+        room_bucket = limits.room_bucket(self.room_group_name)
+        if not room_bucket.allow():
+            await self.reject('rate_limited_room', {
+                'code': 'rate_limited', 'retry_after': round(room_bucket.retry_after(), 3)})
+            return
+        self.violations = 0
+        limits.count('messages_accepted')
+
+        user = self.scope.get('user')
+        self.presence.set_typing(self.room_group_name, self.username, False)
+
+        # Messages from signed-in users are stored, then broadcast by the buffer
+        if self.chat_room_id and user is not None and user.is_authenticated:
+            await self.message_buffer.add(self.chat_room_id, self.room_group_name, user, message)
+            return
+
+        username = frame.get('username', 'Anonymous')
 
         # Send message to room group
-        await self.channel_layer.group_send(
+        await self.broadcaster.send(
             self.room_group_name,
             {
-                'type': 'chat_message',
                 'message': message,
-                'username': username
+                'username': username,
+                'timestamp': timezone.now(),
             }
         )
 
     async def chat_message(self, event):
-        message = event['message']
-        username = event['username']
-
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'message': message,
-            'username': username
-        }))
+        # Stored messages carry their database id
+        if event['id'] is not None and event['id'] <= self.replayed_up_to:
+            return  # already sent during replay
+
+        # Send message to WebSocket, as encoded once for every subscriber
+        await self.send_encoded(event['frames'])
+
+    async def chat_batch(self, event):
+        if event['first_id'] is not None and event['first_id'] <= self.replayed_up_to:
+            frame = self.protocol.decode(event['frames'][self.protocol.name])
+            messages = [message for message in frame['messages']
+                        if message.get('id', self.replayed_up_to + 1) > self.replayed_up_to]
+            if messages:
+                await self.send_frame({'type': 'batch', 'messages': messages})
+            return  # the rest was already sent during replay
+        await self.send_encoded(event['frames'])
+
+    async def replay(self, since_id):
+        limit = getattr(settings, 'CHAT_REPLAY_LIMIT', 200)
+        messages, has_more = await database_sync_to_async(messages_since)(
+            self.chat_room_id, since_id, limit)
+        for message in messages:
+            await self.send_frame(message_payload(message, message.user.username))
+        if messages:
+            self.replayed_up_to = messages[-1].pk
+        if has_more:
+            # Too far behind: fetch the rest from the REST messages endpoint
+            await self.send_frame({
+                'type': 'replay_truncated',
+                'since': self.replayed_up_to,
+            })
+
+    @database_sync_to_async
+    def get_chat_room_id(self):
+        if not self.room_id.isdigit():
+            return None
+        return ChatRoom.objects.filter(pk=self.room_id).values_list('id', flat=True).first()
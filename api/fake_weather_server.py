@@ -0,0 +1,114 @@
+"""
+Local stand-in for the OpenWeatherMap and Open-Meteo current weather APIs.
+
+Serves /data/2.5/weather and /v1/forecast (multi-location) with
+configurable latency, failure rate and conditions, so the weather client,
+retries and circuit breaker can be exercised without network access.
+Point WEATHER_PROVIDER_URL at FakeWeatherServer.url.
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from .weather_providers import WMO_CONDITIONS
+
+
+class FakeWeatherServer:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, failure_rate=0.0,
+                 condition='Clear', temperature=15.5, humidity=65, wind_speed=3.5):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.condition = condition
+        self.temperature = temperature
+        self.humidity = humidity
+        self.wind_speed = wind_speed
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        """Serve on a background thread; returns self"""
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def _weather_code(self):
+        for low, _, condition, _ in WMO_CONDITIONS:
+            if condition == self.condition:
+                return low
+        return 0
+
+    def _openweathermap(self, query):
+        return {
+            'coord': {'lat': float(query['lat'][0]), 'lon': float(query['lon'][0])},
+            'weather': [{'main': self.condition, 'description': self.condition.lower()}],
+            'main': {'temp': self.temperature, 'humidity': self.humidity},
+            'wind': {'speed': self.wind_speed},
+        }
+
+    def _open_meteo(self, query):
+        latitudes = query['latitude'][0].split(',')
+        longitudes = query['longitude'][0].split(',')
+        locations = [{
+            'latitude': float(latitude),
+            'longitude': float(longitude),
+            'current': {
+                'temperature_2m': self.temperature,
+                'relative_humidity_2m': self.humidity,
+                'wind_speed_10m': self.wind_speed,
+                'weather_code': self._weather_code(),
+            },
+        } for latitude, longitude in zip(latitudes, longitudes)]
+        return locations if len(locations) > 1 else locations[0]
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with server._lock:
+                    server.requests += 1
+                if server.latency:
+                    time.sleep(server.latency)
+                if random.random() < server.failure_rate:
+                    return self._send(503, {'message': 'fake outage'})
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                try:
+                    if url.path == '/data/2.5/weather':
+                        return self._send(200, server._openweathermap(query))
+                    if url.path == '/v1/forecast':
+                        return self._send(200, server._open_meteo(query))
+                except (KeyError, ValueError):
+                    return self._send(400, {'message': 'bad coordinates'})
+                self._send(404, {'message': 'not found'})
+
+            def _send(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,182 @@
+"""
+Compact, append-only weather history.
+
+Every stored reading is appended to a WeatherHistoryChunk holding one UTC
+day of samples as a packed NumPy record array, so a day costs one row and
+16 bytes per reading. compact_weather_history() downsamples days older
+than WEATHER_HISTORY_HOURLY_RETENTION into daily aggregates packed one
+month per row, so years of history stay a few dozen small rows per
+destination and a range query reads only the chunks it overlaps.
+"""
+import datetime
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import WeatherHistoryChunk
+
+HOURLY = 'HOURLY'
+DAILY = 'DAILY'
+
+# Offsets are seconds since the chunk start
+HOURLY_DTYPE = np.dtype([
+    ('offset', '<u4'),
+    ('temperature', '<f4'),
+    ('humidity', '<f4'),
+    ('wind_speed', '<f4'),
+])
+DAILY_DTYPE = np.dtype([
+    ('offset', '<u4'),
+    ('temperature', '<f4'),
+    ('temperature_min', '<f4'),
+    ('temperature_max', '<f4'),
+    ('humidity', '<f4'),
+    ('wind_speed', '<f4'),
+    ('wind_speed_max', '<f4'),
+    ('samples', '<u2'),
+])
+DTYPES = {HOURLY: HOURLY_DTYPE, DAILY: DAILY_DTYPE}
+FIELDS = {resolution: dtype.names[1:] for resolution, dtype in DTYPES.items()}
+DAY_SECONDS = 86400
+
+
+def _day_start(moment):
+    return moment.astimezone(datetime.timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _month_start(moment):
+    return _day_start(moment).replace(day=1)
+
+
+def _next_month(start):
+    return (start + datetime.timedelta(days=32)).replace(day=1)
+
+
+def _records(chunk):
+    return np.frombuffer(bytes(chunk.data), dtype=DTYPES[chunk.resolution])
+
+
+def hourly_retention_days():
+    return getattr(settings, 'WEATHER_HISTORY_HOURLY_RETENTION', 30)
+
+
+def record_weather(weather_cache):
+    """Append a WeatherCache reading to its destination's history"""
+    moment = weather_cache.cached_at
+    start = _day_start(moment)
+    record = np.array([(
+        int((moment - start).total_seconds()),
+        weather_cache.temperature,
+        weather_cache.humidity,
+        weather_cache.wind_speed,
+    )], dtype=HOURLY_DTYPE)
+    with transaction.atomic():
+        chunk, _ = (WeatherHistoryChunk.objects.select_for_update()
+                    .get_or_create(destination_id=weather_cache.destination_id,
+                                   resolution=HOURLY, start=start))
+        chunk.data = bytes(chunk.data) + record.tobytes()
+        chunk.samples += 1
+        chunk.save(update_fields=['data', 'samples'])
+
+
+def _daily_aggregate(records, day_offset):
+    """Collapse one day of hourly records into a single DAILY_DTYPE record"""
+    return (
+        day_offset,
+        records['temperature'].mean(),
+        records['temperature'].min(),
+        records['temperature'].max(),
+        records['humidity'].mean(),
+        records['wind_speed'].mean(),
+        records['wind_speed'].max(),
+        len(records),
+    )
+
+
+def compact_weather_history(now=None):
+    """
+    Fold hourly chunks older than the retention period into monthly chunks
+    of daily aggregates. Returns the number of days compacted.
+    """
+    cutoff = _day_start(now or timezone.now()) - datetime.timedelta(days=hourly_retention_days())
+    compacted = 0
+    expired = (WeatherHistoryChunk.objects.filter(resolution=HOURLY, start__lt=cutoff)
+               .order_by('destination_id', 'start'))
+    for chunk in expired.iterator(chunk_size=500):
+        records = _records(chunk)
+        month = _month_start(chunk.start)
+        with transaction.atomic():
+            target, _ = (WeatherHistoryChunk.objects.select_for_update()
+                         .get_or_create(destination_id=chunk.destination_id,
+                                        resolution=DAILY, start=month))
+            if len(records):
+                day_offset = int((chunk.start - month).total_seconds())
+                daily = _records(target)
+                # Days arrive in order, so this only replaces a partially
+                # compacted day if the job was interrupted and rerun
+                daily = daily[daily['offset'] != day_offset]
+                merged = np.concatenate(
+                    [daily, np.array([_daily_aggregate(records, day_offset)], dtype=DAILY_DTYPE)])
+                merged.sort(order='offset')
+                target.data = merged.tobytes()
+                target.samples = len(merged)
+                target.save(update_fields=['data', 'samples'])
+            chunk.delete()
+        compacted += 1
+    return compacted
+
+
+def weather_history(destination_id, start, end, resolution=None, fields=None):
+    """
+    Readings for a destination between `start` and `end` as columns:
+    {'resolution', 'timestamps' (unix seconds), <field>: [...]}.
+    Without an explicit resolution, hourly data is used when the whole range
+    is still within retention and daily aggregates otherwise. Daily queries
+    aggregate recent hourly chunks on the fly, so they cover the full range.
+    """
+    if resolution is None:
+        hourly_from = _day_start(timezone.now()) - datetime.timedelta(days=hourly_retention_days())
+        resolution = HOURLY if start >= hourly_from else DAILY
+    available = FIELDS[resolution]
+    fields = [field for field in (fields or available) if field in available]
+
+    if resolution == HOURLY:
+        chunks = WeatherHistoryChunk.objects.filter(
+            destination_id=destination_id, resolution=HOURLY,
+            start__gt=start - datetime.timedelta(days=1), start__lte=end)
+    else:
+        chunks = WeatherHistoryChunk.objects.filter(
+            destination_id=destination_id,
+            start__gt=_month_start(start) - datetime.timedelta(days=1), start__lte=end)
+
+    timestamps = []
+    columns = {field: [] for field in fields}
+    for chunk in chunks.order_by('start').only('start', 'resolution', 'data'):
+        records = _records(chunk)
+        if chunk.resolution != resolution:
+            # Recent hourly day requested at daily resolution
+            if not len(records):
+                continue
+            records = np.array([_daily_aggregate(records, 0)], dtype=DAILY_DTYPE)
+        times = int(chunk.start.timestamp()) + records['offset'].astype(np.int64)
+        selected = (times >= start.timestamp()) & (times <= end.timestamp())
+        timestamps.append(times[selected])
+        for field in fields:
+            columns[field].append(records[field][selected])
+
+    def join(parts, dtype):
+        return np.concatenate(parts) if parts else np.empty(0, dtype=dtype)
+
+    timestamps = join(timestamps, np.int64)
+    order = np.argsort(timestamps, kind='stable')
+    result = {'resolution': resolution, 'timestamps': timestamps[order].tolist()}
+    for field in fields:
+        values = join(columns[field], DTYPES[resolution][field])[order]
+        if values.dtype.kind == 'f':
+            # float32 storage; round away the representation noise
+            result[field] = np.round(values.astype(float), 2).tolist()
+        else:
+            result[field] = values.astype(int).tolist()
+    return result
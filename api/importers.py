@@ -0,0 +1,286 @@
+"""
+Streaming importers for GPX, GeoJSON and CSV route tracks.
+
+Parsers yield one point at a time and points are written in fixed-size
+bulk_create chunks, so memory stays bounded regardless of file size.
+"""
+import csv
+import io
+import re
+import time
+import xml.etree.ElementTree as ET
+from array import array
+
+import numpy as np
+from django.db import connection, transaction
+
+from .cache import touch_destination
+from .models import TrekRoute
+from .routes import haversine_km, save_route_metrics, store_point_distances
+from . import spatial
+
+FORMATS = ('gpx', 'geojson', 'csv')
+
+_GEOJSON_TOKEN_RE = re.compile(r'"coordinates"|\[|\]|-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?')
+_GEOJSON_DELIMITERS = '[],\n\r\t '
+
+
+class RouteImportError(Exception):
+    pass
+
+
+def detect_format(filename):
+    extension = filename.rsplit('.', 1)[-1].lower()
+    if extension == 'json':
+        extension = 'geojson'
+    if extension not in FORMATS:
+        raise RouteImportError(f'Unsupported route file type: {filename}')
+    return extension
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _coordinates(lat, lon, where):
+    """Parsed latitude and longitude; RouteImportError if missing or malformed"""
+    if lat is None or lon is None:
+        raise RouteImportError(f'{where}: latitude and longitude are required')
+    try:
+        return float(lat), float(lon)
+    except ValueError:
+        raise RouteImportError(f'{where}: invalid coordinates {lat!r}, {lon!r}')
+
+
+def _altitude(value, where):
+    try:
+        return float(value) if value else None
+    except ValueError:
+        raise RouteImportError(f'{where}: invalid altitude {value!r}')
+
+
+def iter_gpx_points(stream):
+    """Yield (lat, lon, altitude, name) for every trkpt/rtept in a GPX file"""
+    try:
+        yield from _iter_gpx_points(stream)
+    except ET.ParseError as e:
+        raise RouteImportError(f'Invalid GPX: {e}')
+
+
+def _iter_gpx_points(stream):
+    parents = []
+    for event, element in ET.iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            parents.append(element)
+            continue
+        parents.pop()
+        if _local_name(element.tag) not in ('trkpt', 'rtept'):
+            continue
+        altitude = name = None
+        for child in element:
+            tag = _local_name(child.tag)
+            if tag == 'ele' and child.text:
+                altitude = _altitude(child.text.strip(), 'GPX point')
+            elif tag == 'name' and child.text:
+                name = child.text.strip()
+        lat, lon = _coordinates(element.get('lat'), element.get('lon'), 'GPX point')
+        yield lat, lon, altitude, name
+        # Detach parsed points so the tree never holds more than one
+        if parents:
+            parents[-1].remove(element)
+
+
+def iter_geojson_points(stream, chunk_size=65536):
+    """
+    Yield (lat, lon, altitude, None) for every position inside
+    "coordinates" arrays, without loading the document into memory.
+    """
+    buffer = ''
+    inside = False
+    depth = 0
+    numbers = []
+    while True:
+        chunk = stream.read(chunk_size)
+        buffer += chunk
+        if chunk:
+            # Only tokenize up to the last delimiter; the tail may be a
+            # number or key cut in half by the chunk boundary
+            cut = max(buffer.rfind(c) for c in _GEOJSON_DELIMITERS) + 1
+        else:
+            cut = len(buffer)
+        for match in _GEOJSON_TOKEN_RE.finditer(buffer, 0, cut):
+            token = match.group()
+            if token == '"coordinates"':
+                inside, depth, numbers = True, 0, []
+            elif not inside:
+                continue
+            elif token == '[':
+                depth += 1
+                numbers = []
+            elif token == ']':
+                # Positions may carry more than [lon, lat, ele], e.g. a timestamp
+                if len(numbers) >= 2:
+                    lon, lat = numbers[0], numbers[1]
+                    yield lat, lon, numbers[2] if len(numbers) > 2 else None, None
+                numbers = []
+                depth -= 1
+                inside = depth > 0
+            else:
+                numbers.append(float(token))
+        buffer = buffer[cut:]
+        if not chunk:
+            break
+
+
+def iter_csv_points(stream):
+    """Yield (lat, lon, altitude, name) from a CSV with a header row"""
+    reader = csv.DictReader(stream)
+    columns = {name.strip().lower(): name for name in reader.fieldnames or []}
+
+    def column(*candidates):
+        for candidate in candidates:
+            if candidate in columns:
+                return columns[candidate]
+        return None
+
+    lat_column = column('lat', 'latitude')
+    lon_column = column('lon', 'lng', 'longitude')
+    if not lat_column or not lon_column:
+        raise RouteImportError('CSV needs latitude and longitude columns')
+    altitude_column = column('ele', 'elevation', 'alt', 'altitude')
+    name_column = column('name', 'location_name')
+
+    for row in reader:
+        # Short rows leave the missing columns None
+        where = f'CSV line {reader.line_num}'
+        lat, lon = _coordinates(row[lat_column], row[lon_column], where)
+        altitude = row.get(altitude_column) if altitude_column else None
+        name = row.get(name_column) if name_column else None
+        yield lat, lon, _altitude(altitude, where), (name or '').strip() or None
+
+
+def iter_points(stream, fmt):
+    """Dispatch on format; `stream` is a binary file object"""
+    if fmt == 'gpx':
+        return iter_gpx_points(stream)
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    if fmt == 'geojson':
+        return iter_geojson_points(text)
+    return iter_csv_points(text)
+
+
+class _RouteColumns:
+    """A route's points as compact arrays, collected while they stream in"""
+
+    def __init__(self):
+        self.sequence = array('q')
+        self.latitudes = array('d')
+        self.longitudes = array('d')
+        self.altitudes = array('d')
+        self.stops = []
+
+    def __len__(self):
+        return len(self.latitudes)
+
+    def append(self, sequence, lat, lon, altitude, name):
+        if name:
+            self.stops.append((len(self.latitudes), name))
+        self.sequence.append(sequence)
+        self.latitudes.append(lat)
+        self.longitudes.append(lon)
+        self.altitudes.append(altitude)
+
+    def cumulative_km(self):
+        if len(self) < 2:
+            return np.zeros(len(self))
+        latitudes, longitudes = np.asarray(self.latitudes), np.asarray(self.longitudes)
+        steps = haversine_km(latitudes[:-1], longitudes[:-1], latitudes[1:], longitudes[1:])
+        return np.concatenate(([0.0], np.cumsum(steps)))
+
+
+def import_route(destination, stream, fmt, replace=False, min_spacing_m=0, chunk_size=5000):
+    """
+    Stream points from `stream` into `destination`'s route.
+    With `replace` the existing route is deleted first, otherwise points are
+    appended after the last sequence_order. `min_spacing_m` drops unnamed
+    points closer than that to the previously kept point (a streaming
+    radial-distance simplification). Returns import statistics.
+    """
+    started = time.perf_counter()
+    imported = skipped = 0
+    # Route metrics are computed from these instead of reading the route back
+    route = _RouteColumns()
+
+    with transaction.atomic():
+        if replace:
+            # Plain SQL skips the per-row delete signals that would otherwise
+            # recompute route metrics once per deleted point
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'DELETE FROM {TrekRoute._meta.db_table} WHERE destination_id = %s',
+                    [destination.pk])
+            distance = 0.0
+        else:
+            # Appended points extend the existing route, which is part of the
+            # metrics; its stored distances are brought up to date first
+            rows = (TrekRoute.objects.filter(destination=destination)
+                    .order_by('sequence_order')
+                    .values_list('id', 'sequence_order', 'latitude', 'longitude',
+                                 'altitude', 'location_name', 'distance_from_start_km'))
+            ids, stored = [], []
+            for point_id, *point, stored_km in rows.iterator(chunk_size=chunk_size):
+                ids.append(point_id)
+                stored.append(stored_km)
+                route.append(*point)
+            cumulative_km = route.cumulative_km()
+            store_point_distances(ids, stored, cumulative_km)
+            distance = float(cumulative_km[-1]) if route else 0.0
+        sequence = route.sequence[-1] if route else 0
+        previous = (route.latitudes[-1], route.longitudes[-1]) if route else None
+        altitude = int(route.altitudes[-1]) if route else 0
+
+        batch = []
+        for lat, lon, point_altitude, name in iter_points(stream, fmt):
+            if point_altitude is not None:
+                altitude = int(round(point_altitude))
+            step = (TrekRoute.calculate_distance(previous[0], previous[1], lat, lon)
+                    if previous else 0.0)
+            if previous and not name and step * 1000 < min_spacing_m:
+                skipped += 1
+                continue
+            distance += step
+            previous = (lat, lon)
+            sequence += 1
+            name = (name or '')[:200]
+            route.append(sequence, lat, lon, altitude, name)
+            batch.append(TrekRoute(
+                destination=destination,
+                sequence_order=sequence,
+                latitude=lat,
+                longitude=lon,
+                altitude=altitude,
+                location_name=name,
+                distance_from_start_km=round(distance, 4),
+            ))
+            if len(batch) >= chunk_size:
+                TrekRoute.objects.bulk_create(batch)
+                imported += len(batch)
+                batch = []
+        if batch:
+            TrekRoute.objects.bulk_create(batch)
+            imported += len(batch)
+
+        # bulk_create skips save signals, so refresh derived data once here
+        save_route_metrics(destination.pk, route.sequence, route.latitudes,
+                           route.longitudes, route.altitudes, route.stops)
+
+    touch_destination(destination.pk)
+    spatial.reset_indexes()
+
+    seconds = time.perf_counter() - started
+    return {
+        'imported': imported,
+        'skipped': skipped,
+        'seconds': seconds,
+        'points_per_second': imported / seconds if seconds else 0,
+    }
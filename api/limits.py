@@ -0,0 +1,133 @@
+"""
+Flood protection for chat sockets.
+
+Every inbound frame is checked against a size limit and a per-connection
+token bucket; chat messages also draw from a per-room bucket (per server
+process). Rejected frames cost no parsing or broadcasting, and a client
+that keeps hammering after MAX_VIOLATIONS consecutive rejections is
+disconnected.
+
+Outbound frames go through a bounded Outbox drained by one writer task per
+socket, so a slow client never blocks the room's broadcasts. When its
+queue is full the client is disconnected (it can reconnect with
+?since=<id> to catch up) or, with SLOW_CONSUMER_POLICY 'drop', the frame is
+dropped. Counters for all of this are reported by /api/chat-stats/.
+"""
+import asyncio
+import threading
+import time
+from collections import Counter, deque
+
+from django.conf import settings
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average and bursts of up to `burst`"""
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def allow(self, now=None):
+        now = now or time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def retry_after(self):
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def is_full(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class Outbox:
+    """Bounded FIFO of outbound frames, written by a single task"""
+
+    def __init__(self, send, max_size):
+        self.max_size = max_size
+        self._send = send
+        self._frames = deque()
+        self.closed = False
+        self._ready = asyncio.Event()
+        self._task = asyncio.ensure_future(self._drain())
+
+    def put(self, frame):
+        """Queue a frame; False if the queue is full"""
+        if len(self._frames) >= self.max_size:
+            return False
+        self._frames.append(frame)
+        self._ready.set()
+        return True
+
+    async def _drain(self):
+        while True:
+            if not self._frames:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            await self._send(**self._frames.popleft())
+
+    def close(self):
+        self.closed = True
+        self._frames.clear()
+        self._task.cancel()
+
+
+class ChatLimits:
+    def __init__(self, max_message_bytes=4096, connection_rate=5, connection_burst=10,
+                 room_rate=50, room_burst=100, send_queue_size=256,
+                 slow_consumer_policy='disconnect', max_violations=20):
+        self.max_message_bytes = max_message_bytes
+        self.connection_rate = connection_rate
+        self.connection_burst = connection_burst
+        self.room_rate = room_rate
+        self.room_burst = room_burst
+        self.send_queue_size = send_queue_size
+        self.slow_consumer_policy = slow_consumer_policy
+        self.max_violations = max_violations
+        self.counters = Counter()
+        self._room_buckets = {}
+        self._lock = threading.Lock()
+
+    def connection_bucket(self):
+        return TokenBucket(self.connection_rate, self.connection_burst)
+
+    def room_bucket(self, group):
+        bucket = self._room_buckets.get(group)
+        if bucket is None:
+            if len(self._room_buckets) > 10000:
+                self._forget_idle_rooms()
+            bucket = self._room_buckets[group] = TokenBucket(self.room_rate, self.room_burst)
+        return bucket
+
+    def _forget_idle_rooms(self):
+        now = time.monotonic()
+        for group in [g for g, bucket in self._room_buckets.items() if bucket.is_full(now)]:
+            del self._room_buckets[group]
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+_limits = None
+
+
+def get_chat_limits():
+    """Per-process limits configured by CHAT_LIMITS"""
+    global _limits
+    if _limits is None:
+        config = getattr(settings, 'CHAT_LIMITS', {})
+        _limits = ChatLimits(**{key.lower(): value for key, value in config.items()})
+    return _limits
@@ -0,0 +1,115 @@
+import asyncio
+import multiprocessing
+import resource
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from .chat_load_test import count_messages, lift_chat_limits
+
+
+async def _run(connections, messages, rate, timeout):
+    from channels.testing import WebsocketCommunicator
+    from trekking_app.asgi import application
+
+    clients = []
+    for _ in range(connections + 1):
+        communicator = WebsocketCommunicator(application, '/ws/chat/benchmark/')
+        connected, _ = await communicator.connect()
+        if not connected:
+            raise RuntimeError('WebSocket connection refused')
+        clients.append(communicator)
+    sender, receivers = clients[0], clients[1:]
+
+    async def send():
+        # Offer a steady load in 10 ms ticks rather than one burst
+        tick = 0.01
+        per_tick = max(1, round(rate * tick))
+        sent = 0
+        while sent < messages:
+            for _ in range(min(per_tick, messages - sent)):
+                await sender.send_json_to({'message': f'message {sent}', 'username': 'benchmark'})
+                sent += 1
+            await asyncio.sleep(tick)
+
+    async def receive(communicator):
+        received = frames = 0
+        try:
+            while received < messages:
+                count = count_messages(await communicator.receive_from(timeout=timeout))
+                received += count
+                frames += 1 if count else 0
+        except asyncio.TimeoutError:
+            pass
+        return received, frames
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.perf_counter()
+    receiving = [asyncio.ensure_future(receive(communicator)) for communicator in receivers]
+    await send()
+    counts = await asyncio.gather(*receiving)
+    elapsed = time.perf_counter() - started
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime)
+
+    for communicator in clients:
+        await communicator.disconnect()
+    return (sum(received for received, _ in counts), sum(frames for _, frames in counts),
+            elapsed, cpu)
+
+
+def _mode_main(coalesce, options, results):
+    # Runs in a forked process, before any chat singleton or channel layer exists
+    settings.CHAT_BROADCAST = dict(getattr(settings, 'CHAT_BROADCAST', {}),
+                                   COALESCE=coalesce, WINDOW=options['window'])
+    lift_chat_limits(SEND_QUEUE_SIZE=options['messages'] + 100)
+    layer = settings.CHANNEL_LAYERS['default']
+    if layer['BACKEND'].endswith('InMemoryChannelLayer'):
+        layer['CONFIG'] = dict(layer.get('CONFIG', {}), capacity=options['messages'] + 100)
+    try:
+        results.put((asyncio.run(_run(options['connections'], options['messages'],
+                                      options['rate'], options['timeout'])), None))
+    except Exception as e:
+        results.put((None, repr(e)))
+
+
+class Command(BaseCommand):
+    help = ('Compare per-message chat broadcasts with coalesced batches: one room, one sender, '
+            'many subscribers, all in one process (CPU includes the test clients)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=100, help='Subscribers in the room')
+        parser.add_argument('--messages', type=int, default=2000, help='Messages sent to the room')
+        parser.add_argument('--rate', type=float, default=1000, help='Messages per second offered')
+        parser.add_argument('--window', type=float, default=0.03,
+                            help='Coalescing window in seconds')
+        parser.add_argument('--timeout', type=float, default=10,
+                            help='Seconds a subscriber waits for its next frame')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'{options["connections"]} subscribers, {options["messages"]} messages '
+                          f'at {options["rate"]:.0f}/s, window {options["window"] * 1000:.0f} ms')
+        expected = options['connections'] * options['messages']
+        baseline = None
+        for coalesce in (False, True):
+            delivered, frames, elapsed, cpu = self.run_mode(coalesce, options)
+            rate = delivered / elapsed
+            baseline = baseline or (rate, cpu)
+            self.stdout.write(self.style.SUCCESS(
+                f'{"coalesced" if coalesce else "per-message"}: delivered {delivered}/{expected} '
+                f'messages in {frames} frames over {elapsed:.2f}s - {rate:.0f} msg/s '
+                f'({rate / baseline[0]:.2f}x), {frames / elapsed:.0f} frames/s, '
+                f'CPU {cpu:.2f}s ({cpu / baseline[1]:.2f}x)'
+            ))
+
+    def run_mode(self, coalesce, options):
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        process = context.Process(target=_mode_main, args=(coalesce, options, results))
+        process.start()
+        result, error = results.get()
+        process.join()
+        if error:
+            raise CommandError(f'Benchmark run failed: {error}')
+        return result
@@ -0,0 +1,138 @@
+import asyncio
+import json
+import multiprocessing
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+
+def lift_chat_limits(**overrides):
+    """Throughput runs would mostly measure the flood limits, so lift them for this process"""
+    settings.CHAT_LIMITS = dict(getattr(settings, 'CHAT_LIMITS', {}), CONNECTION_RATE=1e9,
+                                CONNECTION_BURST=1e9, ROOM_RATE=1e9, ROOM_BURST=1e9, **overrides)
+
+
+def count_messages(text):
+    """Chat messages carried by one frame (presence and other frames carry none)"""
+    frame = json.loads(text)
+    if frame.get('type') == 'batch':
+        return len(frame['messages'])
+    return 1 if 'message' in frame else 0
+
+
+def _room_share(total, workers, worker):
+    """Split `total` as evenly as possible and return this worker's part"""
+    return total // workers + (1 if worker < total % workers else 0)
+
+
+async def _run_worker(worker, workers, rooms, connections_per_room, messages, barrier, timeout):
+    from channels.testing import WebsocketCommunicator
+    from trekking_app.asgi import application
+
+    clients = []
+    for room in range(rooms):
+        for _ in range(_room_share(connections_per_room, workers, worker)):
+            communicator = WebsocketCommunicator(application, f'/ws/chat/loadtest{room}/')
+            connected, _ = await communicator.connect()
+            if not connected:
+                raise RuntimeError('WebSocket connection refused')
+            clients.append((room, communicator))
+
+    # Start sending only when every worker's clients have joined their rooms
+    await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+    started = time.time()
+
+    async def send(room, communicator):
+        for i in range(_room_share(messages, workers, worker)):
+            await communicator.send_json_to({'message': f'{worker}:{i}', 'username': f'load{worker}'})
+
+    async def receive(communicator):
+        received = 0
+        try:
+            while received < messages:
+                received += count_messages(await communicator.receive_from(timeout=timeout))
+        except asyncio.TimeoutError:
+            pass
+        return received
+
+    senders = {}
+    for room, communicator in clients:
+        senders.setdefault(room, communicator)
+    receiving = [asyncio.ensure_future(receive(communicator)) for _, communicator in clients]
+    await asyncio.gather(*(send(room, communicator) for room, communicator in senders.items()))
+    delivered = sum(await asyncio.gather(*receiving))
+    finished = time.time()
+
+    for _, communicator in clients:
+        await communicator.disconnect()
+    return started, finished, delivered
+
+
+def _worker_main(worker, workers, rooms, connections_per_room, messages, barrier, timeout, results):
+    lift_chat_limits()
+    try:
+        results.put((worker, asyncio.run(_run_worker(
+            worker, workers, rooms, connections_per_room, messages, barrier, timeout)), None))
+    except Exception as e:
+        barrier.abort()
+        results.put((worker, None, repr(e)))
+
+
+class Command(BaseCommand):
+    help = ('Measure chat fan-out throughput across N worker processes sharing the channel layer '
+            '(run with REDIS_URL set; the in-memory layer cannot cross processes)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4],
+                            help='Worker process counts to compare')
+        parser.add_argument('--rooms', type=int, default=10)
+        parser.add_argument('--connections', type=int, default=20,
+                            help='Connections per room, spread over the workers')
+        parser.add_argument('--messages', type=int, default=200, help='Messages sent per room')
+        parser.add_argument('--timeout', type=float, default=10,
+                            help='Seconds a client waits for its next message')
+
+    def handle(self, *args, **options):
+        backend = settings.CHANNEL_LAYERS['default']['BACKEND']
+        if max(options['workers']) > 1 and backend.endswith('InMemoryChannelLayer'):
+            raise CommandError('InMemoryChannelLayer cannot deliver between processes; set REDIS_URL')
+        self.stdout.write(f'Channel layer: {backend}')
+
+        expected = options['rooms'] * options['connections'] * options['messages']
+        baseline = None
+        for workers in options['workers']:
+            started, finished, delivered = self.run_round(workers, options)
+            rate = delivered / (finished - started)
+            baseline = baseline or rate
+            self.stdout.write(self.style.SUCCESS(
+                f'{workers} worker(s): delivered {delivered}/{expected} messages in '
+                f'{finished - started:.2f}s - {rate:.0f} msg/s ({rate / baseline:.2f}x)'
+            ))
+
+    def run_round(self, workers, options):
+        # Forked workers must not share the parent's database connections
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        barrier = context.Barrier(workers)
+        results = context.Queue()
+        processes = [
+            context.Process(target=_worker_main, args=(
+                worker, workers, options['rooms'], options['connections'],
+                options['messages'], barrier, options['timeout'], results))
+            for worker in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        outcomes = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+        errors = [error for _, _, error in outcomes if error]
+        if errors:
+            raise CommandError(f'Load test worker failed: {errors[0]}')
+        stats = [result for _, result, _ in outcomes]
+        return (min(started for started, _, _ in stats),
+                max(finished for _, finished, _ in stats),
+                sum(delivered for _, _, delivered in stats))
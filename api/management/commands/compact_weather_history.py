@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from api.history import compact_weather_history, hourly_retention_days
+
+
+class Command(BaseCommand):
+    help = 'Downsample hourly weather history past its retention period into daily aggregates'
+
+    def handle(self, *args, **kwargs):
+        compacted = compact_weather_history()
+        self.stdout.write(self.style.SUCCESS(
+            f'Compacted {compacted} days of hourly readings older than {hourly_retention_days()} days'
+        ))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from api.fake_weather_server import FakeWeatherServer
+
+
+class Command(BaseCommand):
+    help = 'Run a local fake weather API (OpenWeatherMap and Open-Meteo endpoints)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8001)
+        parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to each response')
+        parser.add_argument('--failure-rate', type=float, default=0.0,
+                            help='Fraction of requests answered with 503')
+        parser.add_argument('--condition', default='Clear', help='e.g. Clear, Rain, Snow')
+        parser.add_argument('--temperature', type=float, default=15.5)
+
+    def handle(self, *args, **options):
+        server = FakeWeatherServer(
+            options['host'], options['port'],
+            latency=options['latency'],
+            failure_rate=options['failure_rate'],
+            condition=options['condition'],
+            temperature=options['temperature'],
+        )
+        self.stdout.write(self.style.SUCCESS(f'Fake weather API listening on {server.url}'))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.httpd.server_close()
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+from api.importers import FORMATS, RouteImportError, detect_format, import_route
+from api.models import Destination
+
+
+class Command(BaseCommand):
+    help = 'Stream-import a GPX, GeoJSON or CSV track into a destination route'
+
+    def add_arguments(self, parser):
+        parser.add_argument('destination_id', type=int)
+        parser.add_argument('path', help='Track file (.gpx, .geojson/.json or .csv)')
+        parser.add_argument('--format', choices=FORMATS, help='Override detection by file extension')
+        parser.add_argument('--replace', action='store_true', help='Delete the existing route first')
+        parser.add_argument('--min-spacing', type=float, default=0,
+                            help='Drop unnamed points closer than this many metres to the previous one')
+        parser.add_argument('--chunk-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        try:
+            destination = Destination.objects.get(pk=options['destination_id'])
+        except Destination.DoesNotExist:
+            raise CommandError(f"Destination {options['destination_id']} does not exist")
+
+        try:
+            fmt = options['format'] or detect_format(options['path'])
+            self.stdout.write(f'Importing {options["path"]} into {destination.name}...')
+            with open(options['path'], 'rb') as stream:
+                stats = import_route(
+                    destination, stream, fmt,
+                    replace=options['replace'],
+                    min_spacing_m=options['min_spacing'],
+                    chunk_size=options['chunk_size'],
+                )
+        except (OSError, ValueError, RouteImportError) as e:
+            raise CommandError(f'Import failed: {e}')
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {stats['imported']} points ({stats['skipped']} skipped by simplification) "
+            f"in {stats['seconds']:.2f}s - {stats['points_per_second']:.0f} points/sec"
+        ))
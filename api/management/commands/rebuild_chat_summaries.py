@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from api.models import ChatRoom
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the denormalized message count and last message of every chat room'
+
+    def handle(self, *args, **kwargs):
+        self.stdout.write('Rebuilding chat room summaries...')
+        updated = ChatRoom.rebuild_message_summaries()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt summaries for {updated} chat rooms'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from api.models import Destination
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the denormalized rating summary of every destination from its reviews'
+
+    def handle(self, *args, **kwargs):
+        self.stdout.write('Rebuilding rating summaries...')
+        updated = Destination.rebuild_rating_summaries()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt rating summaries for {updated} destinations'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from api.models import Destination
+from api.routes import update_route_metrics
+
+
+class Command(BaseCommand):
+    help = 'Recompute distance, elevation and grade metrics for every trek route'
+
+    def handle(self, *args, **kwargs):
+        destination_ids = list(Destination.objects.values_list('id', flat=True))
+        for destination_id in destination_ids:
+            update_route_metrics(destination_id)
+        self.stdout.write(self.style.SUCCESS(f'Updated route metrics for {len(destination_ids)} destinations'))
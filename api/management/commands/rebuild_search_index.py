@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from api.chat_search import create_chat_search_index, rebuild_chat_search_index
+from api.search import create_search_index, rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search indexes for destinations and chat messages'
+
+    def handle(self, *args, **kwargs):
+        if not create_search_index() or not create_chat_search_index():
+            self.stdout.write(self.style.WARNING('Full-text search (SQLite FTS5) is not available on this database'))
+            return
+        indexed = rebuild_search_index()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {indexed} destinations'))
+        indexed = rebuild_chat_search_index()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {indexed} chat messages'))
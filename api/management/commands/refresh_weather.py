@@ -0,0 +1,34 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from api.weather import destinations_due_for_refresh, refresh_weather_batch
+
+
+class Command(BaseCommand):
+    help = 'Refresh cached weather for destinations ahead of expiry (run once or as a loop)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=300,
+                            help='Refresh entries expiring within this many seconds')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Concurrent fetches (default WEATHER_REFRESH_WORKERS)')
+        parser.add_argument('--loop', action='store_true', help='Keep running as a scheduler')
+        parser.add_argument('--interval', type=int, default=60,
+                            help='Seconds between passes when looping')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Weather refresher started ({settings.WEATHER_CACHE_DURATION}s cache, "
+                          f"refreshing {options['ahead']}s ahead)")
+        while True:
+            started = time.monotonic()
+            destinations = list(destinations_due_for_refresh(options['ahead']))
+            if destinations:
+                refreshed, failed = refresh_weather_batch(destinations, options['workers'])
+                self.stdout.write(self.style.SUCCESS(
+                    f'Refreshed {refreshed} destinations ({failed} failed) '
+                    f'in {time.monotonic() - started:.2f}s'
+                ))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
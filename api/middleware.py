@@ -0,0 +1,30 @@
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from rest_framework.authtoken.models import Token
+
+
+@database_sync_to_async
+def _user_for_token(key):
+    token = Token.objects.select_related('user').filter(key=key).first()
+    return token.user if token else None
+
+
+class TokenAuthMiddleware:
+    """
+    Authenticate WebSocket connections with the REST API token passed as
+    ?token=<key>, for clients without a session cookie (e.g. the mobile app).
+    Without a valid token the session user (or AnonymousUser) is kept.
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    async def __call__(self, scope, receive, send):
+        query = parse_qs(scope.get('query_string', b'').decode())
+        key = query.get('token', [None])[0]
+        if key:
+            user = await _user_for_token(key)
+            if user is not None:
+                scope = dict(scope, user=user)
+        return await self.inner(scope, receive, send)
@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.utils import timezone
 import math
@@ -33,11 +33,71 @@ class Destination(models.Model):
     latitude = models.FloatField(default=28.0)
     longitude = models.FloatField(default=84.0)
     
+    # Denormalized rating summary, maintained incrementally from reviews
+    rating_count = models.IntegerField(default=0)
+    rating_sum = models.IntegerField(default=0)
+    rating_average = models.FloatField(default=0)
+    rating_histogram = models.JSONField(default=list, blank=True,
+                                        help_text="Review counts for 1-5 stars")
+    
     class Meta:
         ordering = ['-featured', 'name']
     
     def __str__(self):
         return self.name
+    
+    @classmethod
+    def apply_rating_change(cls, destination_id, removed=None, added=None):
+        """
+        Incrementally update the rating summary of a destination.
+        `removed` and `added` are the old and new star ratings of a review
+        (None when the review is being created or deleted).
+        """
+        with transaction.atomic():
+            destination = cls.objects.select_for_update().get(pk=destination_id)
+            histogram = destination.rating_histogram or [0] * 5
+            count, total = destination.rating_count, destination.rating_sum
+            if removed is not None:
+                histogram[removed - 1] -= 1
+                count -= 1
+                total -= removed
+            if added is not None:
+                histogram[added - 1] += 1
+                count += 1
+                total += added
+            cls.objects.filter(pk=destination_id).update(
+                rating_count=count,
+                rating_sum=total,
+                rating_average=total / count if count else 0,
+                rating_histogram=histogram,
+            )
+    
+    @classmethod
+    def rebuild_rating_summaries(cls):
+        """Recompute every rating summary from the reviews table"""
+        histograms = {}
+        rows = Review.objects.values('destination_id', 'rating').annotate(
+            total=models.Count('id'))
+        for row in rows:
+            histogram = histograms.setdefault(row['destination_id'], [0] * 5)
+            histogram[row['rating'] - 1] = row['total']
+        
+        with transaction.atomic():
+            destinations = list(cls.objects.select_for_update())
+            for destination in destinations:
+                histogram = histograms.get(destination.pk, [0] * 5)
+                destination.rating_histogram = histogram
+                destination.rating_count = sum(histogram)
+                destination.rating_sum = sum(
+                    stars * n for stars, n in enumerate(histogram, 1))
+                destination.rating_average = (
+                    destination.rating_sum / destination.rating_count
+                    if destination.rating_count else 0
+                )
+            cls.objects.bulk_update(destinations, [
+                'rating_count', 'rating_sum', 'rating_average', 'rating_histogram'
+            ])
+        return len(destinations)
 
 
 class TrekRoute(models.Model):
@@ -51,6 +111,7 @@ class TrekRoute(models.Model):
     altitude = models.IntegerField(help_text="Altitude at this point in meters")
     location_name = models.CharField(max_length=200, blank=True)
     description = models.TextField(blank=True)
+    distance_from_start_km = models.FloatField(default=0, help_text="Precomputed along-route distance")
     
     class Meta:
         ordering = ['destination', 'sequence_order']
@@ -83,6 +144,27 @@ class TrekRoute(models.Model):
         return distance
 
 
+class RouteMetrics(models.Model):
+    """
+    Precomputed route statistics for a destination (see api/routes.py)
+    """
+    destination = models.OneToOneField(Destination, on_delete=models.CASCADE, related_name='route_metrics')
+    total_distance_km = models.FloatField(default=0)
+    total_ascent_m = models.FloatField(default=0)
+    total_descent_m = models.FloatField(default=0)
+    max_grade_percent = models.FloatField(default=0)
+    min_altitude_m = models.IntegerField(default=0)
+    max_altitude_m = models.IntegerField(default=0)
+    point_count = models.IntegerField(default=0)
+    legs = models.JSONField(default=list, blank=True, help_text="Per-leg stats between named stops")
+    encoded_routes = models.JSONField(default=dict, blank=True,
+                                      help_text="Encoded polylines keyed by zoom level")
+    computed_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"{self.destination.name} - {self.total_distance_km:.1f} km"
+
+
 class WeatherCache(models.Model):
     """
     Caches weather data to reduce API calls
@@ -104,6 +186,10 @@ class WeatherCache(models.Model):
     
     class Meta:
         ordering = ['-cached_at']
+        constraints = [
+            # One current row per destination, written with an atomic upsert
+            models.UniqueConstraint(fields=['destination'], name='unique_weather_cache_per_destination'),
+        ]
     
     def __str__(self):
         return f"{self.destination.name} - {self.weather_condition}"
@@ -116,6 +202,35 @@ class WeatherCache(models.Model):
         return time_diff.total_seconds() < cache_duration
 
 
+class WeatherHistoryChunk(models.Model):
+    """
+    Append-only weather history for one destination, packed as a NumPy
+    record array: a UTC day of hourly readings, or a month of daily
+    aggregates once readings age out (see api/history.py)
+    """
+    RESOLUTION_CHOICES = [
+        ('HOURLY', 'Hourly'),
+        ('DAILY', 'Daily'),
+    ]
+    
+    destination = models.ForeignKey(Destination, on_delete=models.CASCADE, related_name='weather_history')
+    resolution = models.CharField(max_length=10, choices=RESOLUTION_CHOICES)
+    start = models.DateTimeField()
+    samples = models.PositiveIntegerField(default=0)
+    data = models.BinaryField(default=b'')
+    
+    class Meta:
+        ordering = ['destination', 'resolution', 'start']
+        constraints = [
+            # Also serves as the index for range queries
+            models.UniqueConstraint(fields=['destination', 'resolution', 'start'],
+                                    name='unique_weather_history_chunk'),
+        ]
+    
+    def __str__(self):
+        return f"{self.destination.name} - {self.resolution} from {self.start:%Y-%m-%d}"
+
+
 class ChatRoom(models.Model):
     """
     One chat room per destination for group discussions
@@ -124,11 +239,58 @@ class ChatRoom(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    # Denormalized summary, maintained as messages are stored
+    message_count = models.PositiveIntegerField(default=0)
+    last_message = models.ForeignKey('ChatMessage', on_delete=models.SET_NULL,
+                                     null=True, blank=True, related_name='+')
+    
     class Meta:
         ordering = ['destination__name']
     
     def __str__(self):
         return f"Chat: {self.destination.name}"
+    
+    @classmethod
+    def record_new_messages(cls, chat_room_id, count, last_message_id):
+        """
+        Count `count` newly stored messages in a single UPDATE. last_message
+        only moves forward, so concurrent writers cannot regress it.
+        """
+        cls.objects.filter(pk=chat_room_id).update(
+            message_count=models.F('message_count') + count,
+            last_message_id=models.Case(
+                models.When(models.Q(last_message__isnull=True) |
+                            models.Q(last_message_id__lt=last_message_id),
+                            then=models.Value(last_message_id)),
+                default=models.F('last_message_id'),
+                output_field=models.BigIntegerField(),
+            ),
+        )
+    
+    @classmethod
+    def refresh_message_summary(cls, chat_room_id):
+        """Recount one room from its messages (after deletions)"""
+        summary = ChatMessage.objects.filter(chat_room_id=chat_room_id).aggregate(
+            count=models.Count('id'), last=models.Max('id'))
+        cls.objects.filter(pk=chat_room_id).update(
+            message_count=summary['count'], last_message_id=summary['last'])
+    
+    @classmethod
+    def rebuild_message_summaries(cls):
+        """Recompute every room's counter and last message from the messages table"""
+        summaries = {
+            row['chat_room_id']: row
+            for row in ChatMessage.objects.values('chat_room_id').annotate(
+                count=models.Count('id'), last=models.Max('id'))
+        }
+        with transaction.atomic():
+            rooms = list(cls.objects.select_for_update())
+            for room in rooms:
+                summary = summaries.get(room.pk, {'count': 0, 'last': None})
+                room.message_count = summary['count']
+                room.last_message_id = summary['last']
+            cls.objects.bulk_update(rooms, ['message_count', 'last_message'])
+        return len(rooms)
 
 
 class ChatMessage(models.Model):
@@ -138,11 +300,17 @@ class ChatMessage(models.Model):
     chat_room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='messages')
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='chat_messages')
     message = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set when the message is received; WebSocket messages are written later in batches
+    timestamp = models.DateTimeField(default=timezone.now)
     edited = models.BooleanField(default=False)
     
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            # Keyset pagination over (timestamp, id) and delta sync by id
+            models.Index(fields=['chat_room', 'timestamp', 'id'], name='chat_message_room_time_idx'),
+            models.Index(fields=['chat_room', 'id'], name='chat_message_room_id_idx'),
+        ]
     
     def __str__(self):
         return f"{self.user.username} - {self.chat_room.destination.name} - {self.timestamp}"
@@ -0,0 +1,265 @@
+"""
+Presence and typing indicators for chat rooms.
+
+Each server process keeps a PresenceTracker with one RoomPresence per
+room: its local sockets, a connection count per signed-in username, and
+who is typing. Rooms are keyed by channel group name. Processes share
+state over the channel layer. Each publishes the rosters of rooms that
+changed, at most once per FLUSH_INTERVAL, plus a full snapshot every
+HEARTBEAT_INTERVAL that also proves it is alive. Snapshots not renewed
+within three heartbeats are dropped, so a crashed worker's users go
+offline. Every process merges the rosters into a global view and sends
+its own sockets one coalesced diff per room and tick, encoded once per
+wire format (api/protocol.py):
+
+    {"type": "presence", "joined": [...], "left": [...], "typing": [...]}
+
+New connections first get {"type": "presence", "users": [...], "typing": [...]}.
+Clients apply diffs as set operations. Clients that send
+{"type": "heartbeat"} opt into idle detection: once they go silent for
+CONNECTION_TIMEOUT seconds they are closed and drop off the roster. Other
+sockets, such as read-only listeners, are left to the server's WebSocket
+ping/pong.
+"""
+import asyncio
+import logging
+import time
+import uuid
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .protocol import encode_frames
+
+logger = logging.getLogger(__name__)
+
+WORKERS_GROUP = 'presence_workers'
+
+
+class RoomPresence:
+    __slots__ = ('consumers', 'users', 'typing', 'remote', 'announced')
+
+    def __init__(self):
+        self.consumers = set()  # local sockets
+        self.users = {}  # username -> local connection count
+        self.typing = {}  # username -> monotonic expiry
+        self.remote = {}  # worker id -> (users, typing, monotonic expiry)
+        self.announced = (frozenset(), frozenset())
+
+    def online(self):
+        users = set(self.users)
+        for remote_users, _, _ in self.remote.values():
+            users |= remote_users
+        return users
+
+    def typing_now(self):
+        typing = set(self.typing)
+        for _, remote_typing, _ in self.remote.values():
+            typing |= remote_typing
+        return typing
+
+    def is_empty(self):
+        return not (self.consumers or self.users or self.remote)
+
+
+class PresenceTracker:
+    def __init__(self, flush_interval=1.0, heartbeat_interval=15, connection_timeout=60,
+                 typing_timeout=5):
+        self.flush_interval = flush_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.connection_timeout = connection_timeout
+        self.typing_timeout = typing_timeout
+        self.worker_id = uuid.uuid4().hex[:12]
+        self._reset()
+
+    def _reset(self):
+        self.rooms = {}
+        self._dirty = set()  # local state changed: publish to other workers
+        self._changed = set()  # global view may have changed: announce to local sockets
+        self._loop = None
+        self._tasks = ()
+
+    def _start(self):
+        # Bound to the server's event loop; a new loop (e.g. in tests) starts afresh
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self._reset()
+        self._loop = loop
+        self._tasks = (loop.create_task(self._run()),)
+
+    def _room(self, group):
+        room = self.rooms.get(group)
+        if room is None:
+            room = self.rooms[group] = RoomPresence()
+        return room
+
+    def _mark(self, group):
+        self._dirty.add(group)
+        self._changed.add(group)
+
+    async def join(self, group, consumer, username=None):
+        """Register a socket and send it the room's current presence"""
+        self._start()
+        room = self._room(group)
+        room.consumers.add(consumer)
+        consumer.last_seen = time.monotonic()
+        if username:
+            room.users[username] = room.users.get(username, 0) + 1
+            if room.users[username] == 1:
+                self._mark(group)
+        await consumer.send_frame({
+            'type': 'presence',
+            'users': sorted(room.online()),
+            'typing': sorted(room.typing_now()),
+        })
+
+    def leave(self, group, consumer, username=None):
+        room = self.rooms.get(group)
+        if room is None:
+            return
+        room.consumers.discard(consumer)
+        if username and username in room.users:
+            room.users[username] -= 1
+            if not room.users[username]:
+                del room.users[username]
+                room.typing.pop(username, None)
+                self._mark(group)
+
+    def touch(self, consumer):
+        consumer.last_seen = time.monotonic()
+
+    def heartbeat(self, consumer):
+        """A keep-alive: from now on this socket is closed when it goes silent"""
+        consumer.sends_heartbeats = True
+        self.touch(consumer)
+
+    def set_typing(self, group, username, typing=True):
+        room = self.rooms.get(group)
+        if room is None or not username:
+            return
+        if typing:
+            if username not in room.typing:
+                self._mark(group)
+            room.typing[username] = time.monotonic() + self.typing_timeout
+        elif room.typing.pop(username, None) is not None:
+            self._mark(group)
+
+    async def _run(self):
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        receiver = asyncio.ensure_future(self._receive(layer, channel))
+        last_full = 0
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                try:
+                    now = time.monotonic()
+                    full = now - last_full >= self.heartbeat_interval
+                    if full:
+                        last_full = now
+                        # Renewing membership keeps it from expiring in the layer
+                        await layer.group_add(WORKERS_GROUP, channel)
+                        await self._close_idle(now)
+                    self._expire(now)
+                    await self._publish(layer, full)
+                    await self._announce()
+                except Exception:
+                    logger.exception('Presence tick failed')
+        finally:
+            receiver.cancel()
+
+    async def _receive(self, layer, channel):
+        while True:
+            message = await layer.receive(channel)
+            if message.get('worker') == self.worker_id:
+                continue
+            worker = message['worker']
+            expires = time.monotonic() + 3 * self.heartbeat_interval
+            rooms = message['rooms']
+            for group, (users, typing) in rooms.items():
+                room = self._room(group)
+                if users or typing:
+                    room.remote[worker] = (frozenset(users), frozenset(typing), expires)
+                else:
+                    room.remote.pop(worker, None)
+                self._changed.add(group)
+            if message['full']:
+                for group, room in self.rooms.items():
+                    if group not in rooms and room.remote.pop(worker, None) is not None:
+                        self._changed.add(group)
+
+    async def _close_idle(self, now):
+        cutoff = now - self.connection_timeout
+        for room in list(self.rooms.values()):
+            idle = [consumer for consumer in room.consumers
+                    if getattr(consumer, 'sends_heartbeats', False) and consumer.last_seen < cutoff]
+            for consumer in idle:
+                room.consumers.discard(consumer)
+                await consumer.close()
+
+    def _expire(self, now):
+        for group, room in self.rooms.items():
+            expired = [username for username, until in room.typing.items() if until < now]
+            for username in expired:
+                del room.typing[username]
+            if expired:
+                self._mark(group)
+            gone = [worker for worker, (_, _, until) in room.remote.items() if until < now]
+            for worker in gone:
+                del room.remote[worker]
+            if gone:
+                self._changed.add(group)
+
+    async def _publish(self, layer, full):
+        groups = self.rooms.keys() if full else self._dirty
+        rooms = {
+            group: [sorted(self.rooms[group].users), sorted(self.rooms[group].typing)]
+            for group in groups if group in self.rooms
+        }
+        self._dirty = set()
+        if rooms or full:
+            await layer.group_send(WORKERS_GROUP, {
+                'type': 'presence.state',
+                'worker': self.worker_id,
+                'full': full,
+                'rooms': rooms,
+            })
+
+    async def _announce(self):
+        changed, self._changed = self._changed, set()
+        for group in changed:
+            room = self.rooms.get(group)
+            if room is None:
+                continue
+            users, typing = frozenset(room.online()), frozenset(room.typing_now())
+            announced_users, announced_typing = room.announced
+            room.announced = (users, typing)
+            if room.consumers and (users != announced_users or typing != announced_typing):
+                frames = encode_frames({
+                    'type': 'presence',
+                    'joined': sorted(users - announced_users),
+                    'left': sorted(announced_users - users),
+                    'typing': sorted(typing),
+                })
+                for consumer in list(room.consumers):
+                    await consumer.send_encoded(frames)
+            if room.is_empty() and group not in self._dirty:
+                del self.rooms[group]
+
+
+_tracker = None
+
+
+def get_presence_tracker():
+    """The per-process tracker configured by CHAT_PRESENCE"""
+    global _tracker
+    if _tracker is None:
+        config = getattr(settings, 'CHAT_PRESENCE', {})
+        _tracker = PresenceTracker(
+            flush_interval=config.get('FLUSH_INTERVAL', 1.0),
+            heartbeat_interval=config.get('HEARTBEAT_INTERVAL', 15),
+            connection_timeout=config.get('CONNECTION_TIMEOUT', 60),
+            typing_timeout=config.get('TYPING_TIMEOUT', 5),
+        )
+    return _tracker
@@ -0,0 +1,9 @@
+from rest_framework.renderers import JSONRenderer
+
+
+class PolylineRenderer(JSONRenderer):
+    """
+    JSON renderer selected with ?format=polyline; views check
+    request.accepted_renderer.format to return the compact route encoding.
+    """
+    format = 'polyline'
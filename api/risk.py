@@ -0,0 +1,133 @@
+"""
+Weather risk rules, evaluated in bulk.
+
+The rules that turn a reading into warnings and a LOW/MEDIUM/HIGH level
+are declared once in RULES and evaluated over NumPy arrays, so the same
+code scores a single reading (store_weather), every destination, or every
+route point of every destination in one pass (build_risk_map).
+"""
+import numpy as np
+
+from .models import Destination, TrekRoute, WeatherCache
+
+RISK_LEVELS = ('LOW', 'MEDIUM', 'HIGH')
+ALTITUDE_WARNING_M = 4000
+
+# Standard atmosphere lapse rate, used to estimate the temperature at a
+# route point from the reading taken at the destination's altitude
+LAPSE_RATE_C_PER_M = 0.0065
+
+# (level, predicate over the warning flags), highest level wins
+RULES = (
+    ('HIGH', lambda f: f['snow'] | (f['altitude'] & (f['temperature'] < 0))),
+    ('MEDIUM', lambda f: f['rain'] | f['altitude']),
+)
+
+
+def _contains(conditions, *words):
+    found = np.zeros(len(conditions), dtype=bool)
+    for word in words:
+        found |= np.char.find(conditions, word) >= 0
+    return found
+
+
+def assess(conditions, temperatures, altitudes):
+    """
+    Score readings given as parallel sequences. Missing weather is an empty
+    condition and a NaN temperature. Returns boolean arrays `rain`, `snow`,
+    `altitude` and an int array `level` indexing RISK_LEVELS.
+    """
+    conditions = np.char.lower(np.asarray(conditions, dtype=str))
+    flags = {
+        'rain': _contains(conditions, 'rain', 'drizzle'),
+        'snow': _contains(conditions, 'snow'),
+        'altitude': np.asarray(altitudes, dtype=float) > ALTITUDE_WARNING_M,
+        'temperature': np.asarray(temperatures, dtype=float),
+    }
+    level = np.zeros(len(conditions), dtype=np.int8)
+    for name, predicate in RULES:
+        level = np.maximum(level, np.where(predicate(flags), RISK_LEVELS.index(name), 0))
+    flags['level'] = level
+    return flags
+
+
+def assess_reading(condition, temperature, altitude):
+    """WeatherCache warning fields for one reading"""
+    flags = assess([condition], [temperature], [altitude])
+    return {
+        'has_rain_warning': bool(flags['rain'][0]),
+        'has_snow_warning': bool(flags['snow'][0]),
+        'has_altitude_warning': bool(flags['altitude'][0]),
+        'risk_level': RISK_LEVELS[flags['level'][0]],
+    }
+
+
+def _runs(values):
+    """Start indices of runs of equal consecutive values"""
+    if not len(values):
+        return np.empty(0, dtype=int)
+    return np.flatnonzero(np.concatenate(([True], values[1:] != values[:-1])))
+
+
+def build_risk_map():
+    """
+    Current risk for every destination and along every route.
+    Route points are scored at their own altitude, with the destination's
+    reading adjusted by the lapse rate, and returned as runs of
+    [first_sequence, last_sequence, level].
+    """
+    destinations = list(Destination.objects.order_by('id').values_list(
+        'id', 'name', 'latitude', 'longitude', 'altitude'))
+    readings = {
+        destination_id: (condition, temperature)
+        for destination_id, condition, temperature in WeatherCache.objects.values_list(
+            'destination_id', 'weather_condition', 'temperature')
+    }
+    ids = np.array([row[0] for row in destinations], dtype=np.int64)
+    altitudes = np.array([row[4] for row in destinations], dtype=float)
+    conditions = np.array([readings.get(row[0], ('', None))[0] for row in destinations], dtype=str)
+    temperatures = np.array([readings.get(row[0], ('', np.nan))[1] for row in destinations], dtype=float)
+    scored = assess(conditions, temperatures, altitudes)
+
+    points = TrekRoute.objects.order_by('destination_id', 'sequence_order').values_list(
+        'destination_id', 'sequence_order', 'altitude')
+    point_destinations, sequences, point_altitudes = (
+        np.array(column) for column in zip(*points)) if points else (np.empty(0, dtype=int),) * 3
+    owner = np.searchsorted(ids, point_destinations)
+    point_scored = assess(
+        conditions[owner],
+        temperatures[owner] + (altitudes[owner] - point_altitudes) * LAPSE_RATE_C_PER_M,
+        point_altitudes,
+    )
+
+    # Runs break where the level or the destination changes
+    point_levels = point_scored['level']
+    starts = _runs(point_levels.astype(np.int64) * (len(ids) + 1) + owner)
+    ends = np.append(starts[1:], len(point_levels)) - 1
+    routes = {}
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        routes.setdefault(int(owner[start]), []).append(
+            [int(sequences[start]), int(sequences[end]), RISK_LEVELS[point_levels[start]]])
+
+    results = []
+    for position, (destination_id, name, latitude, longitude, altitude) in enumerate(destinations):
+        route = routes.get(position, [])
+        results.append({
+            'id': destination_id,
+            'name': name,
+            'latitude': latitude,
+            'longitude': longitude,
+            'altitude': altitude,
+            'has_weather': destination_id in readings,
+            'risk_level': RISK_LEVELS[scored['level'][position]],
+            'has_rain_warning': bool(scored['rain'][position]),
+            'has_snow_warning': bool(scored['snow'][position]),
+            'has_altitude_warning': bool(scored['altitude'][position]),
+            'route_risk_level': max((run[2] for run in route), key=RISK_LEVELS.index, default=None),
+            'route_risk': route,
+        })
+    counts = np.bincount(scored['level'], minlength=len(RISK_LEVELS)).tolist()
+    return {
+        'summary': dict(zip(RISK_LEVELS, counts)),
+        'destinations': results,
+    }
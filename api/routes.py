@@ -0,0 +1,316 @@
+"""
+Vectorized route analytics and compact route encodings.
+
+Route points are loaded once into NumPy arrays and every statistic is
+computed in a single batched pass. Results, including encoded polylines
+simplified for several map zoom levels, are stored on RouteMetrics and
+TrekRoute.distance_from_start_km, so the API never recomputes them per request.
+"""
+import numpy as np
+from django.db import transaction
+
+from .cache import touch_destination
+from .models import RouteMetrics, TrekRoute
+
+EARTH_RADIUS_KM = 6371
+
+# Segments shorter than this are ignored for max grade, since GPS altitude
+# noise over a few metres produces meaningless gradients
+MIN_GRADE_DISTANCE_M = 10
+
+# Map zoom levels that get a precomputed simplified polyline; deeper zooms
+# are served the full-resolution route
+SIMPLIFICATION_ZOOM_LEVELS = (6, 8, 10, 12, 14)
+POLYLINE_PRECISION = 5
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Vectorized haversine distance in kilometres (same formula as TrekRoute)"""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def compute_route_metrics(latitudes, longitudes, altitudes, stops=()):
+    """
+    Compute metrics for an ordered route.
+    `stops` are indices of named points; legs run between consecutive stops
+    (the first and last points always count as stops).
+    Returns a dict with the cumulative distance array and summary stats.
+    """
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    altitudes = np.asarray(altitudes, dtype=float)
+    count = len(latitudes)
+
+    if count < 2:
+        return {
+            'cumulative_km': np.zeros(count),
+            'total_distance_km': 0.0,
+            'total_ascent_m': 0.0,
+            'total_descent_m': 0.0,
+            'max_grade_percent': 0.0,
+            'min_altitude_m': int(altitudes.min()) if count else 0,
+            'max_altitude_m': int(altitudes.max()) if count else 0,
+            'legs': [],
+        }
+
+    segment_km = haversine_km(latitudes[:-1], longitudes[:-1], latitudes[1:], longitudes[1:])
+    climb = np.diff(altitudes)
+    ascent = np.clip(climb, 0, None)
+    descent = np.clip(-climb, 0, None)
+    segment_m = segment_km * 1000
+    grade = np.divide(climb * 100, segment_m, out=np.zeros_like(climb),
+                      where=segment_m >= MIN_GRADE_DISTANCE_M)
+
+    # Prefix sums let every leg be read off with two lookups
+    cumulative_km = np.concatenate(([0.0], np.cumsum(segment_km)))
+    cumulative_ascent = np.concatenate(([0.0], np.cumsum(ascent)))
+    cumulative_descent = np.concatenate(([0.0], np.cumsum(descent)))
+
+    boundaries = np.unique(np.concatenate(([0, count - 1], np.asarray(stops, dtype=int))))
+    starts, ends = boundaries[:-1], boundaries[1:]
+    leg_max_grade = np.maximum.reduceat(np.abs(grade), starts)
+
+    legs = []
+    for start, end, max_grade in zip(starts.tolist(), ends.tolist(), leg_max_grade.tolist()):
+        distance = cumulative_km[end] - cumulative_km[start]
+        legs.append({
+            'start': start,
+            'end': end,
+            'distance_km': round(float(distance), 3),
+            'ascent_m': round(float(cumulative_ascent[end] - cumulative_ascent[start]), 1),
+            'descent_m': round(float(cumulative_descent[end] - cumulative_descent[start]), 1),
+            'avg_grade_percent': round(float(
+                (altitudes[end] - altitudes[start]) / (distance * 10)) if distance else 0.0, 2),
+            'max_grade_percent': round(float(max_grade), 2),
+        })
+
+    return {
+        'cumulative_km': cumulative_km,
+        'total_distance_km': float(cumulative_km[-1]),
+        'total_ascent_m': float(cumulative_ascent[-1]),
+        'total_descent_m': float(cumulative_descent[-1]),
+        'max_grade_percent': float(np.abs(grade).max()),
+        'min_altitude_m': int(altitudes.min()),
+        'max_altitude_m': int(altitudes.max()),
+        'legs': legs,
+    }
+
+
+def simplify_route(latitudes, longitudes, tolerance, keep=()):
+    """
+    Douglas-Peucker simplification. `tolerance` is in degrees of latitude;
+    longitudes are scaled by cos(latitude) so the tolerance is isotropic.
+    Indices in `keep` (e.g. named stops) are always retained.
+    Returns the sorted indices of the retained points.
+    """
+    y = np.asarray(latitudes, dtype=float)
+    count = len(y)
+    if count < 3:
+        return np.arange(count)
+    x = np.asarray(longitudes, dtype=float) * np.cos(np.radians(y.mean()))
+
+    retained = np.zeros(count, dtype=bool)
+    retained[[0, count - 1]] = True
+    retained[np.asarray(keep, dtype=int)] = True
+    anchors = np.flatnonzero(retained)
+    stack = list(zip(anchors[:-1].tolist(), anchors[1:].tolist()))
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        dx, dy = x[end] - x[start], y[end] - y[start]
+        px, py = x[start + 1:end] - x[start], y[start + 1:end] - y[start]
+        length = np.hypot(dx, dy)
+        if length == 0:
+            distances = np.hypot(px, py)
+        else:
+            distances = np.abs(px * dy - py * dx) / length
+        farthest = int(distances.argmax())
+        if distances[farthest] > tolerance:
+            split = start + 1 + farthest
+            retained[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+    return np.flatnonzero(retained)
+
+
+def zoom_tolerance(zoom):
+    """Width of one 256px web-map tile pixel at `zoom`, in degrees of longitude"""
+    return 360 / (256 * 2 ** zoom)
+
+
+def encode_values(deltas):
+    """Encode signed integers with the Google polyline varint scheme"""
+    chunks = []
+    for value in deltas.tolist():
+        value = ~(value << 1) if value < 0 else value << 1
+        while value >= 0x20:
+            chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chunks.append(chr(value + 63))
+    return ''.join(chunks)
+
+
+def encode_polyline(latitudes, longitudes, precision=POLYLINE_PRECISION):
+    """Google encoded polyline for a sequence of coordinates"""
+    factor = 10 ** precision
+    lat = np.round(np.asarray(latitudes, dtype=float) * factor).astype(np.int64)
+    lon = np.round(np.asarray(longitudes, dtype=float) * factor).astype(np.int64)
+    deltas = np.empty(2 * len(lat), dtype=np.int64)
+    deltas[0::2] = np.diff(lat, prepend=0)
+    deltas[1::2] = np.diff(lon, prepend=0)
+    return encode_values(deltas)
+
+
+def encode_route(latitudes, longitudes, altitudes, stops, indices, zoom=None):
+    """
+    Compact payload for the points at `indices`: an encoded polyline,
+    delta-encoded altitudes (metres, same varint scheme) and the
+    positions of named stops within the simplified sequence.
+    """
+    altitudes = np.round(np.asarray(altitudes, dtype=float)[indices]).astype(np.int64)
+    positions = {index: position for position, index in enumerate(indices.tolist())}
+    return {
+        'zoom': zoom,
+        'point_count': len(indices),
+        'precision': POLYLINE_PRECISION,
+        'polyline': encode_polyline(np.asarray(latitudes)[indices], np.asarray(longitudes)[indices]),
+        'altitudes': encode_values(np.diff(altitudes, prepend=0)),
+        'stops': [[positions[index], name] for index, name in stops if index in positions],
+    }
+
+
+def build_encoded_routes(latitudes, longitudes, altitudes, stops=()):
+    """Encoded route at every simplification zoom level plus full resolution"""
+    stop_indices = [index for index, _ in stops]
+    full = np.arange(len(latitudes))
+    routes = {'full': encode_route(latitudes, longitudes, altitudes, stops, full)}
+    # Web-mercator pixels shrink on the ground by cos(latitude)
+    scale = np.cos(np.radians(np.mean(latitudes))) if len(latitudes) else 1
+    for zoom in SIMPLIFICATION_ZOOM_LEVELS:
+        indices = simplify_route(latitudes, longitudes, zoom_tolerance(zoom) * scale,
+                                 keep=stop_indices)
+        routes[str(zoom)] = encode_route(latitudes, longitudes, altitudes, stops, indices, zoom)
+    return routes
+
+
+def encoded_route_for_zoom(encoded_routes, zoom=None):
+    """Pick the deepest precomputed level not finer than `zoom`"""
+    if zoom is None or zoom > SIMPLIFICATION_ZOOM_LEVELS[-1]:
+        return encoded_routes.get('full')
+    levels = [level for level in SIMPLIFICATION_ZOOM_LEVELS if level <= zoom]
+    level = levels[-1] if levels else SIMPLIFICATION_ZOOM_LEVELS[0]
+    return encoded_routes.get(str(level))
+
+
+def downsample_lttb(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling of the series (x, y) to
+    `threshold` points; keeps the first and last points and the visually
+    significant peaks and dips in between. Returns the retained indices.
+    Thresholds below 3 leave just the first and last points.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    count = len(x)
+    if threshold >= count:
+        return np.arange(count)
+    if threshold < 3:
+        return np.array([0, count - 1])
+
+    # Bucket boundaries for the points between the fixed first and last
+    edges = np.linspace(1, count - 1, threshold - 1).astype(int)
+    indices = np.empty(threshold, dtype=int)
+    indices[0], indices[-1] = 0, count - 1
+    selected = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_start, next_end = end, edges[bucket + 2] if bucket + 2 < len(edges) else count
+        # Average of the next bucket (the last bucket's neighbour is the end point)
+        average_x = x[next_start:next_end].mean()
+        average_y = y[next_start:next_end].mean()
+        areas = np.abs(
+            (x[selected] - average_x) * (y[start:end] - y[selected]) -
+            (x[selected] - x[start:end]) * (average_y - y[selected])
+        )
+        selected = start + int(areas.argmax())
+        indices[bucket + 1] = selected
+    return indices
+
+
+def store_point_distances(ids, stored, cumulative_km):
+    """Write cumulative distances to the route points whose stored value differs"""
+    changed = [
+        TrekRoute(id=point_id, distance_from_start_km=distance)
+        for point_id, old, distance in zip(ids, stored, np.round(cumulative_km, 4).tolist())
+        if old != distance
+    ]
+    TrekRoute.objects.bulk_update(changed, ['distance_from_start_km'], batch_size=1000)
+
+
+def save_route_metrics(destination_id, sequence, latitudes, longitudes, altitudes, stops,
+                       metrics=None):
+    """
+    Store RouteMetrics for a route given as columns in sequence order.
+    `stops` are (index, name) pairs of named points; `metrics` may be passed
+    when compute_route_metrics() has already run.
+    """
+    if metrics is None:
+        metrics = compute_route_metrics(latitudes, longitudes, altitudes,
+                                        stops=[i for i, _ in stops])
+
+    # Report legs by sequence order rather than array position
+    for leg in metrics['legs']:
+        leg['start'] = sequence[leg['start']]
+        leg['end'] = sequence[leg['end']]
+
+    route_metrics, _ = RouteMetrics.objects.update_or_create(
+        destination_id=destination_id,
+        defaults={
+            'total_distance_km': round(metrics['total_distance_km'], 3),
+            'total_ascent_m': round(metrics['total_ascent_m'], 1),
+            'total_descent_m': round(metrics['total_descent_m'], 1),
+            'max_grade_percent': round(metrics['max_grade_percent'], 2),
+            'min_altitude_m': metrics['min_altitude_m'],
+            'max_altitude_m': metrics['max_altitude_m'],
+            'point_count': len(latitudes),
+            'legs': metrics['legs'],
+            'encoded_routes': build_encoded_routes(latitudes, longitudes, altitudes, stops),
+        },
+    )
+    return route_metrics
+
+
+@transaction.atomic
+def update_route_metrics(destination_id):
+    """Recompute and store metrics for one destination's route"""
+    # Plain tuples keep memory low for long imported tracks
+    rows = list(TrekRoute.objects.filter(destination_id=destination_id)
+                .order_by('sequence_order')
+                .values_list('id', 'sequence_order', 'latitude', 'longitude',
+                             'altitude', 'location_name', 'distance_from_start_km'))
+    ids, sequence, latitudes, longitudes, altitudes, names, stored = (
+        list(column) for column in zip(*rows)) if rows else ([],) * 7
+    stops = [(i, name) for i, name in enumerate(names) if name]
+    metrics = compute_route_metrics(latitudes, longitudes, altitudes,
+                                    stops=[i for i, _ in stops])
+    store_point_distances(ids, stored, metrics['cumulative_km'])
+    return save_route_metrics(destination_id, sequence, latitudes, longitudes, altitudes,
+                              stops, metrics)
+
+
+def ensure_route_metrics(destination_id):
+    """
+    Stored metrics for a route, computing them first if they are missing
+    (e.g. routes loaded before metrics existed). Computing them also fills
+    in the points' distance_from_start_km, so the destination's version is
+    bumped and responses cached without them are not served again.
+    """
+    metrics = RouteMetrics.objects.filter(destination_id=destination_id).first()
+    if metrics is None or not metrics.encoded_routes:
+        metrics = update_route_metrics(destination_id)
+        touch_destination(destination_id)
+    return metrics
@@ -0,0 +1,147 @@
+"""
+Full-text search over destinations backed by an SQLite FTS5 table.
+
+The index lives in `api_destination_fts` (rowid = destination id), which
+is created after migrate and kept in sync by the signals in api/signals.py.
+Queries are ranked with bm25 and every term is matched as a prefix for
+type-ahead. On databases without FTS5 the DRF icontains search is used
+instead.
+
+Snippets are highlighted by FTS5 with control characters, then HTML-escaped
+so that only the highlights become markup.
+"""
+import re
+
+from django.db import OperationalError, connection
+from django.utils.html import escape
+from rest_framework import filters
+
+from .models import Destination
+
+FTS_TABLE = 'api_destination_fts'
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+# FTS5 snippet() arguments marking the start and end of each matched term
+SNIPPET_MARKERS = "char(2), char(3)"
+
+_available = None
+
+
+def _table_exists():
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+        return cursor.fetchone() is not None
+
+
+def search_available():
+    """Whether the FTS5 table exists; checked once per process"""
+    global _available
+    if _available is None:
+        _available = connection.vendor == 'sqlite' and _table_exists()
+    return _available
+
+
+def create_search_index():
+    """
+    Create and fill the FTS5 table if it does not exist yet. Runs after
+    migrate (see api/signals.py), so the table is there before anything is
+    written. Returns False if the backend lacks FTS5.
+    """
+    global _available
+    if connection.vendor != 'sqlite':
+        _available = False
+        return _available
+    if not _table_exists():
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+                    "name, location, description, "
+                    "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')")
+        except OperationalError:
+            _available = False
+            return _available
+        _available = True
+        rebuild_search_index()
+    _available = True
+    return _available
+
+
+def build_match_query(text):
+    """Turn free text into an FTS5 query that prefix-matches every term"""
+    tokens = _TOKEN_RE.findall(text.lower())
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+
+def highlight_snippet(snippet):
+    """HTML-safe snippet with matched terms, and nothing else, wrapped in <mark> tags"""
+    if not snippet:
+        return ''
+    return str(escape(snippet)).replace('\x02', '<mark>').replace('\x03', '</mark>')
+
+
+def index_destination(destination):
+    if not search_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [destination.pk])
+        cursor.execute(
+            f"INSERT INTO {FTS_TABLE} (rowid, name, location, description) "
+            "VALUES (%s, %s, %s, %s)",
+            [destination.pk, destination.name, destination.location, destination.description])
+
+
+def unindex_destination(destination_id):
+    if not search_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [destination_id])
+
+
+def rebuild_search_index():
+    """Re-index every destination; returns the number indexed"""
+    if not search_available():
+        return 0
+    rows = Destination.objects.values_list('id', 'name', 'location', 'description')
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE}")
+        cursor.executemany(
+            f"INSERT INTO {FTS_TABLE} (rowid, name, location, description) "
+            "VALUES (%s, %s, %s, %s)",
+            list(rows))
+        cursor.execute(f"SELECT count(*) FROM {FTS_TABLE}")
+        return cursor.fetchone()[0]
+
+
+def search_destinations(queryset, text, snippets=False):
+    """
+    Restrict `queryset` to destinations matching `text`, ordered by relevance.
+    With `snippets`, each result gets a raw `search_snippet` from its best
+    matching field, to be passed through highlight_snippet().
+    """
+    match = build_match_query(text)
+    if not match:
+        return queryset.none()
+    select = {'search_rank': f'{FTS_TABLE}.rank'}
+    if snippets:
+        select['search_snippet'] = (
+            f"snippet({FTS_TABLE}, -1, {SNIPPET_MARKERS}, '...', 16)")
+    # A join lets SQLite drive the query from the FTS index and look up
+    # destinations by primary key, so cost tracks the number of matches
+    return queryset.extra(
+        tables=[FTS_TABLE],
+        where=[f'{FTS_TABLE}.rowid = api_destination.id', f'{FTS_TABLE} MATCH %s'],
+        params=[match],
+        select=select,
+        order_by=['search_rank'],
+    )
+
+
+class DestinationSearchFilter(filters.SearchFilter):
+    """SearchFilter that uses the ranked FTS5 index when it is available"""
+
+    def filter_queryset(self, request, queryset, view):
+        text = request.query_params.get(self.search_param, '')
+        if not text.strip() or not search_available():
+            return super().filter_queryset(request, queryset, view)
+        return search_destinations(queryset, text)
@@ -1,7 +1,7 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
 from .models import (
-    Destination, TrekRoute, WeatherCache, 
+    Destination, TrekRoute, RouteMetrics, WeatherCache, 
     ChatRoom, ChatMessage, Booking, Review
 )
 
@@ -43,7 +43,15 @@ class TrekRouteSerializer(serializers.ModelSerializer):
     class Meta:
         model = TrekRoute
         fields = ['id', 'sequence_order', 'latitude', 'longitude', 
-                 'altitude', 'location_name', 'description']
+                 'altitude', 'location_name', 'description', 'distance_from_start_km']
+
+
+class RouteMetricsSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = RouteMetrics
+        fields = ['total_distance_km', 'total_ascent_m', 'total_descent_m',
+                 'max_grade_percent', 'min_altitude_m', 'max_altitude_m',
+                 'point_count', 'legs', 'computed_at']
 
 
 class WeatherCacheSerializer(serializers.ModelSerializer):
@@ -59,38 +67,48 @@ class ReviewSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Review
-        fields = ['id', 'user', 'rating', 'comment', 'created_at', 'updated_at']
+        fields = ['id', 'user', 'destination', 'rating', 'comment', 'created_at', 'updated_at']
         read_only_fields = ['id', 'created_at', 'updated_at']
+    
+    def validate(self, data):
+        # user is read-only, so DRF skips the unique_together validator
+        request = self.context.get('request')
+        user = self.instance.user if self.instance else getattr(request, 'user', None)
+        destination = data.get('destination', getattr(self.instance, 'destination', None))
+        if user is not None and user.is_authenticated and destination is not None:
+            reviews = Review.objects.filter(user=user, destination=destination)
+            if self.instance:
+                reviews = reviews.exclude(pk=self.instance.pk)
+            if reviews.exists():
+                raise serializers.ValidationError(
+                    {'destination': 'You have already reviewed this destination'})
+        return data
 
 
 class DestinationListSerializer(serializers.ModelSerializer):
     """Lightweight serializer for list view"""
+    average_rating = serializers.FloatField(source='rating_average', read_only=True)
+    total_reviews = serializers.IntegerField(source='rating_count', read_only=True)
+    
     class Meta:
         model = Destination
         fields = ['id', 'name', 'location', 'altitude', 'duration_days',
-                 'difficulty', 'price', 'image', 'featured', 'latitude', 'longitude']
+                 'difficulty', 'price', 'image', 'featured', 'latitude', 'longitude',
+                 'average_rating', 'total_reviews']
 
 
 class DestinationDetailSerializer(serializers.ModelSerializer):
     """Detailed serializer with all related data"""
     route_points = TrekRouteSerializer(many=True, read_only=True)
+    route_metrics = RouteMetricsSerializer(read_only=True)
     weather_data = WeatherCacheSerializer(many=True, read_only=True)
     reviews = ReviewSerializer(many=True, read_only=True)
-    average_rating = serializers.SerializerMethodField()
-    total_reviews = serializers.SerializerMethodField()
+    average_rating = serializers.FloatField(source='rating_average', read_only=True)
+    total_reviews = serializers.IntegerField(source='rating_count', read_only=True)
     
     class Meta:
         model = Destination
         fields = '__all__'
-    
-    def get_average_rating(self, obj):
-        reviews = obj.reviews.all()
-        if reviews:
-            return sum(r.rating for r in reviews) / len(reviews)
-        return 0
-    
-    def get_total_reviews(self, obj):
-        return obj.reviews.count()
 
 
 class ChatMessageSerializer(serializers.ModelSerializer):
@@ -103,19 +121,31 @@ class ChatMessageSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'timestamp', 'edited']
 
 
+class ChatMessageSearchResultSerializer(ChatMessageSerializer):
+    snippet = serializers.CharField(source='search_snippet', read_only=True)
+    
+    class Meta(ChatMessageSerializer.Meta):
+        fields = ChatMessageSerializer.Meta.fields + ['snippet']
+
+
+class ChatMessageSummarySerializer(serializers.ModelSerializer):
+    username = serializers.CharField(source='user.username', read_only=True)
+    
+    class Meta:
+        model = ChatMessage
+        fields = ['id', 'username', 'message', 'timestamp']
+
+
 class ChatRoomSerializer(serializers.ModelSerializer):
     destination_name = serializers.CharField(source='destination.name', read_only=True)
-    messages = ChatMessageSerializer(many=True, read_only=True)
-    message_count = serializers.SerializerMethodField()
+    last_message = ChatMessageSummarySerializer(read_only=True)
     
+    # Messages are fetched separately, page by page (ChatRoomViewSet.messages)
     class Meta:
         model = ChatRoom
-        fields = ['id', 'destination', 'destination_name', 'messages', 
-                 'message_count', 'created_at', 'updated_at']
-        read_only_fields = ['id', 'created_at', 'updated_at']
-    
-    def get_message_count(self, obj):
-        return obj.messages.count()
+        fields = ['id', 'destination', 'destination_name',
+                 'message_count', 'last_message', 'created_at', 'updated_at']
+        read_only_fields = ['id', 'message_count', 'created_at', 'updated_at']
 
 
 class BookingSerializer(serializers.ModelSerializer):
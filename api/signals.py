@@ -0,0 +1,93 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.dispatch import receiver
+
+from .cache import invalidate_destination, on_commit_once, touch_destination
+from .chat_search import create_chat_search_index, index_message, unindex_message
+from .models import ChatMessage, Destination, TrekRoute, WeatherCache, Review
+from .routes import update_route_metrics
+from .search import create_search_index, index_destination, unindex_destination
+from .weather import forget_weather
+from . import spatial
+
+
+@receiver([post_save, post_delete], sender=Destination)
+def destination_changed(sender, instance, **kwargs):
+    """Drop cached versions once the change is committed"""
+    transaction.on_commit(lambda: invalidate_destination(instance.pk))
+
+
+@receiver(post_save, sender=Destination)
+def destination_saved(sender, instance, **kwargs):
+    index_destination(instance)
+    # The in-memory index only ever sees committed positions
+    transaction.on_commit(lambda: spatial.update_destination(instance))
+
+
+@receiver(post_delete, sender=Destination)
+def destination_deleted(sender, instance, **kwargs):
+    unindex_destination(instance.pk)
+    destination_id = instance.pk
+    transaction.on_commit(lambda: spatial.remove_destination(destination_id))
+
+
+@receiver(post_save, sender=ChatMessage)
+def chat_message_saved(sender, instance, **kwargs):
+    index_message(instance)
+
+
+@receiver(post_delete, sender=ChatMessage)
+def chat_message_deleted(sender, instance, **kwargs):
+    unindex_message(instance.pk)
+
+
+def schedule_route_metrics(destination_id):
+    """Recompute a route's metrics once, after all of a transaction's point edits"""
+    def update():
+        if Destination.objects.filter(pk=destination_id).exists():
+            update_route_metrics(destination_id)
+
+    on_commit_once(('route_metrics', destination_id), update)
+
+
+@receiver(post_save, sender=TrekRoute)
+def route_point_saved(sender, instance, raw=False, **kwargs):
+    transaction.on_commit(lambda: spatial.update_route_point(instance))
+    if not raw:
+        schedule_route_metrics(instance.destination_id)
+
+
+@receiver(post_delete, sender=TrekRoute)
+def route_point_deleted(sender, instance, origin=None, **kwargs):
+    point_id = instance.pk
+    transaction.on_commit(lambda: spatial.remove_route_point(point_id))
+    # Skip when the whole destination is being deleted
+    if not isinstance(origin, Destination):
+        schedule_route_metrics(instance.destination_id)
+
+
+@receiver([post_save, post_delete], sender=WeatherCache)
+def weather_changed(sender, instance, **kwargs):
+    """Drop the in-memory copy once the new row is committed"""
+    transaction.on_commit(lambda: forget_weather(instance.destination_id))
+
+
+@receiver([post_save, post_delete], sender=TrekRoute)
+@receiver([post_save, post_delete], sender=WeatherCache)
+@receiver([post_save, post_delete], sender=Review)
+def destination_child_changed(sender, instance, **kwargs):
+    """
+    Routes, weather and reviews are part of the destination responses,
+    so changing them bumps the destination's updated_at (its version).
+    """
+    # Skip when the whole destination is being deleted
+    if not isinstance(kwargs.get('origin'), Destination):
+        touch_destination(instance.destination_id)
+
+
+@receiver(post_migrate)
+def create_search_indexes(sender, **kwargs):
+    """Create the full-text tables with the schema, so every write is indexed"""
+    if sender.name == 'api':
+        create_search_index()
+        create_chat_search_index()
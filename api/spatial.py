@@ -0,0 +1,417 @@
+"""
+In-memory spatial index over destinations and trek route points.
+
+Points are bucketed into a fixed lat/lon grid, so viewport (bbox) queries
+only touch the cells they overlap and k-nearest queries search outward ring
+by ring from the query cell. Indexes are loaded lazily per process and
+updated incrementally by the save/delete signals in api/signals.py once
+their transactions commit. To pick up writes from other workers they are
+rebuilt on a background thread every SPATIAL_INDEX_MAX_AGE seconds, while
+requests keep using the previous index.
+
+SegmentIndex answers "where am I along this route" by projecting a position
+onto the nearest route segment through a per-route bounding-box tree.
+"""
+import bisect
+import heapq
+import math
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.conf import settings
+from django.db import connection
+
+from .cache import LRUCacheBackend
+from .models import Destination, TrekRoute
+from .routes import ensure_route_metrics
+
+KM_PER_DEGREE = 111.195
+
+
+class GridIndex:
+    """Uniform grid of `cell_size`-degree cells mapping key -> (lat, lon, payload)"""
+
+    def __init__(self, cell_size=0.1):
+        self.cell_size = cell_size
+        self._cells = defaultdict(dict)
+        self._positions = {}
+        # Grow-only bounds (min_row, max_row, min_col, max_col) of occupied cells
+        self._bounds = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._positions)
+
+    def _cell(self, lat, lon):
+        return (math.floor(lat / self.cell_size), math.floor(lon / self.cell_size))
+
+    def insert(self, key, lat, lon, payload=None):
+        with self._lock:
+            self.remove(key)
+            row, col = self._cell(lat, lon)
+            self._positions[key] = (lat, lon, payload)
+            self._cells[(row, col)][key] = (lat, lon, payload)
+            if self._bounds is None:
+                self._bounds = (row, row, col, col)
+            else:
+                min_row, max_row, min_col, max_col = self._bounds
+                self._bounds = (min(min_row, row), max(max_row, row),
+                                min(min_col, col), max(max_col, col))
+
+    def remove(self, key):
+        with self._lock:
+            position = self._positions.pop(key, None)
+            if position is None:
+                return
+            cell = self._cell(position[0], position[1])
+            bucket = self._cells[cell]
+            bucket.pop(key, None)
+            if not bucket:
+                del self._cells[cell]
+
+    def within_bbox(self, south, west, north, east):
+        """Yield (key, lat, lon, payload) for every point inside the box"""
+        min_row, min_col = self._cell(south, west)
+        max_row, max_col = self._cell(north, east)
+        with self._lock:
+            if (max_row - min_row + 1) * (max_col - min_col + 1) > len(self._cells):
+                # Viewport spans more cells than are occupied; scan those instead
+                cells = [cell for cell in self._cells
+                         if min_row <= cell[0] <= max_row and min_col <= cell[1] <= max_col]
+            else:
+                cells = [(row, col)
+                         for row in range(min_row, max_row + 1)
+                         for col in range(min_col, max_col + 1)]
+            buckets = [list(self._cells[cell].items()) for cell in cells if cell in self._cells]
+        for bucket in buckets:
+            for key, (lat, lon, payload) in bucket:
+                if south <= lat <= north and west <= lon <= east:
+                    yield key, lat, lon, payload
+
+    def nearest(self, lat, lon, max_distance=None):
+        """
+        Yield (distance_km, key, payload) in increasing distance order.
+        Callers stop iterating once they have enough results.
+        """
+        row, col = self._cell(lat, lon)
+        with self._lock:
+            bounds = self._bounds
+        if bounds is None:
+            return
+        min_row, max_row, min_col, max_col = bounds
+        # Rings closer than the occupied area are empty, and none lie beyond it
+        ring = max(min_row - row, row - max_row, min_col - col, col - max_col, 0)
+        last_ring = max(abs(row - min_row), abs(row - max_row),
+                        abs(col - min_col), abs(col - max_col))
+        heap = []
+        while ring <= last_ring:
+            with self._lock:
+                buckets = [list(self._cells[cell].items())
+                           for cell in _ring_cells(row, col, ring, bounds)
+                           if cell in self._cells]
+            for bucket in buckets:
+                for key, (point_lat, point_lon, payload) in bucket:
+                    distance = TrekRoute.calculate_distance(lat, lon, point_lat, point_lon)
+                    heapq.heappush(heap, (distance, key, payload))
+            # Nothing outside the searched rings can be closer than ring_bound
+            ring_bound = self._ring_lower_bound(ring, bounds) if ring < last_ring else math.inf
+            while heap and heap[0][0] <= ring_bound:
+                distance, key, payload = heapq.heappop(heap)
+                if max_distance is not None and distance > max_distance:
+                    return
+                yield distance, key, payload
+            if max_distance is not None and ring_bound > max_distance:
+                return
+            ring += 1
+
+    def _ring_lower_bound(self, ring, bounds):
+        # The query lies inside the centre cell, so anything beyond `ring` is
+        # at least `ring` cells away in latitude or in longitude; a degree of
+        # longitude is shortest at the occupied latitude farthest from the equator
+        min_row, max_row = bounds[0], bounds[1]
+        widest_lat = min(max(abs(min_row), abs(max_row + 1)) * self.cell_size, 89.999)
+        return ring * self.cell_size * KM_PER_DEGREE * math.cos(math.radians(widest_lat))
+
+
+def _ring_cells(row, col, ring, bounds):
+    """Cells at Chebyshev distance `ring` from (row, col), clipped to bounds"""
+    min_row, max_row, min_col, max_col = bounds
+    if ring == 0:
+        return [(row, col)]
+    cells = []
+    first_col, last_col = max(col - ring, min_col), min(col + ring, max_col)
+    for edge_row in (row - ring, row + ring):
+        if min_row <= edge_row <= max_row:
+            cells.extend((edge_row, c) for c in range(first_col, last_col + 1))
+    first_row, last_row = max(row - ring + 1, min_row), min(row + ring - 1, max_row)
+    for edge_col in (col - ring, col + ring):
+        if min_col <= edge_col <= max_col:
+            cells.extend((r, edge_col) for r in range(first_row, last_row + 1))
+    return cells
+
+
+_indexes = {}
+_loaded_at = {}
+# Edits made while an index is being rebuilt, replayed onto the new one
+_pending_edits = {}
+_scheduled = set()
+_load_lock = threading.Lock()
+_build_lock = threading.Lock()
+_background = ThreadPoolExecutor(max_workers=1, thread_name_prefix='spatial-reload')
+
+
+def _max_age():
+    return getattr(settings, 'SPATIAL_INDEX_MAX_AGE', 300)
+
+
+def _cell_size():
+    return getattr(settings, 'SPATIAL_INDEX_CELL_SIZE', 0.1)
+
+
+def _build(name, loader):
+    with _load_lock:
+        _pending_edits[name] = []
+    index = GridIndex(_cell_size())
+    try:
+        loader(index)
+    finally:
+        with _load_lock:
+            edits = _pending_edits.pop(name)
+    with _load_lock:
+        for method, args in edits:
+            getattr(index, method)(*args)
+        _indexes[name] = index
+        _loaded_at[name] = time.monotonic()
+    return index
+
+
+def _reload_in_background(name, loader):
+    with _load_lock:
+        if name in _scheduled:
+            return
+        _scheduled.add(name)
+
+    def run():
+        try:
+            with _build_lock:
+                _build(name, loader)
+        finally:
+            with _load_lock:
+                _scheduled.discard(name)
+            connection.close()
+
+    _background.submit(run)
+
+
+def _get_index(name, loader):
+    index = _indexes.get(name)
+    if index is None:
+        # Nothing to serve yet, so the first load blocks
+        with _build_lock:
+            index = _indexes.get(name)
+            if index is None:
+                index = _build(name, loader)
+    elif time.monotonic() - _loaded_at.get(name, 0) > _max_age():
+        _reload_in_background(name, loader)
+    return index
+
+
+def _edit(name, method, *args):
+    """Apply an edit to a loaded index and to any rebuild in progress"""
+    with _load_lock:
+        index = _indexes.get(name)
+        if name in _pending_edits:
+            _pending_edits[name].append((method, args))
+    if index is not None:
+        getattr(index, method)(*args)
+
+
+def _load_destinations(index):
+    for pk, lat, lon in Destination.objects.values_list('id', 'latitude', 'longitude').iterator():
+        index.insert(pk, lat, lon)
+
+
+def _load_route_points(index):
+    rows = TrekRoute.objects.values_list('id', 'latitude', 'longitude', 'destination_id')
+    for pk, lat, lon, destination_id in rows.iterator(chunk_size=10000):
+        index.insert(pk, lat, lon, destination_id)
+
+
+def destination_index():
+    """Index of destination map centres keyed by destination id"""
+    return _get_index('destinations', _load_destinations)
+
+
+def route_point_index():
+    """Index of route points keyed by point id, with the destination id as payload"""
+    return _get_index('route_points', _load_route_points)
+
+
+def update_destination(destination):
+    _edit('destinations', 'insert', destination.pk, destination.latitude, destination.longitude)
+
+
+def remove_destination(destination_id):
+    _edit('destinations', 'remove', destination_id)
+
+
+def update_route_point(point):
+    _edit('route_points', 'insert', point.pk, point.latitude, point.longitude,
+          point.destination_id)
+
+
+def remove_route_point(point_id):
+    _edit('route_points', 'remove', point_id)
+
+
+def reset_indexes():
+    """Drop loaded indexes, e.g. after bulk writes that bypass signals"""
+    with _load_lock:
+        _indexes.clear()
+        _loaded_at.clear()
+
+
+class SegmentIndex:
+    """
+    Bounding-box tree over the consecutive segments of one route, used to
+    project a position onto the route. Consecutive segments are spatially
+    coherent, so leaves group `leaf_size` neighbouring segments and each
+    level above merges pairs of boxes. Queries descend best-first and prune
+    boxes farther than the closest segment found so far.
+    """
+
+    def __init__(self, latitudes, longitudes, cumulative_km, stops=(), leaf_size=8):
+        latitudes = np.asarray(latitudes, dtype=float)
+        longitudes = np.asarray(longitudes, dtype=float)
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+        self.cumulative_km = np.asarray(cumulative_km, dtype=float)
+        # Local equirectangular projection in km; accurate at trek scale
+        self._lat_scale = KM_PER_DEGREE
+        self._lon_scale = KM_PER_DEGREE * math.cos(math.radians(latitudes.mean())) if len(latitudes) else KM_PER_DEGREE
+        self._x = longitudes * self._lon_scale
+        self._y = latitudes * self._lat_scale
+        self.stops = list(stops)  # (point index, sequence_order, name), ordered
+        self._stop_indices = [stop[0] for stop in self.stops]
+        self.leaf_size = leaf_size
+
+        segments = max(len(latitudes) - 1, 0)
+        self.levels = []
+        if not segments:
+            return
+        x0, x1 = self._x[:-1], self._x[1:]
+        y0, y1 = self._y[:-1], self._y[1:]
+        boxes = np.stack([np.minimum(x0, x1), np.minimum(y0, y1),
+                          np.maximum(x0, x1), np.maximum(y0, y1)], axis=1)
+        level = self._merge(boxes, leaf_size)
+        self.levels.append(level)
+        while len(level) > 1:
+            level = self._merge(level, 2)
+            self.levels.append(level)
+
+    @staticmethod
+    def _merge(boxes, group):
+        starts = np.arange(0, len(boxes), group)
+        return np.stack([
+            np.minimum.reduceat(boxes[:, 0], starts),
+            np.minimum.reduceat(boxes[:, 1], starts),
+            np.maximum.reduceat(boxes[:, 2], starts),
+            np.maximum.reduceat(boxes[:, 3], starts),
+        ], axis=1)
+
+    @property
+    def total_km(self):
+        return float(self.cumulative_km[-1]) if len(self.cumulative_km) else 0.0
+
+    def locate(self, lat, lon):
+        """
+        Project (lat, lon) onto the route. Returns (segment, fraction,
+        off_route_km): the position lies `fraction` of the way along
+        segment `segment` (points segment -> segment + 1).
+        """
+        if not self.levels:
+            if not len(self._x):
+                return None
+            offset = TrekRoute.calculate_distance(lat, lon, self.latitudes[0], self.longitudes[0])
+            return 0, 0.0, offset
+
+        px, py = lon * self._lon_scale, lat * self._lat_scale
+        top = len(self.levels) - 1
+        heap = [(0.0, top, i) for i in range(len(self.levels[top]))]
+        best = (math.inf, 0, 0.0)
+        while heap:
+            box_distance, depth, node = heapq.heappop(heap)
+            if box_distance >= best[0]:
+                break
+            if depth == 0:
+                first = node * self.leaf_size
+                last = min(first + self.leaf_size, len(self._x) - 1)
+                x0, y0 = self._x[first:last], self._y[first:last]
+                dx, dy = self._x[first + 1:last + 1] - x0, self._y[first + 1:last + 1] - y0
+                lengths = dx * dx + dy * dy
+                t = np.clip(np.divide((px - x0) * dx + (py - y0) * dy, lengths,
+                                      out=np.zeros_like(lengths), where=lengths > 0), 0, 1)
+                distances = np.hypot(x0 + t * dx - px, y0 + t * dy - py)
+                closest = int(distances.argmin())
+                if distances[closest] < best[0]:
+                    best = (float(distances[closest]), first + closest, float(t[closest]))
+                continue
+            children = self.levels[depth - 1]
+            for child in (2 * node, 2 * node + 1):
+                if child < len(children):
+                    min_x, min_y, max_x, max_y = children[child]
+                    gap_x = max(min_x - px, 0.0, px - max_x)
+                    gap_y = max(min_y - py, 0.0, py - max_y)
+                    heapq.heappush(heap, (math.hypot(gap_x, gap_y), depth - 1, child))
+        distance, segment, fraction = best
+        return segment, fraction, distance
+
+    def position(self, segment, fraction):
+        """(lat, lon, distance_from_start_km) of a point along a segment"""
+        end = min(segment + 1, len(self.latitudes) - 1)
+        lat = self.latitudes[segment] + fraction * (self.latitudes[end] - self.latitudes[segment])
+        lon = self.longitudes[segment] + fraction * (self.longitudes[end] - self.longitudes[segment])
+        travelled = (self.cumulative_km[segment] +
+                     fraction * (self.cumulative_km[end] - self.cumulative_km[segment]))
+        return float(lat), float(lon), float(travelled)
+
+    def next_stop(self, segment, fraction=0.0):
+        """First named stop ahead of a position on the route, or None"""
+        # At the end of a segment the trekker is standing on its last point
+        point = segment + 1 if fraction >= 1 else segment
+        position = bisect.bisect_right(self._stop_indices, point)
+        return self.stops[position] if position < len(self.stops) else None
+
+
+_segment_indexes = None
+
+
+def segment_index(destination_id, version):
+    """
+    SegmentIndex for a destination's route, built once per route version
+    and kept in a small per-process LRU.
+    """
+    global _segment_indexes
+    if _segment_indexes is None:
+        _segment_indexes = LRUCacheBackend(
+            max_entries=getattr(settings, 'SEGMENT_INDEX_CACHE_SIZE', 64))
+    key = (destination_id, version)
+    index = _segment_indexes.get(key)
+    if index is None:
+        # Cumulative distances come from the stored metrics
+        ensure_route_metrics(destination_id)
+        rows = list(TrekRoute.objects.filter(destination_id=destination_id)
+                    .order_by('sequence_order')
+                    .values_list('latitude', 'longitude', 'distance_from_start_km',
+                                 'sequence_order', 'location_name'))
+        index = SegmentIndex(
+            [row[0] for row in rows],
+            [row[1] for row in rows],
+            [row[2] for row in rows],
+            stops=[(i, row[3], row[4]) for i, row in enumerate(rows) if row[4]],
+        )
+        _segment_indexes.set(key, index)
+    return index
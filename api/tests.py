@@ -0,0 +1,777 @@
+import asyncio
+import datetime
+import io
+import threading
+from types import SimpleNamespace
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import DatabaseError, transaction
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+
+from .cache import destination_version, get_response_cache, on_commit_once
+from .chat import (
+    ChatMessageBuffer, decode_cursor, encode_cursor, messages_before, messages_since,
+    write_messages,
+)
+from .chat_search import decode_search_cursor, encode_search_cursor, search_messages
+from .history import (
+    DAILY, HOURLY, compact_weather_history, record_weather, weather_history,
+)
+from .importers import RouteImportError, import_route, iter_geojson_points
+from .limits import TokenBucket
+from .models import (
+    ChatMessage, ChatRoom, Destination, Review, RouteMetrics, TrekRoute, WeatherCache,
+)
+from .routes import (
+    SIMPLIFICATION_ZOOM_LEVELS, build_encoded_routes, compute_route_metrics, downsample_lttb,
+    encode_polyline, encoded_route_for_zoom, ensure_route_metrics, simplify_route,
+    update_route_metrics,
+)
+from .weather import SingleFlight
+from .weather_providers import (
+    CircuitBreaker, CircuitOpenError, RateLimiter, WeatherClient, WeatherProvider,
+    WeatherProviderError,
+)
+from . import spatial
+
+
+def create_destination(name='Test Trek', **fields):
+    defaults = dict(
+        description='A trek for tests', location='Test Region', altitude=4000,
+        duration_days=10, difficulty='MODERATE', price=1000,
+    )
+    defaults.update(fields)
+    return Destination.objects.create(name=name, **defaults)
+
+
+class DestinationDetailQueryCountTests(TestCase):
+    """The detail endpoint's query count must not grow with the number of reviews"""
+
+    # Version lookup, destination with its rating summary and route metrics,
+    # then one query each for route points, weather and reviews with users
+    DETAIL_QUERIES = 5
+
+    def setUp(self):
+        get_response_cache().clear()
+        self.client = APIClient()
+        self.destination = create_destination()
+        for sequence in range(1, 4):
+            TrekRoute.objects.create(
+                destination=self.destination, sequence_order=sequence,
+                location_name=f'Stop {sequence}', latitude=28 + sequence / 100,
+                longitude=84, altitude=3000 + sequence * 100,
+            )
+        WeatherCache.objects.create(
+            destination=self.destination, temperature=5, weather_condition='Clear',
+            description='clear sky', humidity=40, wind_speed=3,
+        )
+
+    def add_reviews(self, count):
+        for i in range(count):
+            user = User.objects.create_user(f'reviewer{i}', password='x')
+            Review.objects.create(destination=self.destination, user=user,
+                                  rating=i % 5 + 1, comment='Great')
+
+    def get_detail(self):
+        get_response_cache().clear()
+        response = self.client.get(f'/api/destinations/{self.destination.pk}/')
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_detail_without_reviews(self):
+        with self.assertNumQueries(self.DETAIL_QUERIES):
+            response = self.get_detail()
+        self.assertEqual(response.data['reviews'], [])
+
+    def test_detail_with_reviews(self):
+        self.add_reviews(20)
+        with self.assertNumQueries(self.DETAIL_QUERIES):
+            response = self.get_detail()
+        self.assertEqual(len(response.data['reviews']), 20)
+
+
+class OnCommitOnceTests(TestCase):
+
+    def test_runs_once_per_key(self):
+        calls = []
+        with self.captureOnCommitCallbacks(execute=True):
+            for _ in range(3):
+                on_commit_once('key', lambda: calls.append('key'))
+            on_commit_once('other', lambda: calls.append('other'))
+        self.assertEqual(calls, ['key', 'other'])
+
+    def test_pending_callbacks_are_per_thread(self):
+        calls = []
+        with self.captureOnCommitCallbacks(execute=True):
+            on_commit_once('key', lambda: calls.append('main'))
+            # Outside a transaction the other thread's callback runs at once
+            thread = threading.Thread(
+                target=on_commit_once, args=('key', lambda: calls.append('thread')))
+            thread.start()
+            thread.join()
+            on_commit_once('key', lambda: calls.append('main'))
+        self.assertEqual(calls, ['thread', 'main'])
+
+
+class GridIndexTests(TestCase):
+
+    def setUp(self):
+        self.index = spatial.GridIndex(cell_size=1)
+        self.index.insert('a', 28.0, 84.0)
+        self.index.insert('b', 28.5, 84.5, 'payload')
+        self.index.insert('c', 27.0, 86.0)
+
+    def test_within_bbox(self):
+        keys = {key for key, *_ in self.index.within_bbox(27.9, 83.9, 28.6, 84.6)}
+        self.assertEqual(keys, {'a', 'b'})
+
+    def test_nearest_in_distance_order(self):
+        results = list(self.index.nearest(28.4, 84.4))
+        self.assertEqual([key for _, key, _ in results], ['b', 'a', 'c'])
+        self.assertEqual(results[0][2], 'payload')
+        distances = [distance for distance, _, _ in results]
+        self.assertEqual(distances, sorted(distances))
+
+    def test_nearest_within_max_distance(self):
+        results = list(self.index.nearest(28.0, 84.0, max_distance=100))
+        self.assertEqual([key for _, key, _ in results], ['a', 'b'])
+
+    def test_insert_moves_and_remove_drops(self):
+        self.index.insert('a', 10.0, 10.0)
+        self.index.remove('c')
+        self.assertEqual(len(self.index), 2)
+        self.assertEqual([key for key, *_ in self.index.within_bbox(9, 9, 11, 11)], ['a'])
+
+
+class SpatialIndexUpdateTests(TestCase):
+
+    def setUp(self):
+        spatial.reset_indexes()
+        self.addCleanup(spatial.reset_indexes)
+
+    def indexed(self):
+        return {key for key, *_ in spatial.destination_index().within_bbox(-90, -180, 90, 180)}
+
+    def test_committed_save_is_indexed(self):
+        self.assertEqual(self.indexed(), set())
+        with self.captureOnCommitCallbacks(execute=True):
+            destination = create_destination(latitude=28.0, longitude=84.0)
+        self.assertEqual(self.indexed(), {destination.pk})
+
+    def test_rolled_back_save_is_not_indexed(self):
+        self.assertEqual(self.indexed(), set())
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    create_destination(latitude=28.0, longitude=84.0)
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        self.assertEqual(self.indexed(), set())
+
+    @override_settings(SPATIAL_INDEX_MAX_AGE=0)
+    def test_stale_index_is_served_while_rebuilt(self):
+        loads = []
+
+        def loader(index):
+            loads.append(threading.current_thread())
+            index.insert(len(loads), 0, 0)
+
+        first = spatial._get_index('test', loader)
+        self.assertIs(spatial._get_index('test', loader), first)
+        spatial._background.submit(lambda: None).result()
+        self.assertEqual(loads[0], threading.current_thread())
+        self.assertEqual(len(loads), 2)
+        self.assertNotEqual(loads[1], threading.current_thread())
+        self.assertIsNot(spatial._indexes['test'], first)
+
+
+class RouteMetricsTests(TestCase):
+
+    def test_compute_route_metrics(self):
+        # Three points a tenth of a degree of latitude (11.12 km) apart
+        metrics = compute_route_metrics([28.0, 28.1, 28.2], [84.0, 84.0, 84.0],
+                                        [1000, 1500, 1200], stops=[1])
+        self.assertEqual([round(km, 2) for km in metrics['cumulative_km']], [0, 11.12, 22.24])
+        self.assertAlmostEqual(metrics['total_distance_km'], 22.239, places=3)
+        self.assertEqual(metrics['total_ascent_m'], 500)
+        self.assertEqual(metrics['total_descent_m'], 300)
+        self.assertEqual((metrics['min_altitude_m'], metrics['max_altitude_m']), (1000, 1500))
+        self.assertAlmostEqual(metrics['max_grade_percent'], 500 / 111.2, places=2)
+        self.assertEqual([(leg['start'], leg['end'], leg['ascent_m'], leg['descent_m'])
+                          for leg in metrics['legs']], [(0, 1, 500, 0), (1, 2, 0, 300)])
+
+    def test_short_segments_are_ignored_for_max_grade(self):
+        # A 50 m climb over about 1 m of GPS jitter
+        metrics = compute_route_metrics([28.0, 28.00001, 28.1], [84.0, 84.0, 84.0],
+                                        [1000, 1050, 1050])
+        self.assertLess(metrics['max_grade_percent'], 1)
+
+    def test_route_without_segments(self):
+        metrics = compute_route_metrics([28.0], [84.0], [1000])
+        self.assertEqual(metrics['total_distance_km'], 0)
+        self.assertEqual(metrics['legs'], [])
+
+    def test_ensure_route_metrics_fills_distances_and_bumps_version(self):
+        destination = create_destination()
+        TrekRoute.objects.bulk_create([
+            TrekRoute(destination=destination, sequence_order=i, latitude=28 + i / 10,
+                      longitude=84, altitude=1000, location_name='')
+            for i in range(3)
+        ])
+        version = destination_version(destination.pk)
+        get_response_cache().clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            metrics = ensure_route_metrics(destination.pk)
+        self.assertAlmostEqual(metrics.total_distance_km, 22.239, places=3)
+        self.assertEqual(
+            list(destination.route_points.values_list('distance_from_start_km', flat=True)),
+            [0, 11.1195, 22.239])
+        self.assertNotEqual(destination_version(destination.pk), version)
+        # Already computed: returned as stored
+        with self.assertNumQueries(1):
+            self.assertEqual(ensure_route_metrics(destination.pk), metrics)
+
+
+class RouteEncodingTests(TestCase):
+
+    def test_encode_polyline(self):
+        # The worked example from Google's polyline format documentation
+        self.assertEqual(encode_polyline([38.5, 40.7, 43.252], [-120.2, -120.95, -126.453]),
+                         '_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+
+    def test_simplify_drops_collinear_points(self):
+        latitudes = [28.0, 28.1, 28.2, 28.3, 28.4]
+        self.assertEqual(simplify_route(latitudes, [84.0] * 5, 0.001).tolist(), [0, 4])
+
+    def test_simplify_keeps_corners_and_stops(self):
+        latitudes = [28.0, 28.1, 28.2, 28.2, 28.2]
+        longitudes = [84.0, 84.0, 84.0, 84.1, 84.2]
+        self.assertEqual(simplify_route(latitudes, longitudes, 0.001).tolist(), [0, 2, 4])
+        self.assertEqual(simplify_route(latitudes, longitudes, 0.001, keep=[1]).tolist(),
+                         [0, 1, 2, 4])
+
+    def test_encoded_route_for_zoom(self):
+        routes = build_encoded_routes([28.0, 28.1, 28.2], [84.0, 84.0, 84.0],
+                                      [1000, 1100, 1200], stops=[(1, 'Camp')])
+        self.assertEqual(set(routes), {'full'} | {str(zoom) for zoom in SIMPLIFICATION_ZOOM_LEVELS})
+        self.assertIs(encoded_route_for_zoom(routes), routes['full'])
+        self.assertIs(encoded_route_for_zoom(routes, 20), routes['full'])
+        self.assertIs(encoded_route_for_zoom(routes, 9), routes['8'])
+        self.assertIs(encoded_route_for_zoom(routes, 1), routes['6'])
+        # The named stop survives simplification of a straight line
+        self.assertEqual(routes['6']['point_count'], 3)
+        self.assertEqual(routes['6']['stops'], [[1, 'Camp']])
+
+
+class RouteImportTests(TestCase):
+
+    def test_geojson_positions_with_extra_values(self):
+        stream = io.StringIO('{"type": "LineString", "coordinates": '
+                             '[[84.0, 28.0], [84.1, 28.1, 1200], [84.2, 28.2, 1300, 1700000000]]}')
+        self.assertEqual(list(iter_geojson_points(stream, chunk_size=7)), [
+            (28.0, 84.0, None, None), (28.1, 84.1, 1200, None), (28.2, 84.2, 1300, None),
+        ])
+
+    def test_malformed_csv_names_the_line(self):
+        stream = io.BytesIO(b'lat,lon\n28.0,84.0\n28.1,east\n')
+        with self.assertRaisesMessage(RouteImportError, 'CSV line 3'):
+            import_route(create_destination(), stream, 'csv')
+
+    def test_appended_route_metrics_match_a_full_recompute(self):
+        destination = create_destination()
+        import_route(destination, io.BytesIO(
+            b'lat,lon,ele,name\n28.0,84.0,1000,Start\n28.1,84.0,1500,\n'), 'csv')
+        stats = import_route(destination, io.BytesIO(
+            b'lat,lon,ele,name\n28.2,84.1,1200,Camp\n28.3,84.1,1400,\n'), 'csv')
+        self.assertEqual(stats['imported'], 2)
+        imported = RouteMetrics.objects.get(destination=destination)
+        distances = list(destination.route_points.values_list('distance_from_start_km', flat=True))
+        recomputed = update_route_metrics(destination.pk)
+        self.assertEqual(
+            list(destination.route_points.values_list('distance_from_start_km', flat=True)),
+            distances)
+        for field in ('total_distance_km', 'total_ascent_m', 'total_descent_m',
+                      'max_grade_percent', 'point_count', 'legs', 'encoded_routes'):
+            self.assertEqual(getattr(imported, field), getattr(recomputed, field), field)
+        self.assertEqual([leg['start'] for leg in imported.legs], [1, 3])
+
+
+class ElevationProfileTests(TestCase):
+
+    def test_lttb_keeps_endpoints_and_peaks(self):
+        x = list(range(100))
+        y = [0] * 100
+        y[37], y[71] = 500, -300
+        indices = downsample_lttb(x, y, 10).tolist()
+        self.assertEqual(len(indices), 10)
+        self.assertEqual(indices, sorted(indices))
+        self.assertEqual((indices[0], indices[-1]), (0, 99))
+        self.assertIn(37, indices)
+        self.assertIn(71, indices)
+
+    def test_lttb_small_thresholds(self):
+        self.assertEqual(downsample_lttb(range(10), range(10), 2).tolist(), [0, 9])
+        self.assertEqual(downsample_lttb(range(10), range(10), 1).tolist(), [0, 9])
+        self.assertEqual(downsample_lttb(range(5), range(5), 50).tolist(), [0, 1, 2, 3, 4])
+
+    def test_profile_of_route_without_metrics(self):
+        get_response_cache().clear()
+        destination = create_destination()
+        TrekRoute.objects.bulk_create([
+            TrekRoute(destination=destination, sequence_order=i, latitude=28 + i / 10,
+                      longitude=84, altitude=1000 + 100 * i, location_name='Camp' if i == 2 else '')
+            for i in range(5)
+        ])
+        url = f'/api/destinations/{destination.pk}/elevation_profile/'
+        profile = APIClient().get(url, {'points': 3}).data
+        self.assertEqual(profile['points'], 3)
+        self.assertEqual(profile['distance_km'][0], 0)
+        self.assertAlmostEqual(profile['distance_km'][-1], 44.478, places=3)
+        self.assertEqual(profile['stops'], [{'distance_km': 22.239, 'name': 'Camp'}])
+        self.assertEqual(APIClient().get(url, {'points': 1}).data['points'], 2)
+
+
+class SegmentIndexTests(TestCase):
+
+    def setUp(self):
+        # A straight route north with stops at the second and last points
+        self.index = spatial.SegmentIndex(
+            [28.0, 28.1, 28.2, 28.3], [84.0] * 4, [0, 11.12, 22.24, 33.36],
+            stops=[(1, 2, 'Camp'), (3, 4, 'Summit')], leaf_size=2)
+
+    def test_locate_projects_onto_route(self):
+        segment, fraction, off_route_km = self.index.locate(28.15, 84.01)
+        self.assertEqual(segment, 1)
+        self.assertAlmostEqual(fraction, 0.5)
+        self.assertAlmostEqual(off_route_km, 0.98, places=2)
+        lat, lon, travelled = self.index.position(segment, fraction)
+        self.assertAlmostEqual(lat, 28.15)
+        self.assertAlmostEqual(travelled, 16.68)
+
+    def test_locate_clips_to_route_ends(self):
+        self.assertEqual(self.index.locate(27.5, 84.0)[:2], (0, 0.0))
+        self.assertEqual(self.index.locate(29.0, 84.0)[:2], (2, 1.0))
+
+    def test_next_stop(self):
+        self.assertEqual(self.index.next_stop(0, 0.5), (1, 2, 'Camp'))
+        self.assertEqual(self.index.next_stop(1, 0.0), (3, 4, 'Summit'))
+        # Standing at the end of a segment is standing at its last point
+        self.assertEqual(self.index.next_stop(0, 1.0), (3, 4, 'Summit'))
+        self.assertIsNone(self.index.next_stop(2, 1.0))
+
+    def test_locate_on_route_without_metrics(self):
+        get_response_cache().clear()
+        destination = create_destination()
+        TrekRoute.objects.bulk_create([
+            TrekRoute(destination=destination, sequence_order=i, latitude=28 + i / 10,
+                      longitude=84, altitude=1000, location_name=f'Stop {i}')
+            for i in range(3)
+        ])
+        located = APIClient().get(f'/api/destinations/{destination.pk}/locate/',
+                                  {'lat': 28.05, 'lon': 84}).data
+        self.assertAlmostEqual(located['distance_travelled_km'], 5.56, places=2)
+        self.assertAlmostEqual(located['distance_remaining_km'], 16.68, places=2)
+        self.assertEqual(located['next_stop']['name'], 'Stop 1')
+
+
+class SingleFlightTests(TestCase):
+
+    def test_concurrent_calls_share_one_result(self):
+        flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], []
+
+        def fetch():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'reading'
+
+        leader = threading.Thread(target=lambda: results.append(flight.do('key', fetch)))
+        leader.start()
+        started.wait(5)
+        self.assertTrue(flight.in_flight('key'))
+        followers = [threading.Thread(target=lambda: results.append(flight.do('key', fetch)))
+                     for _ in range(3)]
+        joined = threading.Semaphore(0)
+        lock = flight._lock
+
+        class CountingLock:
+            # Counts followers that have looked up the in-flight call
+            def __enter__(self):
+                lock.acquire()
+
+            def __exit__(self, *exc_info):
+                lock.release()
+                joined.release()
+
+        flight._lock = CountingLock()
+        for follower in followers:
+            follower.start()
+        for _ in followers:
+            self.assertTrue(joined.acquire(timeout=5))
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['reading'] * 4)
+        self.assertFalse(flight.in_flight('key'))
+
+    def test_errors_reach_the_caller_and_are_not_cached(self):
+        flight = SingleFlight()
+        with self.assertRaises(ZeroDivisionError):
+            flight.do('key', lambda: 1 / 0)
+        self.assertEqual(flight.do('key', lambda: 'reading'), 'reading')
+
+
+class WeatherHistoryTests(TestCase):
+
+    def setUp(self):
+        self.destination = create_destination()
+        self.day = datetime.datetime(2024, 3, 10, tzinfo=datetime.timezone.utc)
+        for hour, temperature, wind_speed in ((6, 1.0, 2.0), (12, 5.5, 8.0), (18, 3.0, 5.0)):
+            record_weather(SimpleNamespace(
+                destination_id=self.destination.pk,
+                cached_at=self.day + datetime.timedelta(hours=hour),
+                temperature=temperature, humidity=50.0, wind_speed=wind_speed,
+            ))
+        self.next_day = self.day + datetime.timedelta(days=1)
+
+    def test_hourly_range(self):
+        history = weather_history(self.destination.pk, self.day + datetime.timedelta(hours=7),
+                                  self.next_day, HOURLY, ['temperature'])
+        self.assertEqual(history, {
+            'resolution': HOURLY,
+            'timestamps': [int(self.day.timestamp()) + hours * 3600 for hours in (12, 18)],
+            'temperature': [5.5, 3.0],
+        })
+
+    def test_compaction_into_daily_aggregates(self):
+        now = self.day + datetime.timedelta(days=60)
+        self.assertEqual(compact_weather_history(now), 1)
+        self.assertEqual(compact_weather_history(now), 0)
+        hourly = weather_history(self.destination.pk, self.day, self.next_day, HOURLY)
+        self.assertEqual(hourly['timestamps'], [])
+        history = weather_history(self.destination.pk, self.day, self.next_day, DAILY)
+        self.assertEqual(history['timestamps'], [int(self.day.timestamp())])
+        self.assertEqual(history['temperature'], [3.17])
+        self.assertEqual(history['temperature_min'], [1.0])
+        self.assertEqual(history['temperature_max'], [5.5])
+        self.assertEqual(history['wind_speed_max'], [8.0])
+        self.assertEqual(history['samples'], [3])
+        self.assertIsInstance(history['samples'][0], int)
+
+    def test_daily_resolution_aggregates_recent_hours(self):
+        history = weather_history(self.destination.pk, self.day, self.next_day, DAILY,
+                                  ['temperature', 'samples'])
+        self.assertEqual(history['temperature'], [3.17])
+        self.assertEqual(history['samples'], [3])
+
+
+class FlakyProvider(WeatherProvider):
+    """Raises the queued errors one call at a time, then returns a reading"""
+    name = 'flaky'
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def fetch(self, destination):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return {'temperature': 10}
+
+
+class WeatherClientTests(TestCase):
+
+    def test_retries_transient_failures(self):
+        provider = FlakyProvider(WeatherProviderError('503'), WeatherProviderError('503'))
+        client = WeatherClient(provider, retries=2, backoff=0)
+        self.assertEqual(client.fetch(None), {'temperature': 10})
+        self.assertEqual(provider.calls, 3)
+        self.assertEqual(client.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_gives_up_after_retries(self):
+        provider = FlakyProvider(*[WeatherProviderError('503')] * 3)
+        client = WeatherClient(provider, retries=1, backoff=0)
+        with self.assertRaises(WeatherProviderError):
+            client.fetch(None)
+        self.assertEqual(provider.calls, 2)
+
+    def test_does_not_retry_permanent_failures(self):
+        provider = FlakyProvider(WeatherProviderError('401', retryable=False))
+        client = WeatherClient(provider, retries=2, backoff=0)
+        with self.assertRaises(WeatherProviderError):
+            client.fetch(None)
+        self.assertEqual(provider.calls, 1)
+
+    def test_open_circuit_fails_fast(self):
+        provider = FlakyProvider(*[WeatherProviderError('401', retryable=False)] * 2)
+        client = WeatherClient(provider, retries=0, failure_threshold=2)
+        for _ in range(2):
+            with self.assertRaises(WeatherProviderError):
+                client.fetch(None)
+        with self.assertRaises(CircuitOpenError):
+            client.fetch(None)
+        self.assertEqual(provider.calls, 2)
+
+
+@mock.patch('api.weather_providers.time.monotonic', return_value=1000.0)
+class CircuitBreakerTests(TestCase):
+
+    def open_breaker(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+        return breaker
+
+    def test_success_resets_failure_count(self, monotonic):
+        breaker = CircuitBreaker(failure_threshold=2)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_single_trial_after_timeout_closes_on_success(self, monotonic):
+        breaker = self.open_breaker()
+        monotonic.return_value += 30
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow())
+
+    def test_failed_trial_reopens(self, monotonic):
+        breaker = self.open_breaker()
+        monotonic.return_value += 30
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+
+
+class RateLimiterTests(TestCase):
+
+    @mock.patch('api.weather_providers.time.sleep')
+    @mock.patch('api.weather_providers.time.monotonic', return_value=1000.0)
+    def test_spaces_calls(self, monotonic, sleep):
+        limiter = RateLimiter(rate=10)
+        for _ in range(3):
+            limiter.wait()
+        self.assertEqual([round(call.args[0], 6) for call in sleep.call_args_list], [0.1, 0.2])
+
+    @mock.patch('api.weather_providers.time.sleep')
+    def test_unlimited(self, sleep):
+        RateLimiter(rate=None).wait()
+        sleep.assert_not_called()
+
+
+def run_inline(function):
+    """database_sync_to_async stand-in running on the event loop's thread"""
+    async def call(*args):
+        return function(*args)
+    return call
+
+
+class ChatMessageBufferTests(TestCase):
+
+    def setUp(self):
+        self.failing_rooms = set()
+        self.failures_left = 0
+        self.written = []
+        self.sent = []
+
+        async def send(group, payload):
+            self.sent.append(payload['message'])
+
+        broadcaster = SimpleNamespace(send=send)
+        for patcher in (
+            mock.patch('api.chat.database_sync_to_async', run_inline),
+            mock.patch('api.chat.write_messages', side_effect=self.write_messages),
+            mock.patch('api.chat.get_chat_broadcaster', return_value=broadcaster),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.user = SimpleNamespace(pk=1, username='trekker')
+
+    def write_messages(self, messages):
+        if self.failures_left or any(m.chat_room_id in self.failing_rooms for m in messages):
+            self.failures_left = max(self.failures_left - 1, 0)
+            raise DatabaseError('write failed')
+        for message in messages:
+            message.pk = len(self.written) + 1
+            self.written.append(message.message)
+        return messages
+
+    def add(self, buffer, chat_room_id, text):
+        return buffer.add(chat_room_id, f'chat_{chat_room_id}', self.user, text)
+
+    def test_failed_batch_is_retried_ahead_of_newer_messages(self):
+        self.failures_left = 1
+        buffer = ChatMessageBuffer(max_batch=10, max_retries=3)
+
+        async def scenario():
+            await self.add(buffer, 1, 'first')
+            await buffer.flush()
+            await self.add(buffer, 1, 'second')
+            await buffer.flush()
+
+        with self.assertLogs('api.chat', 'ERROR'):
+            asyncio.run(scenario())
+        self.assertEqual(self.written, ['first', 'second'])
+        self.assertEqual(self.sent, ['first', 'second'])
+        self.assertEqual(buffer._failures, 0)
+
+    def test_unwritable_message_is_dropped_after_retries(self):
+        self.failing_rooms = {2}
+        buffer = ChatMessageBuffer(max_batch=10, max_retries=3)
+
+        async def scenario():
+            await self.add(buffer, 1, 'good')
+            await self.add(buffer, 2, 'orphan')
+            for _ in range(3):
+                await buffer.flush()
+            await self.add(buffer, 1, 'later')
+            await buffer.flush()
+
+        with self.assertLogs('api.chat', 'ERROR') as logs:
+            asyncio.run(scenario())
+        self.assertEqual(self.written, ['good', 'later'])
+        self.assertEqual(self.sent, ['good', 'later'])
+        self.assertIn('Dropping chat message for room 2', logs.output[-1])
+        self.assertEqual(buffer._failures, 0)
+        self.assertEqual(buffer._pending, [])
+
+
+class ChatHistoryTests(TestCase):
+
+    def setUp(self):
+        self.room = ChatRoom.objects.create(destination=create_destination())
+        self.user = User.objects.create_user('trekker', password='x')
+        start = datetime.datetime(2024, 3, 10, tzinfo=datetime.timezone.utc)
+        # Pairs of messages share a timestamp, so pages must break ties by id
+        self.messages = ChatMessage.objects.bulk_create([
+            ChatMessage(chat_room=self.room, user=self.user, message=f'message {i}',
+                        timestamp=start + datetime.timedelta(minutes=i // 2))
+            for i in range(7)
+        ])
+
+    def test_cursor_round_trip(self):
+        message = self.messages[3]
+        self.assertEqual(decode_cursor(encode_cursor(message)), (message.timestamp, message.pk))
+        for cursor in ('', 'not a cursor', 'fHx8', encode_cursor(message)[:-4]):
+            with self.assertRaises(ValueError):
+                decode_cursor(cursor)
+
+    def test_pages_walk_back_through_history(self):
+        pages, cursor = [], None
+        while True:
+            page, cursor = messages_before(self.room.pk, cursor, limit=3)
+            pages.append([message.message for message in page])
+            if cursor is None:
+                break
+        self.assertEqual(pages, [
+            ['message 4', 'message 5', 'message 6'],
+            ['message 1', 'message 2', 'message 3'],
+            ['message 0'],
+        ])
+
+    def test_messages_since(self):
+        page, more = messages_since(self.room.pk, self.messages[2].pk, limit=3)
+        self.assertEqual([message.message for message in page],
+                         ['message 3', 'message 4', 'message 5'])
+        self.assertTrue(more)
+        page, more = messages_since(self.room.pk, self.messages[5].pk, limit=3)
+        self.assertEqual([message.message for message in page], ['message 6'])
+        self.assertFalse(more)
+
+
+class TokenBucketTests(TestCase):
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=2, burst=3)
+        now = bucket.updated
+        self.assertEqual([bucket.allow(now) for _ in range(4)], [True, True, True, False])
+        self.assertAlmostEqual(bucket.retry_after(), 0.5)
+        self.assertFalse(bucket.allow(now + 0.25))
+        self.assertTrue(bucket.allow(now + 0.5))
+        self.assertFalse(bucket.is_full(now + 1))
+        self.assertTrue(bucket.is_full(now + 2))
+
+
+class DestinationSearchTests(TestCase):
+
+    def test_ranked_search_with_escaped_snippets(self):
+        # Saved inside the test's transaction, so indexing must not need to create the table
+        create_destination(name='Annapurna Circuit', description='Cross the <b>Thorong</b> La')
+        create_destination(name='Thorong Peak', description='A climb above the pass')
+        create_destination(name='Manaslu Circuit', description='Cross the Larkya La')
+        results = APIClient().get('/api/destinations/search/', {'q': 'thoro'}).data
+        self.assertEqual([result['name'] for result in results],
+                         ['Thorong Peak', 'Annapurna Circuit'])
+        self.assertEqual(results[1]['snippet'],
+                         'Cross the &lt;b&gt;<mark>Thorong</mark>&lt;/b&gt; La')
+
+
+class ChatSearchTests(TestCase):
+
+    def setUp(self):
+        self.room = ChatRoom.objects.create(destination=create_destination())
+        other_room = ChatRoom.objects.create(destination=create_destination('Other Trek'))
+        user = User.objects.create_user('trekker', password='x')
+        texts = [
+            'Crossing the Thorong La pass tomorrow',
+            'Thorong thorong, everyone talks about Thorong',
+            'Nothing to see here',
+            'Snow at <script>alert(1)</script> Thorong High Camp',
+        ]
+        # Written like WebSocket batches, inside a transaction
+        write_messages([ChatMessage(chat_room=self.room, user=user, message=text)
+                        for text in texts])
+        write_messages([ChatMessage(chat_room=other_room, user=user, message='Thorong again')])
+
+    def search(self, order, limit=10):
+        results, cursor = [], None
+        while True:
+            page, cursor = search_messages(self.room.pk, 'thor', order, cursor, limit)
+            results.extend(page)
+            if cursor is None:
+                return results
+
+    def test_ranked_by_relevance(self):
+        results = self.search('rank')
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0].message, 'Thorong thorong, everyone talks about Thorong')
+        ranks = [message.search_rank for message in results]
+        self.assertEqual(ranks, sorted(ranks))
+
+    def test_pages_cover_every_match_once(self):
+        for order in ('rank', 'recent'):
+            with self.subTest(order=order):
+                self.assertEqual([m.pk for m in self.search(order, limit=1)],
+                                 [m.pk for m in self.search(order)])
+        self.assertEqual([m.message for m in self.search('recent')][0],
+                         'Snow at <script>alert(1)</script> Thorong High Camp')
+
+    def test_snippets_are_escaped(self):
+        snippets = {m.message: m.search_snippet for m in self.search('recent')}
+        self.assertEqual(snippets['Snow at <script>alert(1)</script> Thorong High Camp'],
+                         'Snow at &lt;script&gt;alert(1)&lt;/script&gt; '
+                         '<mark>Thorong</mark> High Camp')
+
+    def test_cursor_round_trip(self):
+        message = self.search('rank')[1]
+        self.assertEqual(decode_search_cursor(encode_search_cursor(message, 'rank'), 'rank'),
+                         (message.search_rank, message.pk))
+        self.assertEqual(decode_search_cursor(encode_search_cursor(message, 'recent'), 'recent'),
+                         (None, message.pk))
+        with self.assertRaises(ValueError):
+            decode_search_cursor('not a cursor', 'rank')
@@ -18,6 +18,10 @@ urlpatterns = [
     # Chat endpoint
     path('chat/destination/<int:destination_id>/', views.get_chat_by_destination, name='chat-by-destination'),
     
+    # Cache counters (staff only)
+    path('cache-stats/', views.cache_stats, name='cache-stats'),
+    path('chat-stats/', views.chat_stats, name='chat-stats'),
+    
     # Router URLs
     path('', include(router.urls)),
 ]
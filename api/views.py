@@ -1,24 +1,39 @@
+import datetime
+
 from rest_framework import viewsets, status, filters
 from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
 from rest_framework.authtoken.models import Token
+from rest_framework.settings import api_settings
 from django.contrib.auth import authenticate
 from django.contrib.auth.models import User
 from django.shortcuts import get_object_or_404
+from django.db import transaction
+from django.db.models import Prefetch, Q
 from django.utils import timezone
-import requests
-from django.conf import settings
+from django.utils.dateparse import parse_date, parse_datetime
 
-from .models import (
-    Destination, TrekRoute, WeatherCache,
-    ChatRoom, ChatMessage, Booking, Review
+from .models import Destination, ChatRoom, ChatMessage, Booking, Review
+from .history import DAILY, HOURLY, weather_history
+from .limits import get_chat_limits
+from .cache import cached_response, catalogue_version, destination_version, get_response_cache
+from .chat import messages_before, messages_since
+from .chat_search import ORDERS, search_messages
+from .presence import get_presence_tracker
+from .renderers import PolylineRenderer
+from .risk import build_risk_map
+from .routes import downsample_lttb, encoded_route_for_zoom, ensure_route_metrics
+from .search import (
+    DestinationSearchFilter, highlight_snippet, search_available, search_destinations
 )
+from .spatial import destination_index, route_point_index, segment_index
+from .weather import cached_weather, get_weather, weather_memory_cache
 from .serializers import (
     UserSerializer, UserRegistrationSerializer,
     DestinationListSerializer, DestinationDetailSerializer,
-    TrekRouteSerializer, WeatherCacheSerializer,
-    ChatRoomSerializer, ChatMessageSerializer,
+    TrekRouteSerializer, RouteMetricsSerializer, WeatherCacheSerializer,
+    ChatRoomSerializer, ChatMessageSerializer, ChatMessageSearchResultSerializer,
     BookingSerializer, ReviewSerializer
 )
 
@@ -72,6 +87,30 @@ def get_user_profile(request):
     return Response(serializer.data)
 
 
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def cache_stats(request):
+    """Hit/miss/eviction counters of this worker's in-process caches"""
+    stats = {'weather': weather_memory_cache().stats()}
+    response_cache = get_response_cache()
+    if hasattr(response_cache, 'stats'):
+        stats['responses'] = response_cache.stats()
+    return Response(stats)
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def chat_stats(request):
+    """How often this worker's chat limits fired, and its current sockets"""
+    tracker = get_presence_tracker()
+    rooms = list(tracker.rooms.values())
+    return Response({
+        'limits': get_chat_limits().stats(),
+        'rooms': sum(1 for room in rooms if room.consumers),
+        'connections': sum(len(room.consumers) for room in rooms),
+    })
+
+
 # Destination Views
 class DestinationViewSet(viewsets.ReadOnlyModelViewSet):
     """
@@ -81,36 +120,139 @@ class DestinationViewSet(viewsets.ReadOnlyModelViewSet):
     """
     queryset = Destination.objects.all()
     permission_classes = [AllowAny]
-    filter_backends = [filters.SearchFilter, filters.OrderingFilter]
+    filter_backends = [DestinationSearchFilter, filters.OrderingFilter]
     search_fields = ['name', 'location', 'description']
-    ordering_fields = ['price', 'duration_days', 'altitude', 'created_at']
+    ordering_fields = ['price', 'duration_days', 'altitude', 'created_at',
+                       'rating_average', 'rating_count']
+    
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action in ('retrieve', 'featured'):
+            # Prefetch nested relations so the detail serializer runs a fixed
+            # number of queries; ratings come from the denormalized summary
+            queryset = queryset.select_related('route_metrics').prefetch_related(
+                'route_points',
+                'weather_data',
+                Prefetch('reviews', queryset=Review.objects.select_related('user')),
+            )
+        return queryset
     
     def get_serializer_class(self):
         if self.action == 'list':
             return DestinationListSerializer
         return DestinationDetailSerializer
     
-    @action(detail=True, methods=['get'])
+    def list(self, request, *args, **kwargs):
+        return cached_response(request, 'list', catalogue_version(),
+                               lambda: super(DestinationViewSet, self).list(request, *args, **kwargs))
+    
+    def retrieve(self, request, *args, **kwargs):
+        return cached_response(request, 'retrieve', destination_version(kwargs['pk']),
+                               lambda: super(DestinationViewSet, self).retrieve(request, *args, **kwargs))
+    
+    @action(detail=True, methods=['get'],
+            renderer_classes=api_settings.DEFAULT_RENDERER_CLASSES + [PolylineRenderer])
     def route(self, request, pk=None):
-        """Get route coordinates for a destination"""
-        destination = self.get_object()
-        route_points = destination.route_points.all()
-        serializer = TrekRouteSerializer(route_points, many=True)
-        return Response(serializer.data)
+        """
+        Get route coordinates for a destination.
+        ?format=polyline&zoom=N returns an encoded polyline simplified for zoom N.
+        """
+        def build():
+            destination = self.get_object()
+            if request.accepted_renderer.format == PolylineRenderer.format:
+                zoom = request.query_params.get('zoom')
+                zoom = int(zoom) if zoom and zoom.isdigit() else None
+                metrics = ensure_route_metrics(destination.pk)
+                return Response(encoded_route_for_zoom(metrics.encoded_routes, zoom))
+            route_points = destination.route_points.all()
+            serializer = TrekRouteSerializer(route_points, many=True)
+            return Response(serializer.data)
+        return cached_response(request, 'route', destination_version(pk), build)
     
     @action(detail=True, methods=['get'])
-    def weather(self, request, pk=None):
-        """Get weather data for a destination"""
-        destination = self.get_object()
+    def elevation_profile(self, request, pk=None):
+        """
+        Get a distance-vs-altitude series downsampled (LTTB) to ?points=N
+        (default 300, between 2 and 5000) for drawing altitude charts.
+        """
+        def build():
+            destination = self.get_object()
+            resolution = min(max(_int_param(request, 'points', 300), 2), 5000)
+            # Distances along the route are filled in with the metrics
+            ensure_route_metrics(destination.pk)
+            rows = list(destination.route_points.values_list(
+                'distance_from_start_km', 'altitude', 'location_name'))
+            distances = [row[0] for row in rows]
+            altitudes = [row[1] for row in rows]
+            indices = downsample_lttb(distances, altitudes, resolution).tolist()
+            return Response({
+                'points': len(indices),
+                'source_points': len(rows),
+                'distance_km': [distances[i] for i in indices],
+                'altitude_m': [altitudes[i] for i in indices],
+                'stops': [{'distance_km': distance, 'name': name}
+                          for distance, _, name in rows if name],
+            })
+        return cached_response(request, 'elevation_profile', destination_version(pk), build)
+    
+    @action(detail=True, methods=['get'])
+    def locate(self, request, pk=None):
+        """
+        Locate a trekker on the route from ?lat=&lon=: nearest point on the
+        route, distance travelled and remaining, and the next named stop.
+        """
+        params = _float_params(request, ['lat', 'lon'])
+        if params is None:
+            return Response({'error': 'lat and lon are required numbers'},
+                          status=status.HTTP_400_BAD_REQUEST)
+        version = destination_version(pk)
+        if version is None:
+            return Response({'error': 'Destination not found'}, status=status.HTTP_404_NOT_FOUND)
         
-        # Check for cached weather data
-        cached_weather = destination.weather_data.first()
-        if cached_weather and cached_weather.is_cache_valid(settings.WEATHER_CACHE_DURATION):
-            serializer = WeatherCacheSerializer(cached_weather)
-            return Response(serializer.data)
+        index = segment_index(int(pk), version)
+        located = index.locate(*params)
+        if located is None:
+            return Response({'error': 'Destination has no route points'},
+                          status=status.HTTP_404_NOT_FOUND)
+        segment, fraction, off_route_km = located
+        lat, lon, travelled = index.position(segment, fraction)
+        total = index.total_km
         
-        # Fetch new weather data
-        weather_data = fetch_weather_for_destination(destination)
+        next_stop = index.next_stop(segment, fraction)
+        if next_stop is not None:
+            stop_index, sequence_order, name = next_stop
+            next_stop = {
+                'name': name,
+                'sequence_order': sequence_order,
+                'distance_km': round(float(index.cumulative_km[stop_index]) - travelled, 3),
+            }
+        return Response({
+            'nearest_point': {'latitude': lat, 'longitude': lon},
+            'off_route_km': round(off_route_km, 3),
+            'distance_travelled_km': round(travelled, 3),
+            'distance_remaining_km': round(total - travelled, 3),
+            'total_distance_km': round(total, 3),
+            'progress_percent': round(100 * travelled / total, 1) if total else 100.0,
+            'next_stop': next_stop,
+        })
+    
+    @action(detail=True, methods=['get'])
+    def route_metrics(self, request, pk=None):
+        """Get precomputed distance, elevation and grade stats for a route"""
+        def build():
+            destination = self.get_object()
+            metrics = ensure_route_metrics(destination.pk)
+            return Response(RouteMetricsSerializer(metrics).data)
+        return cached_response(request, 'route_metrics', destination_version(pk), build)
+    
+    @action(detail=True, methods=['get'])
+    def weather(self, request, pk=None):
+        """Get weather data for a destination"""
+        # Hot destinations are answered from the in-memory tier without a query
+        weather_data = cached_weather(int(pk)) if pk.isdigit() else None
+        if weather_data is None:
+            # Table, stale-while-revalidate or a coalesced fetch
+            weather_data = get_weather(self.get_object())
         if weather_data:
             serializer = WeatherCacheSerializer(weather_data)
             return Response(serializer.data)
@@ -118,89 +260,167 @@ class DestinationViewSet(viewsets.ReadOnlyModelViewSet):
         return Response({'error': 'Unable to fetch weather data'}, 
                        status=status.HTTP_503_SERVICE_UNAVAILABLE)
     
+    @action(detail=True, methods=['get'])
+    def weather_history(self, request, pk=None):
+        """
+        Weather readings over a range as columns: ?days=N (default 7, ending
+        now) or ?start=&end= ISO datetimes, ?resolution=hourly|daily and
+        ?fields=temperature,wind_speed,...
+        """
+        destination = self.get_object()
+        end = timezone.now()
+        start = end - datetime.timedelta(days=min(_int_param(request, 'days', 7), 36500))
+        if 'start' in request.query_params or 'end' in request.query_params:
+            try:
+                start = _datetime_param(request, 'start', start)
+                end = _datetime_param(request, 'end', end)
+            except ValueError:
+                return Response({'error': 'start and end must be ISO 8601 datetimes'},
+                                status=status.HTTP_400_BAD_REQUEST)
+        resolution = request.query_params.get('resolution', '').upper() or None
+        if resolution not in (None, HOURLY, DAILY):
+            return Response({'error': 'resolution must be hourly or daily'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        fields = request.query_params.get('fields')
+        fields = [field.strip() for field in fields.split(',')] if fields else None
+        return Response(weather_history(destination.pk, start, end, resolution, fields))
+    
     @action(detail=False, methods=['get'])
-    def featured(self, request):
-        """Get featured destinations"""
-        featured = self.queryset.filter(featured=True)
-        serializer = self.get_serializer(featured, many=True)
-        return Response(serializer.data)
-
-
-def fetch_weather_for_destination(destination):
-    """
-    Fetch weather data from OpenWeatherMap API and cache it
-    """
-    if not settings.WEATHER_API_KEY:
-        # Create dummy weather data for development
-        return create_dummy_weather(destination)
+    def risk_map(self, request):
+        """
+        Current weather risk for every destination and along every route,
+        recomputed only when destinations, routes or weather change
+        """
+        return cached_response(request, 'risk_map', catalogue_version(),
+                               lambda: Response(build_risk_map()))
     
-    try:
-        url = f"https://api.openweathermap.org/data/2.5/weather"
-        params = {
-            'lat': destination.latitude,
-            'lon': destination.longitude,
-            'appid': settings.WEATHER_API_KEY,
-            'units': 'metric'
-        }
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """Ranked type-ahead search with highlighted description snippets"""
+        text = request.query_params.get('q', '').strip()
+        if not text:
+            return Response({'error': 'q parameter is required'},
+                          status=status.HTTP_400_BAD_REQUEST)
+        limit = min(_int_param(request, 'limit', 10), 50)
         
-        response = requests.get(url, params=params, timeout=5)
-        response.raise_for_status()
-        data = response.json()
+        if not search_available():
+            destinations = self.get_queryset().filter(
+                Q(name__icontains=text) | Q(location__icontains=text))[:limit]
+            return Response([
+                {'id': d.id, 'name': d.name, 'location': d.location, 'snippet': ''}
+                for d in destinations
+            ])
         
-        # Determine risk warnings
-        temp = data['main']['temp']
-        weather_main = data['weather'][0]['main'].lower()
+        destinations = search_destinations(self.get_queryset(), text, snippets=True)
+        return Response([
+            {'id': d.id, 'name': d.name, 'location': d.location, 'snippet': highlight_snippet(d.search_snippet)}
+            for d in destinations.only('id', 'name', 'location')[:limit]
+        ])
+    
+    @action(detail=False, methods=['get'])
+    def nearby(self, request):
+        """
+        Get the k destinations nearest to lat/lon.
+        by=route ranks treks by their closest route point instead of map centre.
+        """
+        params = _float_params(request, ['lat', 'lon'])
+        if params is None:
+            return Response({'error': 'lat and lon are required numbers'},
+                          status=status.HTTP_400_BAD_REQUEST)
+        lat, lon = params
+        k = min(_int_param(request, 'k', 10), 100)
+        radius = _float_params(request, ['radius'])
+        radius = radius[0] if radius else None
         
-        has_rain = 'rain' in weather_main or 'drizzle' in weather_main
-        has_snow = 'snow' in weather_main
-        has_altitude_warning = destination.altitude > 4000
+        distances = {}
+        if request.query_params.get('by') == 'route':
+            for distance, point_id, destination_id in route_point_index().nearest(lat, lon, radius):
+                distances.setdefault(destination_id, distance)
+                if len(distances) >= k:
+                    break
+        else:
+            for distance, destination_id, _ in destination_index().nearest(lat, lon, radius):
+                distances[destination_id] = distance
+                if len(distances) >= k:
+                    break
         
-        # Calculate risk level
-        risk_level = 'LOW'
-        if has_snow or (has_altitude_warning and temp < 0):
-            risk_level = 'HIGH'
-        elif has_rain or has_altitude_warning:
-            risk_level = 'MEDIUM'
+        destinations = Destination.objects.in_bulk(list(distances))
+        results = []
+        for destination_id, distance in distances.items():
+            if destination_id in destinations:
+                data = DestinationListSerializer(destinations[destination_id],
+                                                 context={'request': request}).data
+                data['distance_km'] = round(distance, 3)
+                results.append(data)
+        return Response(results)
+    
+    @action(detail=False, methods=['get'])
+    def bbox(self, request):
+        """
+        Get destinations whose map centre lies inside a viewport.
+        points=true also returns route points in the viewport (up to `limit`).
+        """
+        params = _float_params(request, ['south', 'west', 'north', 'east'])
+        if params is None:
+            return Response({'error': 'south, west, north and east are required numbers'},
+                          status=status.HTTP_400_BAD_REQUEST)
+        ids = [key for key, _, _, _ in destination_index().within_bbox(*params)]
+        destinations = Destination.objects.filter(pk__in=ids)
+        data = {
+            'destinations': DestinationListSerializer(destinations, many=True,
+                                                      context={'request': request}).data
+        }
         
-        # Delete old cache and create new
-        WeatherCache.objects.filter(destination=destination).delete()
-        weather_cache = WeatherCache.objects.create(
-            destination=destination,
-            temperature=temp,
-            weather_condition=data['weather'][0]['main'],
-            description=data['weather'][0]['description'],
-            humidity=data['main']['humidity'],
-            wind_speed=data['wind']['speed'],
-            has_rain_warning=has_rain,
-            has_snow_warning=has_snow,
-            has_altitude_warning=has_altitude_warning,
-            risk_level=risk_level
-        )
-        return weather_cache
+        if request.query_params.get('points') == 'true':
+            limit = min(_int_param(request, 'limit', 1000), 10000)
+            points = []
+            for point_id, lat, lon, destination_id in route_point_index().within_bbox(*params):
+                points.append({'id': point_id, 'destination': destination_id,
+                               'latitude': lat, 'longitude': lon})
+                if len(points) >= limit:
+                    break
+            data['route_points'] = points
+        return Response(data)
     
-    except Exception as e:
-        print(f"Error fetching weather: {e}")
-        return create_dummy_weather(destination)
+    @action(detail=False, methods=['get'])
+    def featured(self, request):
+        """Get featured destinations"""
+        def build():
+            featured = self.get_queryset().filter(featured=True)
+            serializer = self.get_serializer(featured, many=True)
+            return Response(serializer.data)
+        return cached_response(request, 'featured', catalogue_version(), build)
 
 
-def create_dummy_weather(destination):
-    """Create dummy weather data for development"""
-    WeatherCache.objects.filter(destination=destination).delete()
-    
-    has_altitude_warning = destination.altitude > 4000
-    weather_cache = WeatherCache.objects.create(
-        destination=destination,
-        temperature=15.5,
-        weather_condition='Clear',
-        description='clear sky',
-        humidity=65,
-        wind_speed=3.5,
-        has_rain_warning=False,
-        has_snow_warning=False,
-        has_altitude_warning=has_altitude_warning,
-        risk_level='MEDIUM' if has_altitude_warning else 'LOW'
-    )
-    return weather_cache
+def _float_params(request, names):
+    """Parse required float query params; None if any is missing or invalid"""
+    try:
+        return [float(request.query_params[name]) for name in names]
+    except (KeyError, ValueError):
+        return None
+
+
+def _datetime_param(request, name, default):
+    """Parse an optional ISO 8601 query param; naive values use the current timezone"""
+    value = request.query_params.get(name)
+    if not value:
+        return default
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(value)
+        moment = datetime.datetime.combine(day, datetime.time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def _int_param(request, name, default):
+    try:
+        return max(int(request.query_params.get(name, default)), 1)
+    except ValueError:
+        return default
 
 
 # Chat Views
@@ -208,17 +428,60 @@ class ChatRoomViewSet(viewsets.ReadOnlyModelViewSet):
     """
     ViewSet for chat rooms
     """
-    queryset = ChatRoom.objects.all()
+    # Counters and the last message are denormalized, so listing is one query
+    queryset = ChatRoom.objects.select_related('destination', 'last_message__user')
     serializer_class = ChatRoomSerializer
     permission_classes = [IsAuthenticated]
     
     @action(detail=True, methods=['get'])
     def messages(self, request, pk=None):
-        """Get messages for a chat room"""
+        """
+        Get messages for a chat room, newest page first (?limit=, default 50).
+        Each page is ordered oldest to newest; pass ?before=<next> for older
+        pages, or ?since=<message id> for everything newer (delta sync).
+        """
         chat_room = self.get_object()
-        messages = chat_room.messages.all()[:100]  # Last 100 messages
+        limit = min(_int_param(request, 'limit', 50), 200)
+        since = request.query_params.get('since')
+        if since is not None:
+            if not since.isdigit():
+                return Response({'error': 'since must be a message id'},
+                                status=status.HTTP_400_BAD_REQUEST)
+            messages, has_more = messages_since(chat_room.pk, int(since), limit)
+            serializer = ChatMessageSerializer(messages, many=True)
+            return Response({'results': serializer.data, 'has_more': has_more})
+        try:
+            messages, next_cursor = messages_before(
+                chat_room.pk, request.query_params.get('before'), limit)
+        except ValueError:
+            return Response({'error': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
         serializer = ChatMessageSerializer(messages, many=True)
-        return Response(serializer.data)
+        return Response({'results': serializer.data, 'next': next_cursor})
+    
+    @action(detail=True, methods=['get'])
+    def search(self, request, pk=None):
+        """
+        Search a chat room's messages (?q=, ?limit=, default 20), best matches
+        first, or newest first with ?order=recent. Results carry a highlighted
+        snippet; pass ?cursor=<next> for the following page.
+        """
+        chat_room = self.get_object()
+        text = request.query_params.get('q', '').strip()
+        if not text:
+            return Response({'error': 'q parameter is required'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        order = request.query_params.get('order', 'rank')
+        if order not in ORDERS:
+            return Response({'error': f'order must be one of: {", ".join(ORDERS)}'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        limit = min(_int_param(request, 'limit', 20), 100)
+        try:
+            messages, next_cursor = search_messages(
+                chat_room.pk, text, order, request.query_params.get('cursor'), limit)
+        except ValueError:
+            return Response({'error': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
+        serializer = ChatMessageSearchResultSerializer(messages, many=True)
+        return Response({'results': serializer.data, 'next': next_cursor})
     
     @action(detail=True, methods=['post'])
     def send_message(self, request, pk=None):
@@ -230,11 +493,13 @@ class ChatRoomViewSet(viewsets.ReadOnlyModelViewSet):
             return Response({'error': 'Message cannot be empty'}, 
                           status=status.HTTP_400_BAD_REQUEST)
         
-        message = ChatMessage.objects.create(
-            chat_room=chat_room,
-            user=request.user,
-            message=message_text
-        )
+        with transaction.atomic():
+            message = ChatMessage.objects.create(
+                chat_room=chat_room,
+                user=request.user,
+                message=message_text
+            )
+            ChatRoom.record_new_messages(chat_room.pk, 1, message.pk)
         
         serializer = ChatMessageSerializer(message)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -279,5 +544,24 @@ class ReviewViewSet(viewsets.ModelViewSet):
             return Review.objects.filter(destination_id=destination_id)
         return Review.objects.all()
     
+    @transaction.atomic
     def perform_create(self, serializer):
-        serializer.save(user=self.request.user)
+        review = serializer.save(user=self.request.user)
+        Destination.apply_rating_change(review.destination_id, added=review.rating)
+    
+    @transaction.atomic
+    def perform_update(self, serializer):
+        old_destination_id = serializer.instance.destination_id
+        old_rating = serializer.instance.rating
+        review = serializer.save()
+        if review.destination_id != old_destination_id:
+            Destination.apply_rating_change(old_destination_id, removed=old_rating)
+            Destination.apply_rating_change(review.destination_id, added=review.rating)
+        elif review.rating != old_rating:
+            Destination.apply_rating_change(review.destination_id,
+                                            removed=old_rating, added=review.rating)
+    
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        Destination.apply_rating_change(instance.destination_id, removed=instance.rating)
+        instance.delete()
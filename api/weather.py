@@ -0,0 +1,227 @@
+"""
+Weather caching and batch refresh.
+
+Readings come from the provider client in api/weather_providers.py.
+store_weather() scores them with the rules in api/risk.py, upserts the
+WeatherCache row and appends the reading to the history (api/history.py).
+refresh_weather_batch() fetches many destinations concurrently on a
+bounded thread pool, in batches where the provider supports them, so the
+`weather` endpoint can read a cache that was warmed ahead of expiry.
+
+get_weather() serves requests. Fresh rows are kept in an in-process LRU
+tier in front of the table, so hot destinations skip the database. Expired
+rows are returned immediately while one background refresh runs
+(stale-while-revalidate), and concurrent misses for a destination share a
+single in-flight fetch.
+"""
+import datetime
+import logging
+import random
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .cache import LRUCacheBackend
+from .history import record_weather
+from .models import Destination, WeatherCache
+from .risk import assess_reading
+from .weather_providers import WeatherProviderError, get_weather_client
+
+logger = logging.getLogger(__name__)
+
+
+def store_weather(destination, reading):
+    """Derive risk warnings from a provider reading and cache it"""
+    risk = assess_reading(reading['weather_condition'], reading['temperature'],
+                          destination.altitude)
+
+    # Upsert the single row per destination instead of delete + insert
+    weather_cache, _ = WeatherCache.objects.update_or_create(
+        destination=destination,
+        defaults=dict(
+            **risk,
+            **reading
+        ),
+    )
+    record_weather(weather_cache)
+    return weather_cache
+
+
+def fetch_weather_for_destination(destination):
+    """
+    Fetch weather data for one destination and cache it.
+    If the provider fails or its circuit is open, the last good reading is
+    returned untouched (None if there is none).
+    """
+    try:
+        reading = get_weather_client().fetch(destination)
+    except WeatherProviderError as e:
+        logger.warning('Weather fetch for %s failed: %s', destination.name, e)
+        return destination.weather_data.first()
+    return store_weather(destination, reading)
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls for the same key: the first caller runs the
+    function and everyone arriving meanwhile waits for and shares its result.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def in_flight(self, key):
+        with self._lock:
+            return key in self._calls
+
+    def do(self, key, function):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            result = function()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+_weather_flights = SingleFlight()
+_background = ThreadPoolExecutor(max_workers=2, thread_name_prefix='weather-refresh')
+
+
+def _refresh_coalesced(destination):
+    return _weather_flights.do(destination.pk, lambda: fetch_weather_for_destination(destination))
+
+
+def _refresh_in_background(destination):
+    if _weather_flights.in_flight(destination.pk):
+        return
+
+    def run():
+        try:
+            _refresh_coalesced(destination)
+        finally:
+            connection.close()
+
+    _background.submit(run)
+
+
+_memory = None
+_memory_lock = threading.Lock()
+
+
+def _memory_config():
+    return getattr(settings, 'WEATHER_MEMORY_CACHE', {})
+
+
+def weather_memory_cache():
+    """The per-process LRU tier holding fresh WeatherCache rows by destination id"""
+    global _memory
+    with _memory_lock:
+        if _memory is None:
+            _memory = LRUCacheBackend(_memory_config().get('MAX_ENTRIES', 2048))
+        return _memory
+
+
+def remember_weather(weather_cache):
+    """
+    Keep a fresh row in memory until shortly before it expires. The lifetime
+    is capped by WEATHER_MEMORY_CACHE['TIMEOUT'], which bounds how long another
+    worker's refresh can go unseen, and shortened by a random JITTER fraction
+    so rows cached together do not all expire together.
+    """
+    config = _memory_config()
+    age = (timezone.now() - weather_cache.cached_at).total_seconds()
+    timeout = min(settings.WEATHER_CACHE_DURATION - age, config.get('TIMEOUT', 300))
+    timeout *= 1 - random.uniform(0, config.get('JITTER', 0.1))
+    if timeout > 0:
+        weather_memory_cache().set(weather_cache.destination_id, weather_cache, timeout)
+
+
+def cached_weather(destination_id):
+    """Fresh weather from the memory tier, or None"""
+    return weather_memory_cache().get(destination_id)
+
+
+def forget_weather(destination_id):
+    weather_memory_cache().delete(destination_id)
+
+
+def get_weather(destination):
+    """
+    Current weather for a destination, refreshing it as needed.
+    Fresh rows are served from memory or the table. Rows expired by less than
+    WEATHER_STALE_WHILE_REVALIDATE seconds are served immediately while a
+    single background refresh runs. Anything older blocks on one coalesced
+    fetch shared by all concurrent callers.
+    """
+    cached = cached_weather(destination.pk)
+    if cached is not None:
+        return cached
+    cached = destination.weather_data.first()
+    duration = settings.WEATHER_CACHE_DURATION
+    if cached and cached.is_cache_valid(duration):
+        remember_weather(cached)
+        return cached
+    stale_window = getattr(settings, 'WEATHER_STALE_WHILE_REVALIDATE', 0)
+    if cached and cached.is_cache_valid(duration + stale_window):
+        _refresh_in_background(destination)
+        return cached
+    weather_cache = _refresh_coalesced(destination)
+    if weather_cache:
+        remember_weather(weather_cache)
+    return weather_cache
+
+
+def destinations_due_for_refresh(ahead=300):
+    """Destinations whose cached weather is missing or expires within `ahead` seconds"""
+    cutoff = timezone.now() - datetime.timedelta(seconds=settings.WEATHER_CACHE_DURATION - ahead)
+    fresh = WeatherCache.objects.filter(cached_at__gt=cutoff).values('destination_id')
+    return Destination.objects.exclude(pk__in=fresh)
+
+
+def refresh_weather_batch(destinations, max_workers=None):
+    """
+    Fetch weather for many destinations concurrently and cache the results.
+    Destinations are grouped into provider-sized batches whose calls run on
+    a bounded thread pool; database writes stay on the calling thread.
+    A failed batch keeps its last good readings. Returns (refreshed, failed)
+    counts.
+    """
+    client = get_weather_client()
+    max_workers = max_workers or getattr(settings, 'WEATHER_REFRESH_WORKERS', 8)
+    destinations = list(destinations)
+    size = client.provider.batch_size
+    batches = [destinations[i:i + size] for i in range(0, len(destinations), size)]
+
+    def fetch(batch):
+        try:
+            return batch, client.fetch_many(batch), None
+        except WeatherProviderError as e:
+            return batch, None, e
+
+    refreshed = failed = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for batch, readings, error in executor.map(fetch, batches):
+            if error is not None:
+                logger.warning('Weather fetch for %d destinations failed: %s', len(batch), error)
+                failed += len(batch)
+                continue
+            for destination, reading in zip(batch, readings):
+                store_weather(destination, reading)
+                refreshed += 1
+    return refreshed, failed
@@ -0,0 +1,327 @@
+"""
+Weather provider clients.
+
+A provider turns destinations into readings (temperature,
+weather_condition, description, humidity, wind_speed). WeatherClient wraps
+the configured provider with a rate limiter, bounded retries with
+exponential backoff, and a circuit breaker that fails fast while the
+provider is down, so callers can keep serving the last good reading.
+"""
+import random
+import threading
+import time
+
+import requests
+from django.conf import settings
+from django.utils.module_loading import import_string
+from requests.adapters import HTTPAdapter
+
+
+class WeatherProviderError(Exception):
+    """A provider call failed; `retryable` marks transient failures"""
+
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class CircuitOpenError(WeatherProviderError):
+    def __init__(self):
+        super().__init__('weather provider circuit is open', retryable=False)
+
+
+class RateLimiter:
+    """Thread-safe limiter spacing calls at most `rate` per second"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next_slot, now)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and rejects calls
+    for `reset_timeout` seconds. Then a single trial call is let through
+    (half-open): success closes the circuit, failure opens it again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return self.CLOSED
+            if self._trial or time.monotonic() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self.OPEN
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial or time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial = False
+
+
+class WeatherProvider:
+    """
+    Base class for weather sources. fetch() returns one reading;
+    fetch_many() returns readings in the same order as `destinations` and
+    is overridden by providers with a multi-location API (up to batch_size
+    destinations per call). Failures raise WeatherProviderError.
+    """
+    name = 'base'
+    requests_per_second = None
+    batch_size = 1
+
+    def fetch(self, destination):
+        raise NotImplementedError
+
+    def fetch_many(self, destinations):
+        return [self.fetch(destination) for destination in destinations]
+
+
+class HTTPWeatherProvider(WeatherProvider):
+    """
+    Provider over HTTP with a persistent, pooled session.
+    WEATHER_PROVIDER_URL overrides `base_url` (e.g. to use the fake server).
+    """
+    base_url = ''
+    timeout = 5
+
+    def __init__(self):
+        self.base_url = getattr(settings, 'WEATHER_PROVIDER_URL', '') or self.base_url
+        self.session = requests.Session()
+        pool_size = getattr(settings, 'WEATHER_REFRESH_WORKERS', 8)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get_json(self, path, params):
+        try:
+            response = self.session.get(self.base_url + path, params=params, timeout=self.timeout)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise WeatherProviderError(f'{self.name}: {e}') from e
+        if response.status_code == 429 or response.status_code >= 500:
+            raise WeatherProviderError(f'{self.name} returned {response.status_code}')
+        if response.status_code >= 400:
+            raise WeatherProviderError(f'{self.name} returned {response.status_code}', retryable=False)
+        try:
+            return response.json()
+        except ValueError as e:
+            raise WeatherProviderError(f'{self.name} returned invalid JSON', retryable=False) from e
+
+
+class OpenWeatherMapProvider(HTTPWeatherProvider):
+    """Current weather from OpenWeatherMap (needs WEATHER_API_KEY)"""
+    name = 'openweathermap'
+    base_url = 'https://api.openweathermap.org'
+    requests_per_second = 1  # free tier allows 60 calls/minute
+
+    def fetch(self, destination):
+        data = self.get_json('/data/2.5/weather', {
+            'lat': destination.latitude,
+            'lon': destination.longitude,
+            'appid': settings.WEATHER_API_KEY,
+            'units': 'metric'
+        })
+        try:
+            return {
+                'temperature': data['main']['temp'],
+                'weather_condition': data['weather'][0]['main'],
+                'description': data['weather'][0]['description'],
+                'humidity': data['main']['humidity'],
+                'wind_speed': data['wind']['speed'],
+            }
+        except (KeyError, IndexError, TypeError) as e:
+            raise WeatherProviderError(f'{self.name} response missing {e}', retryable=False) from e
+
+
+# WMO weather interpretation codes -> (condition, description), by code range
+WMO_CONDITIONS = (
+    (0, 0, 'Clear', 'clear sky'),
+    (1, 3, 'Clouds', 'partly cloudy'),
+    (45, 48, 'Fog', 'fog'),
+    (51, 57, 'Drizzle', 'drizzle'),
+    (61, 67, 'Rain', 'rain'),
+    (71, 77, 'Snow', 'snow'),
+    (80, 82, 'Rain', 'rain showers'),
+    (85, 86, 'Snow', 'snow showers'),
+    (95, 99, 'Thunderstorm', 'thunderstorm'),
+)
+
+
+def wmo_condition(code):
+    for low, high, condition, description in WMO_CONDITIONS:
+        if low <= code <= high:
+            return condition, description
+    return 'Unknown', f'weather code {code}'
+
+
+class OpenMeteoProvider(HTTPWeatherProvider):
+    """
+    Current weather from Open-Meteo (no API key), which accepts many
+    coordinates per request, so refreshes are batched
+    """
+    name = 'open-meteo'
+    base_url = 'https://api.open-meteo.com'
+    requests_per_second = 5
+    batch_size = 50
+
+    def fetch(self, destination):
+        return self.fetch_many([destination])[0]
+
+    def fetch_many(self, destinations):
+        data = self.get_json('/v1/forecast', {
+            'latitude': ','.join(str(destination.latitude) for destination in destinations),
+            'longitude': ','.join(str(destination.longitude) for destination in destinations),
+            'current': 'temperature_2m,relative_humidity_2m,wind_speed_10m,weather_code',
+            'wind_speed_unit': 'ms',
+        })
+        # A single location comes back as an object, several as a list
+        locations = data if isinstance(data, list) else [data]
+        if len(locations) != len(destinations):
+            raise WeatherProviderError(f'{self.name} returned {len(locations)} locations '
+                                       f'for {len(destinations)}', retryable=False)
+        readings = []
+        try:
+            for location in locations:
+                current = location['current']
+                condition, description = wmo_condition(current['weather_code'])
+                readings.append({
+                    'temperature': current['temperature_2m'],
+                    'weather_condition': condition,
+                    'description': description,
+                    'humidity': current['relative_humidity_2m'],
+                    'wind_speed': current['wind_speed_10m'],
+                })
+        except (KeyError, TypeError) as e:
+            raise WeatherProviderError(f'{self.name} response missing {e}', retryable=False) from e
+        return readings
+
+
+class StubWeatherProvider(WeatherProvider):
+    """Offline provider returning fixed clear-sky readings (development and tests)"""
+    name = 'stub'
+    batch_size = 100
+
+    def fetch(self, destination):
+        return {
+            'temperature': 15.5,
+            'weather_condition': 'Clear',
+            'description': 'clear sky',
+            'humidity': 65,
+            'wind_speed': 3.5,
+        }
+
+
+class WeatherClient:
+    """
+    Calls a provider through its rate limiter, retrying transient failures
+    up to `retries` times with exponential backoff and full jitter, behind a
+    circuit breaker. Raises WeatherProviderError (CircuitOpenError while the
+    circuit is open) once a call has finally failed.
+    """
+
+    def __init__(self, provider, retries=2, backoff=0.5, max_backoff=8,
+                 failure_threshold=5, reset_timeout=30, rate=None):
+        self.provider = provider
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.rate_limiter = RateLimiter(rate or provider.requests_per_second)
+
+    def _call(self, function, *args):
+        if not self.breaker.allow():
+            raise CircuitOpenError()
+        attempt = 0
+        while True:
+            self.rate_limiter.wait()
+            try:
+                result = function(*args)
+            except WeatherProviderError as e:
+                if e.retryable and attempt < self.retries:
+                    time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+                    attempt += 1
+                    continue
+                self.breaker.record_failure()
+                raise
+            except Exception as e:
+                self.breaker.record_failure()
+                raise WeatherProviderError(f'{self.provider.name}: {e}', retryable=False) from e
+            self.breaker.record_success()
+            return result
+
+    def fetch(self, destination):
+        return self._call(self.provider.fetch, destination)
+
+    def fetch_many(self, destinations):
+        """One provider call for up to provider.batch_size destinations"""
+        return self._call(self.provider.fetch_many, list(destinations))
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_weather_client():
+    """
+    Client for the configured provider: WEATHER_PROVIDER if set, otherwise
+    OpenWeatherMap when an API key is present and the stub when not.
+    Created once per process so the connection pool and breaker are shared.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            path = getattr(settings, 'WEATHER_PROVIDER', '')
+            if not path:
+                path = ('api.weather_providers.OpenWeatherMapProvider' if settings.WEATHER_API_KEY
+                        else 'api.weather_providers.StubWeatherProvider')
+            config = getattr(settings, 'WEATHER_CLIENT', {})
+            _client = WeatherClient(
+                import_string(path)(),
+                retries=config.get('RETRIES', 2),
+                backoff=config.get('BACKOFF', 0.5),
+                max_backoff=config.get('MAX_BACKOFF', 8),
+                failure_threshold=config.get('FAILURE_THRESHOLD', 5),
+                reset_timeout=config.get('RESET_TIMEOUT', 30),
+                rate=getattr(settings, 'WEATHER_PROVIDER_RATE_LIMIT', None),
+            )
+        return _client
@@ -1,21 +1,32 @@
 """
 ASGI config for trekking_app project.
+
+Run several workers for more throughput, e.g.
+    daphne -b 127.0.0.1 -p 8001 trekking_app.asgi:application
+with REDIS_URL set so chat is shared between them (see SETUP.md).
 """
 
 import os
 
 from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'trekking_app.settings')
+
+# Set up Django before importing anything that touches models
+django_asgi_app = get_asgi_application()
+
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 import api.routing
-
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'trekking_app.settings')
+from api.middleware import TokenAuthMiddleware
 
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    "http": django_asgi_app,
     "websocket": AuthMiddlewareStack(
-        URLRouter(
-            api.routing.websocket_urlpatterns
+        TokenAuthMiddleware(
+            URLRouter(
+                api.routing.websocket_urlpatterns
+            )
         )
     ),
 })
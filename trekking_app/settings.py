@@ -129,12 +129,99 @@ CORS_ALLOWED_ORIGINS = [
 CORS_ALLOW_ALL_ORIGINS = True  # For development only
 
 # Channels Configuration
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer'
+# Channel layer. The in-memory layer only delivers within one process; set
+# REDIS_URL to share chat across daphne workers (see SETUP.md). The pub/sub
+# layer suits chat fan-out; CHANNEL_LAYER_BACKEND can select
+# channels_redis.core.RedisChannelLayer instead.
+REDIS_URL = os.getenv('REDIS_URL', '')
+if REDIS_URL:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': os.getenv('CHANNEL_LAYER_BACKEND', 'channels_redis.pubsub.RedisPubSubChannelLayer'),
+            'CONFIG': {
+                'hosts': [REDIS_URL],
+            },
+        }
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer'
+        }
     }
+
+# WebSocket chat messages are stored in batches of up to MAX_BATCH, at most
+# MAX_DELAY seconds after arrival, then broadcast. A failing batch is retried
+# MAX_RETRIES times before its messages are written (or dropped) one by one.
+CHAT_WRITE_BUFFER = {
+    'MAX_BATCH': 100,
+    'MAX_DELAY': 0.05,
+    'MAX_RETRIES': 3,
+}
+CHAT_REPLAY_LIMIT = 200  # messages replayed to a reconnecting client (?since=<id>)
+
+# Busy rooms: set COALESCE to send the messages a room gets within WINDOW
+# seconds as one {"type": "batch"} frame of up to MAX_BATCH messages
+CHAT_BROADCAST = {
+    'COALESCE': False,
+    'WINDOW': 0.03,
+    'MAX_BATCH': 100,
+}
+
+# Presence and typing indicators (see api/presence.py)
+CHAT_PRESENCE = {
+    'FLUSH_INTERVAL': 1.0,  # seconds between coalesced presence diffs
+    'HEARTBEAT_INTERVAL': 15,  # seconds between full snapshots shared by workers
+    'CONNECTION_TIMEOUT': 60,  # close heartbeat-sending sockets silent for this long
+    'TYPING_TIMEOUT': 5,  # seconds a typing indicator lasts without renewal
 }
 
+# Flood protection for chat sockets (see api/limits.py)
+CHAT_LIMITS = {
+    'MAX_MESSAGE_BYTES': 4096,  # larger inbound frames are rejected
+    'CONNECTION_RATE': 5,  # frames per second per socket...
+    'CONNECTION_BURST': 10,  # ...with bursts of up to this many
+    'ROOM_RATE': 50,  # chat messages per second per room and process
+    'ROOM_BURST': 100,
+    'SEND_QUEUE_SIZE': 256,  # outbound frames buffered per socket (keep above CHAT_REPLAY_LIMIT)
+    'SLOW_CONSUMER_POLICY': 'disconnect',  # or 'drop' frames for a full queue
+    'MAX_VIOLATIONS': 20,  # consecutive rejected frames before disconnecting
+}
+
+# Response cache for destination endpoints. Use 'api.cache.DjangoCacheBackend'
+# (OPTIONS: {'alias': 'default'}) to share entries between worker processes.
+RESPONSE_CACHE = {
+    'BACKEND': 'api.cache.LRUCacheBackend',
+    'OPTIONS': {'max_entries': 1024},
+    'TIMEOUT': 3600,  # seconds a cached response is kept
+    'VERSION_TIMEOUT': 5,  # seconds before a destination version is re-read
+}
+
+# Spatial index for nearby/bbox queries
+SPATIAL_INDEX_CELL_SIZE = 0.1  # grid cell size in degrees (~11 km)
+SPATIAL_INDEX_MAX_AGE = 300  # seconds before a worker reloads its index
+
 # Weather API Configuration
 WEATHER_API_KEY = os.getenv('WEATHER_API_KEY', '')
 WEATHER_CACHE_DURATION = 3600  # 1 hour in seconds
+WEATHER_STALE_WHILE_REVALIDATE = 1800  # serve expired weather this long while refreshing
+WEATHER_HISTORY_HOURLY_RETENTION = 30  # days of hourly readings kept before daily downsampling
+WEATHER_MEMORY_CACHE = {
+    'MAX_ENTRIES': 2048,  # fresh weather rows kept in memory per worker
+    'TIMEOUT': 300,  # max seconds a row is served from memory
+    'JITTER': 0.1,  # fraction of the lifetime randomly shaved off each entry
+}
+# Dotted path to a provider class in api/weather_providers.py (e.g.
+# api.weather_providers.OpenMeteoProvider); empty picks OpenWeatherMap
+# when WEATHER_API_KEY is set and the offline stub otherwise
+WEATHER_PROVIDER = os.getenv('WEATHER_PROVIDER', '')
+WEATHER_PROVIDER_URL = os.getenv('WEATHER_PROVIDER_URL', '')  # e.g. the fake_weather_server
+WEATHER_PROVIDER_RATE_LIMIT = None  # requests/second; None uses the provider default
+WEATHER_CLIENT = {
+    'RETRIES': 2,  # extra attempts for timeouts, 429s and 5xx responses
+    'BACKOFF': 0.5,  # base seconds for exponential backoff with jitter
+    'MAX_BACKOFF': 8,
+    'FAILURE_THRESHOLD': 5,  # consecutive failures before the circuit opens
+    'RESET_TIMEOUT': 30,  # seconds the circuit stays open before a trial call
+}
+WEATHER_REFRESH_WORKERS = 8  # concurrent fetches in the refresh_weather command